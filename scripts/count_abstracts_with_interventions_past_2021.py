@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 import re
-import yaml
+import sys
 from pathlib import Path
 import statistics
 import matplotlib.pyplot as plt
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import yaml_cache
+
 # ======== Constants ========
 YAML_PATH = "../data/impact_records.yaml"
 YEAR_REGEX = re.compile(r"\b(19[6-9]\d|20[0-4]\d|2050)\b")
@@ -15,8 +18,7 @@ def load_yaml(path):
     if not Path(path).exists():
         print(f"File not found: {path}")
         return []
-    with open(path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f) or []
+    return yaml_cache.iter_list(path)   # one record at a time
 
 def find_years_with_context(text, radius=40):
     matches = []
@@ -52,7 +54,7 @@ def is_excludable_year_mention(text: str, year: int) -> bool:
 
 def main():
     records = load_yaml(YAML_PATH)
-    print(f"Loaded {len(records)} records")
+    n_records = 0
 
     diffs = []
     valid_records = 0
@@ -60,6 +62,7 @@ def main():
     valid_records_with_context = []
 
     for rec in records:
+        n_records += 1
         if rec:
             pub_year = rec.get("year_of_publication")
             abstract = rec.get("abstract", "")
@@ -91,13 +94,15 @@ def main():
             # if mentioned_years.issubset({pub_year_int - 1, pub_year_int - 2, pub_year_int - 3}):
             if mentioned_years.issubset({pub_year_int - 1, pub_year_int - 2, pub_year_int - 3}):
                 valid_records += 1
-                valid_records_with_context.append((pub_year_int, rec, matches))
+                valid_records_with_context.append((pub_year_int, matches))
 
 
             # Collect all year gaps for histogram
             for mentioned_year in mentioned_years:
                 diffs.append(pub_year_int - mentioned_year)
 
+    print(f"Loaded {n_records} records")
+
     # ====== Stats and Output ======
     print("\n" + "=" * 80)
     if eligible_records > 0:
@@ -125,7 +130,7 @@ def main():
     # ====== Context Printouts ======
     print("\n" + "=" * 80)
     print("Valid eligible records with 1–3 year gap and context:")
-    for i, (pub_year, rec, matches) in enumerate(valid_records_with_context, 1):
+    for i, (pub_year, matches) in enumerate(valid_records_with_context, 1):
         print(f"\nRecord {i} (Publication year: {pub_year}):")
         for year, context in matches:
             print(f"  Mentioned year {year}: ...{context}...")
@@ -1,30 +1,33 @@
 #!/usr/bin/env python3
-import yaml
+import sys
 from collections import Counter, defaultdict
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+from artifacts import iter_rows
+
 YAML_PATH = "../data/abstract_extractions.yaml"
 
 def load_yaml(path):
     if not Path(path).exists():
         print(f"File not found: {path}")
         return []
-    with open(path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f) or []
+    return iter_rows(path, text=False)   # legacy or normalized layout, one row at a time
 
 def main():
     records = load_yaml(YAML_PATH)
 
-    # Filter only outcome-type records
-    outcome_records = [r for r in records if r.get("kind") == "outcome"]
-    total_outcomes = len(outcome_records)
-
+    total_outcomes = 0
     no_info_count = 0
     informative_count = 0
     per_term_counts = defaultdict(int)
     unique_record_ids = set()
 
-    for r in outcome_records:
+    for r in records:
+        # Only outcome-type records
+        if r.get("kind") != "outcome":
+            continue
+        total_outcomes += 1
         record_id = r.get("record_id")
         if record_id:
             unique_record_ids.add(record_id)
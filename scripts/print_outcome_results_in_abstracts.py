@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
-import yaml
+import sys
 from collections import Counter, defaultdict
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+from artifacts import iter_rows
+
 YAML_PATH = "../data/abstract_extractions.yaml"
 
 def load_yaml(path):
     if not Path(path).exists():
         print(f"File not found: {path}")
         return []
-    with open(path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f) or []
+    return iter_rows(path, text=False)   # legacy or normalized layout, one row at a time
 
 def is_informative(rec):
     # Only consider records with kind == "outcome"
@@ -28,15 +30,14 @@ def is_informative(rec):
 def main():
     records = load_yaml(YAML_PATH)
 
-    outcome_records = [r for r in records if is_informative(r)]
+    # Group informative records by term, keeping only what is printed
+    grouped = defaultdict(list)
+    for r in records:
+        if is_informative(r):
+            grouped[r["term"]].append({"record_id": r["record_id"], "response": r["response"]})
 
     # Count occurrences of each outcome term
-    term_counter = Counter(r["term"] for r in outcome_records)
-
-    # Group records by term
-    grouped = defaultdict(list)
-    for r in outcome_records:
-        grouped[r["term"]].append(r)
+    term_counter = Counter({term: len(recs) for term, recs in grouped.items()})
 
     # Sort terms by frequency (descending)
     sorted_terms = sorted(term_counter.items(), key=lambda x: -x[1])
@@ -49,13 +50,12 @@ def main():
         print("-" * 80)
 
         for rec in grouped[term]:
-            if(is_informative(rec)):
-                print(f"Record ID: {rec['record_id']}")
-                # print("Abstract:")
-                # print(rec["abstract"].strip())
-                print("Response:")
-                print(rec["response"].strip())
-                print("-" * 80)
+            print(f"Record ID: {rec['record_id']}")
+            # print("Abstract:")
+            # print(rec["abstract"].strip())
+            print("Response:")
+            print(rec["response"].strip())
+            print("-" * 80)
 
 if __name__ == "__main__":
     main()
@@ -5,18 +5,46 @@ import pprint
 # Prerequisites
 #   pip install requests pyyaml textwrap3
 
+import argparse
+import collections
+import contextlib
+import hashlib
+import json
+import queue
+import random
+import threading
+import time
 import requests
-import yaml
 import textwrap
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from time import sleep
+from requests.adapters import HTTPAdapter
+
+from journal import Journal, read_journal, compact_yaml
+from rate_limit import TokenBucket, retry_after, backoff_delay
+from store import Store
+
 FILE_WITH_URLS = "all_record_urls.txt"
 OUTPUT_YAML    = "impact_records.yaml"
+JOURNAL        = "impact_records.jsonl"   # append-only crawl log, one record per line
+CHANGES_JSON   = "impact_records_changes.json"   # report of the last --refresh run
+MAX_AGE_DAYS   = 30       # --refresh re-fetches records older than this
+AUDIT_FRACTION = 0.02     # --refresh also re-fetches this share of fresh records
 GRAPHQL_URL    = "https://api.developmentevidence.3ieimpact.org/graphql"
+CONCURRENCY    = 4        # parallel requests in flight
+RATE           = 4.0      # requests per second (token bucket refill rate)
+BURST          = 4        # token bucket capacity
+RETRY_LIMIT    = 5
+REQUEST_TIMEOUT = 30      # seconds per HTTP request
+STALL_TIMEOUT  = RETRY_LIMIT * (REQUEST_TIMEOUT + 60)   # one batch's retries, worst case
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BATCH_SIZE     = 10       # starting number of records per GraphQL request
+MAX_BATCH_SIZE = 50
+TARGET_LATENCY = 5.0      # seconds; slower batches shrink the batch size
+MAX_BATCH_BYTES = 2_000_000   # larger responses shrink the batch size
 
-QUERY = textwrap.dedent("""
-    query recordDetail($id: Int!) {
-      recordDetail(id: $id) {
+FULL_FIELDS = textwrap.dedent("""
       product_type
       title
       synopsis
@@ -145,55 +173,479 @@ QUERY = textwrap.dedent("""
       ethics_approval
       interventions
       outcome
+""").strip()
+
+ANALYSIS_FIELDS = textwrap.dedent("""
+      id
+      title
+      abstract
+      year_of_publication
+      interventions
+      outcome
+      synopsis
+      short_title
+      language
+      sector_name
+      sub_sector
+      journal
+      publication_type
+      doi
+      keywords
+      context
+      main_finding
+      headline_findings
+      evaluation_design
+      evaluation_method
+      quantitative_method
+      qualitative_method
+      equity_focus
+      equity_dimension
+      region
+      un_sustainable_development_goal
+      continent {
+        continent
+        countries {
+          country
+          income_level
+          fcv_status
+        }
       }
-    }
 """).strip()
 
+# Only what stages 2–5 and scripts/ actually read.
+MINIMAL_FIELDS = textwrap.dedent("""
+      id
+      title
+      abstract
+      year_of_publication
+      interventions
+      outcome
+""").strip()
+
+# Ordered from narrowest to widest: a record fetched with a wider profile
+# also satisfies a narrower one.
+PROFILES = {
+    "pipeline-minimal": MINIMAL_FIELDS,
+    "analysis":         ANALYSIS_FIELDS,
+    "full":             FULL_FIELDS,
+}
+DEFAULT_PROFILE = "full"
+
+
+def build_query(profile: str = DEFAULT_PROFILE) -> str:
+    fields = textwrap.indent(PROFILES[profile], "    ")
+    return (
+        "query recordDetail($id: Int!) {\n"
+        "  recordDetail(id: $id) {\n"
+        f"{fields}\n"
+        "  }\n"
+        "}"
+    )
+
+
+def covers(have: str, want: str) -> bool:
+    """True if a record fetched with profile ``have`` has every field of ``want``."""
+    order = list(PROFILES)
+    return order.index(have) >= order.index(want)
+
+
+def wider(a: str, b: str) -> str:
+    """The profile of ``a`` and ``b`` that covers the other."""
+    return a if covers(a, b) else b
+
+
+QUERY = build_query()
+
+
 def extract_id(path: str) -> int:
     """Return the integer after the last slash of the path line."""
     return int(path.rstrip().split("/")[-1])
-    
-def fetch_record(rid: int) -> dict | None:
+
+
+def make_session(pool_size: int) -> requests.Session:
+    """One keep-alive connection pool shared by every worker thread."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def build_batch_query(ids: list[int], profile: str = DEFAULT_PROFILE) -> str:
+    """One operation selecting ``recordDetail`` once per ID under the alias ``r<id>``."""
+    fields = textwrap.indent(PROFILES[profile], "    ")
+    parts  = [f"  r{rid}: recordDetail(id: {int(rid)}) {{\n{fields}\n  }}" for rid in ids]
+    return "query recordBatch {\n" + "\n".join(parts) + "\n}"
+
+
+class AdaptiveBatchSize:
+    """Additive-increase / multiplicative-decrease batch size.
+
+    A batch that came back full, fast and small grows the next one by one
+    record; a failed, slow or oversized batch halves it.
+    """
+
+    def __init__(self, start: int = BATCH_SIZE, maximum: int = MAX_BATCH_SIZE,
+                 target_latency: float = TARGET_LATENCY,
+                 max_bytes: int = MAX_BATCH_BYTES):
+        self.size = max(1, min(start, maximum))
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def current(self) -> int:
+        with self.lock:
+            return self.size
+
+    def update(self, n: int, latency: float, nbytes: int, ok: bool) -> None:
+        with self.lock:
+            if not ok or latency > self.target_latency or nbytes > self.max_bytes:
+                self.size = max(1, self.size // 2)
+            elif n >= self.size:
+                self.size = min(self.maximum, self.size + 1)
+
+
+def post_graphql(session: requests.Session, bucket: TokenBucket,
+                 payload: dict) -> tuple[dict, int]:
+    """POST a GraphQL payload, backing off on 429/5xx and honouring Retry-After.
+
+    Returns the decoded response and its size in bytes.
+    """
+    for attempt in range(1, RETRY_LIMIT + 1):
+        bucket.acquire()
+        try:
+            r = session.post(GRAPHQL_URL, json=payload, timeout=REQUEST_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            if attempt == RETRY_LIMIT:
+                raise
+            delay = backoff_delay(attempt)
+            print(f"… network error ({exc}); retrying in {delay:.1f}s")
+            sleep(delay)
+            continue
+
+        if r.status_code in RETRY_STATUSES and attempt < RETRY_LIMIT:
+            delay = retry_after(r.headers.get("Retry-After"))
+            if delay is None:
+                delay = backoff_delay(attempt)
+            if r.status_code == 429:
+                bucket.pause(delay)     # slow down every worker, not just this one
+            print(f"… HTTP {r.status_code}; retrying in {delay:.1f}s")
+            sleep(delay)
+            continue
+
+        r.raise_for_status()
+        return r.json(), len(r.content)
+    raise RuntimeError("unreachable")
+
+
+def fetch_record(session: requests.Session, bucket: TokenBucket, rid: int,
+                 query: str = QUERY) -> dict | None:
     payload = {
         "operationName": "recordDetail",
         "variables": {"id": rid},
-        "query": QUERY,
+        "query": query,
     }
-    r = requests.post(GRAPHQL_URL, json=payload, timeout=30)
-    r.raise_for_status()
-
-    data = r.json()
+    data, _ = post_graphql(session, bucket, payload)
     if "errors" in data:                # GraphQL rejected the query
         print(f"✗ {rid}  GraphQL error → {data['errors'][0]['message']}")
         return None
     return data["data"]["recordDetail"]
 
-def main() -> None:
-    records = []
 
-    # 1  read each line from the text file
-    for line in Path(FILE_WITH_URLS).read_text(encoding="utf-8").splitlines():
-        sleep(.5)
-        if not line.strip():
-            continue                      # skip blank lines
-        rid = extract_id(line)
-        try:
-            record = fetch_record(rid)
-            records.append(record)
-            print(f"✓ {rid}  {record['title'][:80]}")
-            with open(OUTPUT_YAML, "a", encoding="utf-8") as f:
-                yaml.dump([record], f, allow_unicode=True, sort_keys=False)
-
-            print(f"✓ {rid}  {record['title'][:80]}")
-        except Exception as exc:
-            print(f"✗ {rid}  ({exc})")
-
-        # 2  write everything to YAML
-        Path(OUTPUT_YAML).write_text(
-            yaml.dump(records, allow_unicode=True, sort_keys=False),
-            encoding="utf-8"
-        )
-        print(f"\nSaved {len(records)} records → {OUTPUT_YAML}")
+def fetch_batch(session: requests.Session, bucket: TokenBucket, ids: list[int],
+                profile: str = DEFAULT_PROFILE) -> tuple[dict, dict, int]:
+    """Fetch several records in one request.
+
+    Returns ``(records, errors, nbytes)`` where ``records`` maps ID → record
+    and ``errors`` maps ID → message for aliases the server reported an
+    error for.  Errors that cannot be tied to an alias fail the whole batch.
+    """
+    payload = {"operationName": "recordBatch", "query": build_batch_query(ids, profile)}
+    data, nbytes = post_graphql(session, bucket, payload)
+    aliases = {f"r{rid}": rid for rid in ids}
+
+    errors = {}
+    for err in data.get("errors") or []:
+        path = err.get("path") or []
+        if not path or path[0] not in aliases:
+            raise RuntimeError(f"GraphQL error → {err.get('message')}")
+        errors.setdefault(aliases[path[0]], err.get("message"))
+
+    body = data.get("data") or {}
+    records = {rid: body.get(alias) for alias, rid in aliases.items()
+               if rid not in errors}
+    return records, errors, nbytes
+
+
+def crawl(session: requests.Session, bucket: TokenBucket, ids: list[int],
+          profile: str, concurrency: int, sizer: AdaptiveBatchSize,
+          stall_timeout: float = STALL_TIMEOUT, poll: float = 1.0):
+    """Yield ``(rid, record | None, exc | None)`` once for every ID.
+
+    Workers take batches of ``sizer.current()`` IDs.  A batch that fails as
+    a whole is split in half and retried, so one bad ID ends up failing on
+    its own without taking its neighbours with it.  If the caller stops
+    early (Ctrl-C, an exception, ``close()``), the workers take no further
+    batches and the generator returns without waiting for them.
+
+    If every worker has exited, or none has taken a batch or returned a
+    result for ``stall_timeout`` seconds, the IDs still outstanding are
+    yielded as failed instead of waiting for them forever.
+    """
+    lock    = threading.Lock()
+    stop    = threading.Event()
+    active  = [time.monotonic()]        # last time a worker took a batch or returned a result
+    ids     = list(dict.fromkeys(ids))
+    pending = collections.deque(ids)
+    retry   = collections.deque()       # halves of batches that failed as a whole
+    results = queue.Queue()
+    query   = build_query(profile)
+
+    def next_batch():
+        with lock:
+            if stop.is_set():
+                return []
+            active[0] = time.monotonic()
+            if retry:
+                return retry.popleft()
+            n = min(sizer.current(), len(pending))
+            return [pending.popleft() for _ in range(n)]
+
+    def worker():
+        while batch := next_batch():
+            started = time.monotonic()
+            try:
+                if len(batch) == 1:
+                    rid = batch[0]
+                    results.put((rid, fetch_record(session, bucket, rid, query), None))
+                    continue
+                records, errors, nbytes = fetch_batch(session, bucket, batch, profile)
+            except Exception as exc:
+                sizer.update(len(batch), time.monotonic() - started, 0, ok=False)
+                if len(batch) == 1:
+                    results.put((batch[0], None, exc))
+                else:
+                    mid = len(batch) // 2
+                    with lock:
+                        retry.extend([batch[:mid], batch[mid:]])
+                continue
+            sizer.update(len(batch), time.monotonic() - started, nbytes, ok=True)
+            for rid in batch:
+                if rid in errors:
+                    results.put((rid, None, RuntimeError(f"GraphQL error → {errors[rid]}")))
+                else:
+                    results.put((rid, records.get(rid), None))
+
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        workers = [pool.submit(worker) for _ in range(concurrency)]
+        missing = set(ids)
+        while missing:
+            try:
+                item = results.get(timeout=poll)
+            except queue.Empty:
+                if all(w.done() for w in workers):
+                    if not results.empty():
+                        continue            # put just before the last worker exited
+                    died = [w.exception() for w in workers if w.exception()]
+                    lost = died[0] if died else RuntimeError("no worker returned a result")
+                elif time.monotonic() - active[0] > stall_timeout:
+                    lost = TimeoutError(f"no progress for {stall_timeout:.0f}s")
+                else:
+                    continue
+                for rid in ids:
+                    if rid in missing:
+                        missing.discard(rid)
+                        yield rid, None, lost
+                break
+            active[0] = time.monotonic()
+            missing.discard(item[0])
+            yield item
+    finally:
+        stop.set()
+        # only the batches already in flight finish; their results are dropped
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def read_ids(path: str) -> list[int]:
+    return [extract_id(line)
+            for line in Path(path).read_text(encoding="utf-8").splitlines()
+            if line.strip()]         # skip blank lines
+
+
+def content_hash(record: dict) -> str:
+    """Stable hash of a record's content (key order does not matter)."""
+    blob = json.dumps(record, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def profile_of(entry: dict) -> str:
+    return entry.get("profile", "full")      # entries predating profiles used the full query
+
+
+def fetch_profiles(pending: list[int], done: dict, profile: str) -> dict:
+    """{query profile: IDs to fetch with it}, narrowest profile first.
+
+    A record already fetched with a wider profile is re-fetched with that
+    one, so a refresh with a narrower ``profile`` does not strip its fields.
+    """
+    groups = {}
+    for rid in pending:
+        want = wider(profile_of(done[rid]), profile) if rid in done else profile
+        groups.setdefault(want, []).append(rid)
+    return {p: groups[p] for p in PROFILES if p in groups}
+
+
+def crawl_profiles(session: requests.Session, bucket: TokenBucket, groups: dict,
+                   concurrency: int, sizer: AdaptiveBatchSize):
+    """``crawl()`` each group of ``fetch_profiles()``; yields ``(profile, rid, record, exc)``."""
+    for profile, ids in groups.items():
+        with contextlib.closing(crawl(session, bucket, ids, profile, concurrency, sizer)) as results:
+            for rid, record, exc in results:
+                yield profile, rid, record, exc
+
+
+def compact(ids: list[int], journal: dict) -> list[dict]:
+    """Records from the journal, in the order of the URL file."""
+    listed = set(ids)
+    order  = [rid for rid in ids if rid in journal]
+    order += [rid for rid in journal if rid not in listed]
+    return [{**journal[rid]["record"], "query_profile": profile_of(journal[rid])}
+            for rid in order]
+
+
+def previous_hash(old: dict, record: dict, profile: str) -> tuple[str, str]:
+    """Hashes of the old and new record over the fields both profiles share."""
+    if profile_of(old) == profile:
+        return old.get("hash") or content_hash(old["record"]), content_hash(record)
+    shared = old["record"].keys() & record.keys()
+    return (content_hash({k: old["record"][k] for k in shared}),
+            content_hash({k: record[k] for k in shared}))
+
+
+def select_for_refresh(ids: list[int], done: dict, max_age_days: float,
+                       audit_fraction: float, rng: random.Random,
+                       profile: str = DEFAULT_PROFILE) -> list[int]:
+    """New IDs, IDs fetched more than ``max_age_days`` ago, and an audit sample.
+
+    Records fetched with a narrower profile than ``profile`` count as new.
+    """
+    cutoff = time.time() - max_age_days * 86400
+    done   = {rid: e for rid, e in done.items() if covers(profile_of(e), profile)}
+    new    = [rid for rid in ids if rid not in done]
+    stale  = [rid for rid in ids if rid in done and done[rid]["fetched_at"] < cutoff]
+    fresh  = [rid for rid in ids if rid in done and done[rid]["fetched_at"] >= cutoff]
+    audit  = rng.sample(fresh, round(len(fresh) * audit_fraction)) if fresh else []
+    print(f"Refresh: {len(new)} new, {len(stale)} older than {max_age_days:g} days, "
+          f"{len(audit)} audit sample")
+    chosen = set(new) | set(stale) | set(audit)
+    return [rid for rid in ids if rid in chosen]
+
+
+def write_changes(path: str, new: list[int], changed: list[int],
+                  unchanged: list[int], failed: list[int]) -> None:
+    report = {
+        "refreshed_at": time.time(),
+        "new":          new,
+        "changed":      changed,
+        "unchanged":    unchanged,
+        "failed":       failed,
+    }
+    Path(path).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+
+def main(concurrency: int = CONCURRENCY, rate: float = RATE, burst: int = BURST,
+         refresh: bool = False, max_age_days: float = MAX_AGE_DAYS,
+         audit_fraction: float = AUDIT_FRACTION, seed: int | None = None,
+         profile: str = DEFAULT_PROFILE, batch_size: int = BATCH_SIZE,
+         max_batch_size: int = MAX_BATCH_SIZE, db: str | None = None) -> None:
+    ids     = read_ids(FILE_WITH_URLS)
+    done    = read_journal(JOURNAL, key=lambda e: e["id"])
+    if refresh:
+        pending = select_for_refresh(ids, done, max_age_days, audit_fraction,
+                                     random.Random(seed), profile)
+    else:
+        pending = [rid for rid in ids
+                   if rid not in done or not covers(profile_of(done[rid]), profile)]
+    print(f"{len(done)} records already in {JOURNAL}; {len(pending)} to fetch "
+          f"with the '{profile}' profile")
+
+    session = make_session(concurrency)
+    bucket  = TokenBucket(rate, burst)
+    sizer   = AdaptiveBatchSize(batch_size, max_batch_size)
+    new, changed, unchanged, failed = [], [], [], []
+
+    # 1  fetch the selected records in concurrent batches and journal each one
+    with Journal(JOURNAL) as journal:
+        groups = fetch_profiles(pending, done, profile)
+        for fetched_with, rid, record, exc in crawl_profiles(session, bucket, groups,
+                                                             concurrency, sizer):
+            if exc is not None:
+                print(f"✗ {rid}  ({exc})")
+                failed.append(rid)
+                continue
+            if record is None:
+                print(f"✗ {rid}  (not returned by the API)")
+                failed.append(rid)
+                continue
+            digest = content_hash(record)
+            old    = done.get(rid)
+            if old is None:
+                new.append(rid)
+            elif len(set(previous_hash(old, record, fetched_with))) > 1:
+                changed.append(rid)
+            else:
+                unchanged.append(rid)
+            entry = {"id": rid, "fetched_at": time.time(), "hash": digest,
+                     "profile": fetched_with, "record": record}
+            journal.append(entry)
+            done[rid] = entry
+            print(f"✓ {rid}  {(record.get('title') or '')[:80]}")
+
+    # 2  compact the journal into the YAML artifact in one write
+    records = compact(ids, done)
+    compact_yaml(OUTPUT_YAML, records)
+    print(f"\nSaved {len(records)} records → {OUTPUT_YAML}")
+    if db:
+        store = Store(db)
+        store.replace_records(records)
+        store.close()
+        print(f"Saved {len(records)} records → {db}")
+
+    if refresh:
+        write_changes(CHANGES_JSON, new, changed, unchanged, failed)
+        print(f"{len(new)} new, {len(changed)} changed, {len(unchanged)} unchanged, "
+              f"{len(failed)} failed → {CHANGES_JSON}")
+        for rid in changed:
+            print(f"  changed: {rid}  {(done[rid]['record'].get('title') or '')[:70]}")
+
 
 if __name__ == "__main__":
-    main()
+    p = argparse.ArgumentParser(description="Download 3ie records to YAML")
+    p.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                   help="maximum number of requests in flight")
+    p.add_argument("--rate", type=float, default=RATE,
+                   help="maximum requests per second")
+    p.add_argument("--burst", type=int, default=BURST,
+                   help="token bucket capacity (short bursts above --rate)")
+    p.add_argument("--profile", choices=list(PROFILES), default=DEFAULT_PROFILE,
+                   help="which fields to request (pipeline-minimal is enough for stages 2–5)")
+    p.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                   help="records per GraphQL request to start with (1 disables batching)")
+    p.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE,
+                   help="upper bound for the adaptive batch size")
+    p.add_argument("--refresh", action="store_true",
+                   help="re-fetch new, stale and audit-sampled records and report changes")
+    p.add_argument("--max-age", type=float, default=MAX_AGE_DAYS,
+                   help="with --refresh: re-fetch records fetched more than this many days ago")
+    p.add_argument("--audit", type=float, default=AUDIT_FRACTION,
+                   help="with --refresh: fraction of fresh records to re-fetch anyway")
+    p.add_argument("--seed", type=int, default=None,
+                   help="seed for the audit sample")
+    p.add_argument("--db", metavar="PATH", default=None,
+                   help="also write the records to this SQLite store for stages 2–5")
+    args = p.parse_args()
+    main(args.concurrency, args.rate, args.burst,
+         args.refresh, args.max_age, args.audit, args.seed, args.profile,
+         args.batch_size, args.max_batch_size, args.db)
@@ -3,25 +3,46 @@
 Incrementally extracts what each abstract says about every outcome and interventions
 term in impact_records.yaml.  Results are stored (and re-loaded) in
 abstract_extractions.yaml so the script can resume after an interruption.
+New answers are group-committed to abstract_extractions.jsonl while the
+script runs and folded into the YAML file once at the end; an interrupted
+run's journal is replayed on the next start (or compact it by hand with
+`python journal.py abstract_extractions.yaml`).
 
-Each record in the output YAML has:
-  record_id   – “R00001”, “R00002”, …
+Each row (as returned by `artifacts.read_rows()`) has:
+  record_id   – “3ie-28503”, … (stable, from the source ID; see record_ids.py)
   kind        – “outcome” or “interventions”
   term        – the term being queried
   query       – full prompt sent to GPT-4o-mini
   abstract    – the abstract text
   response    – GPT-4o-mini’s full answer
+
+On disk the file uses the normalized layout from artifacts.py: each
+abstract is stored once per record and each query as a prompt template ID
+plus its parameters.  Give YAML_OUTPUT a `.zst` suffix to compress it.
+
+With --combined, each record's intervention and outcome terms are asked
+for in a single JSON call (query then holds that shared prompt); terms
+missing from the JSON answer are re-asked one at a time.
 """
-import os, time, yaml
+import argparse, json
+from functools import partial
 from pathlib import Path
-from openai import OpenAI
-import pprint
+
+from artifacts import iter_rows, read_templates, render, template_id, write_rows
+from journal import JournaledYaml
+from llm_cache import LLMCache
+from llm_runner import Job, LLMRunner
+from record_ids import check_stable, record_id
+from shards import in_shard, open_output, parse_shard, shard_path
+from store import Store
+import yaml_cache
 # ────────────── CONFIG ──────────────
 MODEL          = "gpt-4.1-mini" #"gpt-4.1-2025-04-14"
 YAML_INPUT     = "impact_records.yaml"
 YAML_OUTPUT    = "abstract_extractions.yaml"
-WAIT_TIME      = 1          # seconds between calls / retries
-RETRY_LIMIT    = 3
+MAX_CONCURRENCY = 8        # parallel requests (halves on 429s / timeouts)
+FLUSH_EVERY    = 50        # journal rows written per group commit …
+FLUSH_INTERVAL = 5.0       # … or after this many seconds, whichever is first
 
 QUESTION_TMPL_INTERVENTION = (
     "What is the intervention that is described in the abstract? "
@@ -42,68 +63,48 @@ SYSTEM_MSG = (
     "You are analysing paper abstracts. "
     "Return only the answer text (no numbering, no extra commentary)."
 )
-# ─────────────────────────────────────
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# --combined: the intervention and every outcome term of a record in one call
+QUESTION_TMPL_COMBINED = (
+    "Answer the questions below about the abstract and reply with a JSON object "
+    "with exactly two keys, \"intervention\" and \"outcomes\".\n\n"
+    "\"intervention\": a string answering: " + QUESTION_TMPL_INTERVENTION + "\n\n"
+    "\"outcomes\": an object with one entry per outcome term listed below, keyed by the term "
+    "exactly as written. Each value is a string saying what the abstract says regarding that outcome. "
+    "Be sure to include relevant quantitative or categorical information where present. "
+    "If nothing is said about an outcome write: No Information.\n\n"
+    "Outcome terms:\n{term_list}"
+)
 
-# ---------- helpers ----------
-def load_yaml(path: str, default):
-    if Path(path).exists():
-        with open(path, "r", encoding="utf-8") as f:
-            return yaml.safe_load(f) or default
-    return default
-
-def save_yaml(path: str, data):
-    tmp = Path(path).with_suffix(".tmp")
-    with open(tmp, "w", encoding="utf-8") as f:
-        yaml.safe_dump(data, f, allow_unicode=True, sort_keys=False)
-    tmp.replace(path)
-
-def ask_chatgpt(prompt: str) -> str:
-    for attempt in range(1, RETRY_LIMIT + 1):
-        print("asking...")
-        try:
-            resp = client.chat.completions.create(
-                model=MODEL,
-                messages=[
-                    {"role": "system", "content": SYSTEM_MSG},
-                    {"role": "user",   "content": prompt}
-                ],
-                temperature=0
-            )
-            return resp.choices[0].message.content.strip()
-        except Exception as e:
-            if attempt < RETRY_LIMIT:
-                time.sleep(WAIT_TIME)
-            else:
-                raise RuntimeError(f"OpenAI call failed after {RETRY_LIMIT} attempts: {e}")
+SYSTEM_MSG_COMBINED = (
+    "You are analysing paper abstracts. "
+    "Reply with a single JSON object and nothing else."
+)
+# ─────────────────────────────────────
 
-# ---------- main ----------
-def main():
-    input_records  = load_yaml(YAML_INPUT,  [])
-    output_records = load_yaml(YAML_OUTPUT, [])
+# ---------- helpers ----------
+def output_key(row: dict) -> tuple:
+    return row["record_id"], row["kind"], row["term"]
 
-    processed_keys = {
-        (r["record_id"], r["kind"], r["term"]) for r in output_records
-    }
+def load_changed_ids(path: str) -> set:
+    """3ie IDs that were new or changed in the last `1_make_database.py --refresh`."""
+    report = json.loads(Path(path).read_text(encoding="utf-8"))
+    return set(report["new"]) | set(report["changed"])
 
-    count = 0
+def iter_records(input_records, changed=None):
+    """Yield (rec_id, abstract, outcomes, intervention_list) for usable records."""
     for idx, rec in enumerate(input_records, start=1):
         if not isinstance(rec, dict):
             print(f"Skipping invalid record at idx={idx}: {rec}")
             continue
 
-        print("idx")
-        print(idx)
-
-        count += 1
-        # if count >= 10:
-        #     break
+        if changed is not None and rec.get("id") not in changed:
+            continue
 
-        rec_id   = f"R{idx:05}"
+        rec_id   = record_id(rec)
         abstract = rec.get("abstract")
         if not isinstance(abstract, str):
-            print(f"Missing or invalid abstract for record {rec.get('record_id', idx)}")
+            print(f"Missing or invalid abstract for record {rec_id}")
             continue
         abstract = abstract.strip()
 
@@ -111,81 +112,227 @@ def main():
         outcomes      = rec.get("outcome", []) or []
         interventions   = rec.get("interventions", []) or []
         intervention_list = ", ".join(interventions)
-        # Now handle interventions (one prompt total)
-        
-
-        for kind, terms in (("outcome", outcomes), ("intervention", [intervention_list])):
-            if kind == "intervention":
-                term = "intervention"
-                key = (rec_id, kind, term)
-
-                if key in processed_keys:
-                    continue  # already done in a previous run
-
-                prompt = (
-                    f"{QUESTION_TMPL_INTERVENTION.format(intervention_list=intervention_list)}\n\n"
-                    f"Abstract:\n\"\"\"\n{abstract}\n\"\"\""
-                )
-                print("")
-                print("")
-                print(f"{rec_id} – {kind} – '{term}'")
-                print("")
-
-                # print(prompt)
-                # pprint.pprint(prompt)
-                try:
-                    answer = ask_chatgpt(prompt)
-                except RuntimeError as err:
-                    print(f"{rec_id} – {kind} – '{term}': {err}")
-                    continue
-                # answer = "DUMMY DELETEME"
-                output_records.append({
-                    "record_id": rec_id,
-                    "kind":      kind,
-                    "term":      term,
-                    "query":     prompt,
-                    "abstract":  abstract,
-                    "response":  answer,
-                })
-                processed_keys.add(key)
-                save_yaml(YAML_OUTPUT, output_records)
-                time.sleep(WAIT_TIME)
-            else:
-                for term in terms:
-                    key = (rec_id, kind, term)
-
-
-                    if key in processed_keys:
-                        continue  # already done in a previous run
-
-                    prompt = (
-                        f"{QUESTION_TMPL_OUTCOME.format(term=term)}\n\n"
-                        f"Abstract:\n\"\"\"\n{abstract}\n\"\"\""
-                    )
-
-                    print("")
-                    print("")
-                    print(f"{rec_id} – {kind} – '{term}'")
-                    print("")
-                    # print(prompt)
-                    # pprint.pprint(prompt)
-                    try:
-                        answer = ask_chatgpt(prompt)
-                    except RuntimeError as err:
-                        print(f"{rec_id} – {kind} – '{term}': {err}")
-                        continue
-                    # answer = "DUMMY DELETEME"
-                    output_records.append({
-                        "record_id": rec_id,
-                        "kind":      kind,
-                        "term":      term,
-                        "query":     prompt,
-                        "abstract":  abstract,
-                        "response":  answer,
-                    })
-                    processed_keys.add(key)
-                    save_yaml(YAML_OUTPUT, output_records)
-                    time.sleep(WAIT_TIME)
+        yield rec_id, abstract, outcomes, intervention_list
+
+def with_abstract(question: str, abstract: str) -> str:
+    return f"{question}\n\nAbstract:\n\"\"\"\n{abstract}\n\"\"\""
+
+def prompt_templates() -> dict:
+    """{name: (template_id, template)}; rows store the ID plus their params."""
+    templates = {}
+    for name, question in (("outcome",      QUESTION_TMPL_OUTCOME),
+                           ("intervention", QUESTION_TMPL_INTERVENTION),
+                           ("combined",     QUESTION_TMPL_COMBINED)):
+        text = with_abstract(question, "{abstract}")
+        templates[name] = (template_id(name, text), text)
+    return templates
+
+TEMPLATES = prompt_templates()
+
+def templated_job(name, params, meta) -> Job:
+    tid, text = TEMPLATES[name]
+    prompt = render(text, meta["abstract"], params)
+    return Job(prompt, {**meta, "template": tid, "params": params})
+
+def outcome_job(rec_id, term, abstract) -> Job:
+    return templated_job("outcome", {"term": term},
+                         {"record_id": rec_id, "kind": "outcome",
+                          "term": term, "abstract": abstract})
+
+def intervention_job(rec_id, intervention_list, abstract) -> Job:
+    return templated_job("intervention", {"intervention_list": intervention_list},
+                         {"record_id": rec_id, "kind": "intervention",
+                          "term": "intervention", "abstract": abstract})
+
+def pending_outcomes(rec_id, outcomes, processed_keys):
+    """Outcome terms not answered or queued yet; marks them as queued.
+
+    Keys are added to ``processed_keys`` as they are queued so duplicate
+    terms within a record are only asked once per run.
+    """
+    terms = []
+    for term in outcomes:
+        key = (rec_id, "outcome", term)
+        if key in processed_keys:
+            continue  # already done in a previous run
+        processed_keys.add(key)
+        terms.append(term)
+    return terms
+
+def pending_intervention(rec_id, processed_keys) -> bool:
+    key = (rec_id, "intervention", "intervention")
+    if key in processed_keys:
+        return False
+    processed_keys.add(key)
+    return True
+
+def iter_jobs(input_records, processed_keys, changed=None):
+    """One Job per (record, kind, term) that has not been answered or queued yet."""
+    for rec_id, abstract, outcomes, intervention_list in iter_records(input_records, changed):
+        # outcomes first (one prompt per term), then the intervention (one prompt total)
+        for term in pending_outcomes(rec_id, outcomes, processed_keys):
+            yield outcome_job(rec_id, term, abstract)
+        if pending_intervention(rec_id, processed_keys):
+            yield intervention_job(rec_id, intervention_list, abstract)
+
+def iter_combined_jobs(input_records, processed_keys, plain, changed=None):
+    """One JSON Job per record covering its intervention and all pending outcome terms.
+
+    Records with only the intervention left get the plain intervention
+    prompt, which is appended to ``plain`` instead of being yielded.
+    """
+    for rec_id, abstract, outcomes, intervention_list in iter_records(input_records, changed):
+        terms = pending_outcomes(rec_id, outcomes, processed_keys)
+        intervention = pending_intervention(rec_id, processed_keys)
+        if not terms:
+            if intervention:
+                plain.append(intervention_job(rec_id, intervention_list, abstract))
+            continue
+        params = {
+            "intervention_list": intervention_list,
+            "term_list": "\n".join(f"- {t}" for t in terms),
+        }
+        yield templated_job("combined", params,
+                            {"record_id": rec_id, "kind": "combined", "terms": terms,
+                             "intervention": intervention,
+                             "intervention_list": intervention_list, "abstract": abstract})
+
+def split_combined(result):
+    """Turn a combined JSON answer into per-term rows plus fallback Jobs.
+
+    Every requested term must come back as a non-empty string; anything
+    missing, malformed or unparsable is re-asked with the per-term prompt.
+    """
+    meta  = result.job.meta
+    rec_id, abstract = meta["record_id"], meta["abstract"]
+    answer = {}
+    if result.error is None:
+        try:
+            answer = json.loads(result.text)
+        except json.JSONDecodeError:
+            print(f"{rec_id} – combined answer is not valid JSON; falling back to per-term calls")
+        if not isinstance(answer, dict):
+            answer = {}
+    outcomes = answer.get("outcomes")
+    if not isinstance(outcomes, dict):
+        outcomes = {}
+
+    rows, fallback = [], []
+    for term in meta["terms"]:
+        text = outcomes.get(term)
+        if isinstance(text, str) and text.strip():
+            rows.append(("outcome", term, text.strip()))
+        else:
+            fallback.append(outcome_job(rec_id, term, abstract))
+    if meta["intervention"]:
+        text = answer.get("intervention")
+        if isinstance(text, str) and text.strip():
+            rows.append(("intervention", "intervention", text.strip()))
+        else:
+            fallback.append(intervention_job(rec_id, meta["intervention_list"], abstract))
+    return rows, fallback
+
+# ---------- main ----------
+def main(changed_path: str | None = None, combined: bool = False, db: str | None = None,
+         shard: tuple | None = None):
+    # input_records() starts a fresh streaming pass over the crawler output
+    if db:
+        store = Store(db)
+        store.put_templates(dict(TEMPLATES.values()))
+        input_records = store.records
+        outputs = store.table("extractions", FLUSH_EVERY)
+    else:
+        input_records = partial(yaml_cache.iter_list, YAML_INPUT)
+        # earlier answers, in either layout; templates they reference are kept
+        templates = {**read_templates(YAML_OUTPUT), **read_templates(shard_path(YAML_OUTPUT, shard)),
+                     **dict(TEMPLATES.values())}
+        outputs = open_output(YAML_OUTPUT, shard, output_key, lambda path: JournaledYaml(
+            path, output_key, load=iter_rows,
+            dump=lambda out, rows: write_rows(out, rows, templates),
+            flush_every=FLUSH_EVERY, flush_interval=FLUSH_INTERVAL))
+    if shard is not None:
+        all_records = input_records
+        input_records = lambda: (rec for rec in all_records()
+                                 if isinstance(rec, dict) and in_shard(record_id(rec), shard))
+
+    check_stable(outputs.keys(), db or YAML_OUTPUT)
+
+    changed = None
+    if changed_path and shard is not None and not db:
+        raise SystemExit("--changed rewrites the whole output; run it without --shard")
+    if changed_path:
+        changed = load_changed_ids(changed_path)
+        stale = {
+            record_id(rec) for rec in input_records()
+            if isinstance(rec, dict) and rec.get("id") in changed
+        }
+        # drop earlier answers for records whose source changed so they are redone
+        outputs.replace_all(r for r in outputs.values() if r["record_id"] not in stale)
+        print(f"Re-extracting {len(stale)} new/changed records from {changed_path}")
+
+    processed_keys = set(outputs.keys())
+
+    cache  = LLMCache()
+    runner = LLMRunner(MODEL, SYSTEM_MSG, max_concurrency=MAX_CONCURRENCY, cache=cache)
+
+    def save(rec_id, kind, term, job, response):
+        outputs.append({
+            "record_id": rec_id,
+            "kind":      kind,
+            "term":      term,
+            "template":  job.meta["template"],
+            "params":    job.meta["params"],
+            "query":     job.prompt,
+            "abstract":  job.meta["abstract"],
+            "response":  response,
+        })
+
+    def save_results(results):
+        for result in results:
+            meta = result.job.meta
+            rec_id, kind, term = meta["record_id"], meta["kind"], meta["term"]
+            print(f"{rec_id} – {kind} – '{term}'")
+            if result.error is not None:
+                print(f"{rec_id} – {kind} – '{term}': {result.error}")
+                continue
+            save(rec_id, kind, term, result.job, result.text)
+
+    with outputs:
+        if not combined:
+            save_results(runner.run(iter_jobs(input_records(), processed_keys, changed)))
+        else:
+            json_runner = LLMRunner(MODEL, SYSTEM_MSG_COMBINED,
+                                    response_format={"type": "json_object"},
+                                    max_concurrency=MAX_CONCURRENCY, cache=cache)
+            fallback = []
+            for result in json_runner.run(
+                    iter_combined_jobs(input_records(), processed_keys, fallback, changed)):
+                meta = result.job.meta
+                rows, missing = split_combined(result)
+                print(f"{meta['record_id']} – {len(rows)} answers in one call, "
+                      f"{len(missing)} to re-ask per term")
+                for kind, term, text in rows:
+                    save(meta["record_id"], kind, term, result.job, text)
+                fallback.extend(missing)
+            if fallback:
+                print(f"Asking {len(fallback)} remaining terms one at a time")
+                save_results(runner.run(fallback))
+
+    cache.report()
 
 if __name__ == "__main__":
-    main()
+    p = argparse.ArgumentParser(description="Extract outcome and intervention text from abstracts")
+    p.add_argument("--changed", metavar="CHANGES_JSON", default=None,
+                   help="only (re-)extract records listed as new/changed in this "
+                        "report from 1_make_database.py --refresh")
+    p.add_argument("--combined", action="store_true",
+                   help="ask for the intervention and all outcome terms of a record in one "
+                        "JSON call, falling back to per-term calls for missing terms")
+    p.add_argument("--db", metavar="PATH", default=None,
+                   help="read records from and write extractions to this SQLite store "
+                        "instead of the YAML files")
+    p.add_argument("--shard", metavar="I/N", default=None,
+                   help="only extract records in slice I of N, writing a separate output shard "
+                        "(merge with `python shards.py merge`)")
+    args = p.parse_args()
+    main(args.changed, args.combined, args.db, parse_shard(args.shard))
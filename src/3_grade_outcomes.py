@@ -1,28 +1,45 @@
 #!/usr/bin/env python3
 """
-Grades each informative outcome in the first 100 records of
-abstract_extractions_copy.yaml using GPT‑4o‑mini, according to the
-five‑point grading scheme provided by the user.
+Grades every informative outcome in abstract_extractions_copy.yaml
+(or the --db store) with MODEL, according to the five‑point grading
+scheme provided by the user, in file order.
 
 Output is saved to abstract_outcome_grades.yaml with entries like:
-  - record_id: R00001
+  - record_id: 3ie-28503
     term: Forest coverage
     grade: Significant
 
+The model answers with a schema-constrained JSON object whose grade is an
+enum (see structured.py); a malformed answer is re-asked once and never
+saved, so a later run retries it.
+
 The script can be re‑run safely; completed (record_id, term) pairs will
-be skipped.
+be skipped.  Grades are group-committed to abstract_outcome_grades.jsonl
+as they arrive and folded into the YAML file at the end of the run.
 """
-import os, time, yaml
-from pathlib import Path
-from openai import OpenAI
+import argparse
+
+from artifacts import iter_rows
+from batch_api import LocalBatchBackend, OpenAIBatchBackend, run_batch, POLL_INTERVAL
+from journal import JournaledYaml
+from llm_cache import LLMCache
+from llm_runner import Job, LLMRunner
+from multi_outcome import answers_all, chunk_size, chunked, group_by_record, run_multi
+from record_ids import check_stable
+from shards import in_shard, open_output, parse_shard
+from store import Store
+from structured import (GRADES, accepts, array, normalize, obj, parse, parse_items,
+                        response_format, run_validated, string)
 
 # ────────────── CONFIG ──────────────
 # MODEL          = "gpt-4o-mini"
 MODEL          = "gpt-4.1-mini" #"gpt-4.1-2025-04-14"
 YAML_INPUT     = "abstract_extractions_copy.yaml"
 YAML_OUTPUT    = "abstract_outcome_grades.yaml"
-WAIT_TIME      = 1     # seconds between calls / retries
-RETRY_LIMIT    = 3
+MAX_CONCURRENCY = 8   # parallel requests (halves on 429s / timeouts)
+BATCH_DIR      = "batch_grades"   # --batch input/output and in-flight batch state
+FLUSH_EVERY    = 50    # journal rows written per group commit …
+FLUSH_INTERVAL = 5.0   # … or after this many seconds, whichever is first
 
 GRADING_SCHEME = (
     "1. Very significant\n"
@@ -40,7 +57,7 @@ GRADING_SCHEME = (
 
 SYSTEM_MSG = (
     "You are a careful research assistant.\n"
-    "Only reply with exactly one of the following grades (no extra text):\n"
+    "Reply with a single JSON object {\"grade\": \"<grade>\"} and nothing else, where the grade is exactly one of:\n"
     "Very significant | Significant | Neutral/mixed results | No effect | Outcome was worsened | No information"
 )
 
@@ -51,23 +68,46 @@ PROMPT_TMPL = (
     "Specific outcome of the intervention to evaluate:\n{outcome_name}\n\n"
     "Impact evaluation:\n{outcome}\n\n"
     "Assign the appropriate grade for the degree to which the outcome \"{outcome_name}\" was acheived from the intervention, based on the impact evaluation provided.\n"
-    "Output exactly one of: Very significant, Significant, Neutral/mixed results, No effect, Outcome was worsened, No Information. "
+    "Reply with {{\"grade\": \"<grade>\"}}, the grade being exactly one of: Very significant, Significant, Neutral/mixed results, No effect, Outcome was worsened, No information."
 )
-# ─────────────────────────────────────
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+GRADE_SCHEMA    = obj(grade=string(GRADES))
+RESPONSE_FORMAT = response_format("outcome_grade", GRADE_SCHEMA)
 
-# ---------- helpers ----------
-def load_yaml(path: str, default):
-    if Path(path).exists():
-        with open(path, "r", encoding="utf-8") as f:
-            return yaml.safe_load(f) or default
-    return default
+# --per-record: every informative outcome of a record graded in one JSON call
+MAX_OUTCOMES_PER_CALL = 10
+MAX_OUTPUT_TOKENS     = 1000
+TOKENS_PER_OUTCOME    = 40     # {"outcome": …, "grade": …} item in the JSON answer
+
+SYSTEM_MSG_MULTI = (
+    "You are a careful research assistant.\n"
+    "Reply with a single JSON object and nothing else."
+)
 
-def append_yaml(path: str, item):
-    mode = "a" if Path(path).exists() else "w"
-    with open(path, mode, encoding="utf-8") as f:
-        yaml.safe_dump([item], f, allow_unicode=True, sort_keys=False)
+PROMPT_TMPL_MULTI = (
+    "Below is the grading rubric you will be using:\n"
+    "{grading}\n\n"
+    "This is the intervention:\n{intervention}\n\n"
+    "Outcomes of the intervention to evaluate, each followed by its impact evaluation:\n\n"
+    "{outcomes}\n\n"
+    "For each outcome, assign the appropriate grade for the degree to which it was acheived from the intervention, based on its impact evaluation.\n"
+    "Reply with a JSON object of the form {{\"grades\": [{{\"outcome\": \"<outcome name>\", \"grade\": \"<grade>\"}}]}} "
+    "with one item per outcome, the outcome name exactly as written above. "
+    "Each grade is exactly one of: Very significant, Significant, Neutral/mixed results, No effect, Outcome was worsened, No information."
+)
+
+GRADE_ITEM            = obj(outcome=string(), grade=string(GRADES))
+RESPONSE_FORMAT_MULTI = response_format("outcome_grades", obj(grades=array(GRADE_ITEM)))
+
+OUTCOME_TMPL_MULTI = "Outcome: {outcome_name}\nImpact evaluation:\n{outcome}"
+
+# Canned answer used by the offline --local-batch stand-in
+LOCAL_REPLY = '{"grade": "No information"}'
+# ─────────────────────────────────────
+
+# ---------- helpers ----------
+def output_key(row: dict) -> tuple:
+    return row["record_id"], row["term"]
 
 
 def is_informative(rec):
@@ -89,101 +129,170 @@ def is_informative(rec):
     return True
 
 
-def ask_chatgpt(prompt: str) -> str:
-    for attempt in range(1, RETRY_LIMIT + 1):
-        try:
-            resp = client.chat.completions.create(
-                model=MODEL,
-                messages=[
-                    {"role": "system", "content": SYSTEM_MSG},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0
-            )
-            return resp.choices[0].message.content.strip()
-        except Exception as e:
-            if attempt < RETRY_LIMIT:
-                time.sleep(WAIT_TIME)
-            else:
-                raise RuntimeError(f"OpenAI call failed after {RETRY_LIMIT} attempts: {e}")
+def grade_job(rec, interventions) -> Job:
+    rid = rec["record_id"]
+    prompt = PROMPT_TMPL.format(
+        grading=GRADING_SCHEME,
+        intervention=interventions.get(rid, "No Intervention Described."),
+        outcome=rec["response"].strip(),
+        outcome_name=rec["term"].strip(),
+    )
+    return Job(prompt, {"record_id": rid, "term": rec["term"]})
+
+
+def multi_grade_job(rid, recs, interventions) -> Job:
+    outcomes = "\n\n".join(
+        OUTCOME_TMPL_MULTI.format(outcome_name=r["term"].strip(), outcome=r["response"].strip())
+        for r in recs
+    )
+    prompt = PROMPT_TMPL_MULTI.format(
+        grading=GRADING_SCHEME,
+        intervention=interventions.get(rid, "No Intervention Described."),
+        outcomes=outcomes,
+    )
+    return Job(prompt, {"record_id": rid, "terms": [r["term"] for r in recs],
+                        "rows": {r["term"]: r for r in recs}})
+
+
+def parse_grade(result) -> tuple:
+    """(grade, None) from a one-outcome answer, or (None, what was wrong)."""
+    value, error = parse(result.text, GRADE_SCHEMA)
+    return (None, error) if error else (normalize(value["grade"]), None)
+
+
+def parse_multi_grades(result) -> dict:
+    """{term: grade} for the items of a multi-outcome answer that validate."""
+    grades = {item["outcome"].strip(): normalize(item["grade"])
+              for item in parse_items(result.text, "grades", GRADE_ITEM)}
+    return {term: grades[term.strip()] for term in result.job.meta["terms"]
+            if term.strip() in grades}
+
 
 # ---------- main ----------
-def main():
-    records_in  = load_yaml(YAML_INPUT, [])
-    grades_out  = load_yaml(YAML_OUTPUT, [])
-
-    done_keys = {(g["record_id"], g["term"]) for g in grades_out}
-
-    # Build intervention lookup by record_id
-    interventions = {}
-    for rec in records_in:
-        if rec.get("kind") == "intervention":
-            interventions[rec["record_id"]] = rec.get("response", "No Intervention Described.")
-
-    # Process first 100 records only, in file order
-    to_process = records_in #[:200]
-
-    count = 0
-    for rec in to_process:
-        if not is_informative(rec):
-            continue
-        rid  = rec["record_id"]
-        term = rec["term"]
-        key  = (rid, term)
-        if key in done_keys:
-            continue
-        count += 1
-        print(f"Record #{str(count)}: Grading {rid} – {term}...")
-        print()
-
-        intervention_txt = interventions.get(rid, "No Intervention Described.")
-        outcome_txt      = rec["response"].strip()
-        outcome_name_txt      = rec["term"].strip()
-
-        prompt = PROMPT_TMPL.format(
-            grading=GRADING_SCHEME,
-            intervention=intervention_txt,
-            outcome=outcome_txt,
-            outcome_name=outcome_name_txt,
-        )
-
-        # import pprint
-        # pprint.pprint(prompt)
-        try:
-            grade = ask_chatgpt(prompt)
-        except RuntimeError as err:
-            print(f"{rid} – {term}: {err}")
-            continue
-
-        grade = grade.strip().lower()
-        print("grade")
-        print(grade)
-        print(type(grade))
-        if grade not in {
-            "very significant",
-            "significant",
-            "neutral/mixed results",
-            "no effect",
-            "outcome was worsened",
-            "no information"
-        }:
-            print(f"Unexpected grade for {rid} – {term}: '{grade}' (saving anyway)")
-        result = {
+def main(batch: bool = False, local_batch: str | None = None,
+         poll_interval: float = POLL_INTERVAL, per_record: bool = False,
+         max_outcomes: int = MAX_OUTCOMES_PER_CALL, db: str | None = None,
+         shard: tuple | None = None):
+    if db:
+        store         = Store(db)
+        records_in    = store.extractions(kind="outcome", text=False)
+        interventions = store.interventions()
+        input_keys    = store.table("extractions").keys()
+        outputs       = store.table("grades", FLUSH_EVERY)
+    else:
+        outputs     = open_output(YAML_OUTPUT, shard, output_key, lambda path: JournaledYaml(
+            path, output_key, flush_every=FLUSH_EVERY, flush_interval=FLUSH_INTERVAL))
+
+        # Build intervention lookup by record_id (first streaming pass)
+        interventions = {}
+        input_ids     = set()
+        for rec in iter_rows(YAML_INPUT, text=False):   # either artifact layout
+            input_ids.add(rec["record_id"])
+            if rec.get("kind") == "intervention":
+                interventions[rec["record_id"]] = rec.get("response", "No Intervention Described.")
+        input_keys = [(rid,) for rid in input_ids]
+        records_in = iter_rows(YAML_INPUT, text=False)  # second pass, consumed by pending()
+
+    check_stable(input_keys, db or YAML_INPUT)
+    check_stable(outputs.keys(), db or YAML_OUTPUT)
+
+    queued = set()   # keys handed out this run; earlier runs' keys are looked up in outputs
+
+    def pending():
+        for rec in records_in:          # every record, in file order
+            if not is_informative(rec) or not in_shard(rec["record_id"], shard):
+                continue
+            key = (rec["record_id"], rec["term"])
+            if key in queued or key in outputs:
+                continue
+            queued.add(key)
+            yield rec
+
+    cache = LLMCache()
+    batch_dir = BATCH_DIR if shard is None else f"{BATCH_DIR}/shard{shard[0]}of{shard[1]}"
+    if batch:
+        backend = LocalBatchBackend(local_batch, LOCAL_REPLY) if local_batch else OpenAIBatchBackend()
+
+    def execute(jobs, system=SYSTEM_MSG, response_format=RESPONSE_FORMAT,
+                accept=accepts(parse_grade)):
+        if batch:
+            return run_batch(backend, jobs, MODEL, system, batch_dir, poll_interval,
+                             cache=cache, response_format=response_format, accept=accept)
+        runner = LLMRunner(MODEL, system, response_format=response_format,
+                           max_concurrency=MAX_CONCURRENCY, cache=cache, accept=accept)
+        return runner.run(jobs)
+
+    def save(rid, term, grade):
+        row = {
             "record_id": rid,
             "term": term,
             "grade": grade,
         }
+        outputs.append(row)
+
+    with outputs:
+        if per_record:
+            size = chunk_size(max_outcomes, MAX_OUTPUT_TOKENS, TOKENS_PER_OUTCOME)
+            multi_jobs = (
+                multi_grade_job(rid, chunk, interventions)
+                for rid, recs in group_by_record(pending())
+                for chunk in chunked(recs, size)
+            )
+
+            def sub_job(job, terms):
+                rows = [job.meta["rows"][t] for t in terms]
+                return multi_grade_job(job.meta["record_id"], rows, interventions)
+
+            def execute_multi(jobs):
+                return execute(jobs, SYSTEM_MSG_MULTI, RESPONSE_FORMAT_MULTI,
+                               answers_all(parse_multi_grades))
+
+            single_jobs = []
+            results = run_multi(execute_multi, multi_jobs, sub_job, parse_multi_grades)
+            for result, term, grade in results:
+                rid = result.job.meta["record_id"]
+                if grade is None:
+                    single_jobs.append(grade_job(result.job.meta["rows"][term], interventions))
+                    continue
+                print(f"Graded {rid} – {term}: {grade}")
+                save(rid, term, grade)
+            if single_jobs:
+                print(f"Grading {len(single_jobs)} outcomes one at a time")
+        else:
+            single_jobs = (grade_job(rec, interventions) for rec in pending())
+
+        count = 0
+        for result, grade, error in run_validated(execute, single_jobs, parse_grade):
+            rid, term = result.job.meta["record_id"], result.job.meta["term"]
+            count += 1
+            print(f"Record #{str(count)}: Grading {rid} – {term}...")
+            if error is not None:
+                print(f"{rid} – {term}: {error} (not saved)")
+                continue
 
-        # grades_out.append({
-        #     "record_id": rid,
-        #     "term": term,
-        #     "grade": grade,
-        # })
-        done_keys.add(key)
-        append_yaml(YAML_OUTPUT, result)
+            save(rid, term, grade)
 
-        time.sleep(WAIT_TIME)
+    cache.report()
 
 
 if __name__ == "__main__":
-    main()
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument("--batch", action="store_true",
+                   help="submit all pending prompts as one Batch API job, wait for it and merge the results")
+    p.add_argument("--local-batch", metavar="DIR", default=None,
+                   help="with --batch: use the offline file-based batch stand-in rooted at DIR")
+    p.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+                   help="with --batch: seconds between status checks")
+    p.add_argument("--per-record", action="store_true",
+                   help="grade all informative outcomes of a record in one JSON call")
+    p.add_argument("--max-outcomes", type=int, default=MAX_OUTCOMES_PER_CALL,
+                   help="with --per-record: most outcomes graded in one call")
+    p.add_argument("--db", metavar="PATH", default=None,
+                   help="read extractions from and write grades to this SQLite store "
+                        "instead of the YAML files")
+    p.add_argument("--shard", metavar="I/N", default=None,
+                   help="only grade records in slice I of N, writing a separate output shard "
+                        "(merge with `python shards.py merge`)")
+    args = p.parse_args()
+    main(args.batch or bool(args.local_batch), args.local_batch, args.poll_interval,
+         args.per_record, args.max_outcomes, args.db, parse_shard(args.shard))
@@ -4,27 +4,59 @@ Forecasts the *expected* grade for each informative outcome using
 GPT‑4.1‑2025‑04‑14 **before** reading the outcome description.
 
 Prompt provides only the intervention text and the name of the outcome.
-The model must respond with three labelled sections **in this exact
-order**:
+The model must respond with a JSON object (schema-constrained, see
+structured.py) with three fields **in this exact order**:
 
-Scratchpad thoughts: free‑form step‑by‑step reasoning
-Prediction: 1‑3 sentence qualitative forecast of the outcome direction
-Grade: one of → Very significant | Significant | Neutral/mixed results |
-       No effect | Outcome was worsened | No information
+scratchpad: free‑form step‑by‑step reasoning
+prediction: 1‑3 sentence qualitative forecast of the outcome direction
+grade:      one of → Very significant | Significant | Neutral/mixed results |
+            No effect | Outcome was worsened | No information
 
-Each result is appended immediately to `abstract_outcome_forecasts.yaml`
-so the script can resume safely after interruption.
+A malformed answer is re-asked once and never saved, so a later run
+retries it.
+
+Each result is appended immediately to the journal
+`abstract_outcome_forecasts.jsonl` (group-committed) and the journal is
+folded into `abstract_outcome_forecasts.yaml` at the end of the run, so
+the script can resume safely after interruption.
+
+With `--samples K` every prompt is sampled K times in one request (the
+API's `n` parameter, at SAMPLE_TEMPERATURE).  The saved grade is the modal
+one; the row also keeps the share of samples per grade (`distribution`),
+its Shannon entropy in bits and the number of samples that gave a grade,
+which stage 5 scores with multi-class Brier and log-loss.
+
+With `--retrieve K` the prompt also lists up to K past interventions that
+graded the same outcome, published before this record (retrieval.py; build
+the index first with `python retrieval.py build`).
 """
-import os, time, yaml
-from pathlib import Path
-from openai import OpenAI
+import argparse, collections, itertools, math
+
+from artifacts import iter_rows
+from batch_api import LocalBatchBackend, OpenAIBatchBackend, run_batch, POLL_INTERVAL
+from journal import JournaledYaml
+from llm_cache import LLMCache
+from llm_runner import Job, LLMRunner
+from multi_outcome import answers_all, chunk_size, chunked, group_by_record, run_multi
+from record_ids import check_stable
+from retrieval import INDEX_DIR, Index
+from shards import in_shard, open_output, parse_shard
+from store import Store
+from structured import (GRADES, accepts, array, normalize, obj, parse, parse_items,
+                        response_format, run_validated, string)
 
 # ────────────── CONFIG ──────────────
 MODEL          = "gpt-4.1-2025-04-14"
 YAML_INPUT     = "abstract_extractions_copy.yaml"
 YAML_OUTPUT    = "abstract_outcome_forecasts.yaml"
-WAIT_TIME      = 1      # seconds between calls / retries
-RETRY_LIMIT    = 3
+MAX_CONCURRENCY = 8    # parallel requests (halves on 429s / timeouts)
+BATCH_DIR      = "batch_forecasts"   # --batch input/output and in-flight batch state
+FLUSH_EVERY    = 50    # journal rows written per group commit …
+FLUSH_INTERVAL = 5.0   # … or after this many seconds, whichever is first
+SAMPLES        = 1     # --samples: completions per prompt (1 = single temperature-0 answer)
+SAMPLE_TEMPERATURE = 1.0   # temperature for --samples > 1
+RETRIEVAL_K    = 0     # --retrieve: past interventions shown per outcome (0 = none)
+RETRIEVAL_INDEX = INDEX_DIR
 
 RUBRIC = (
     "1. Very significant\n"
@@ -41,49 +73,80 @@ RUBRIC = (
 
 SYSTEM_MSG = (
     "You are a disciplined forecasting assistant.\n"
-    "Deliberate internally but output exactly three labelled sections in this order:\n"
-    "Scratchpad thoughts: <your step‑by‑step reasoning>\n"
-    "Prediction: <1‑3 sentences>\n"
-    "Grade: <Very significant | Significant | Neutral/mixed results | No effect | Outcome was worsened | No information>"
+    "Deliberate internally, then reply with a single JSON object with three fields in this order:\n"
+    "scratchpad: <your step‑by‑step reasoning>\n"
+    "prediction: <1‑3 sentences>\n"
+    "grade: <Very significant | Significant | Neutral/mixed results | No effect | Outcome was worsened | No information>"
 )
 
 PROMPT_TMPL = (
     "Grading rubric:\n{rubric}\n\n"
     "Intervention description:\n{intervention}\n\n"
+    "{context}"
     "Outcome to evaluate:\n{outcome}\n\n"
     "Using only the information above plus your world knowledge, forecast the most likely grade.\n"
     "Think through causal pathways, historical base‑rates, and similar programs. Weigh arguments for each grade, then decide the single most likely grade.\n"
-    "Respond with the three labelled sections:"
-    "Scratchpad thoughts: <your step‑by‑step reasoning>\n"
-    "Prediction: <1‑3 sentences>\n"
-    "Grade: <Very significant | Significant | Neutral/mixed results | No effect | Outcome was worsened | No information>"
-
+    "Reply with a JSON object of the form "
+    "{{\"scratchpad\": \"<your step‑by‑step reasoning>\", \"prediction\": \"<1‑3 sentences>\", \"grade\": \"<grade>\"}} "
+    "where the grade is exactly one of: Very significant | Significant | Neutral/mixed results | No effect | Outcome was worsened | No information"
 )
 
-VALID_GRADES = {
+FORECAST_SCHEMA = obj(scratchpad=string(), prediction=string(), grade=string(GRADES))
+RESPONSE_FORMAT = response_format("outcome_forecast", FORECAST_SCHEMA)
+
+FORECAST_GRADES = [      # the classes of a --samples distribution, in rubric order
     "very significant",
     "significant",
     "neutral/mixed results",
     "no effect",
     "outcome was worsened",
-    "no information",
-}
+]
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# --per-record: every informative outcome of a record forecast in one JSON call
+MAX_OUTCOMES_PER_CALL = 5
+MAX_OUTPUT_TOKENS     = 4000
+TOKENS_PER_OUTCOME    = 450    # scratchpad + prediction + grade per outcome
 
-# ---------- helpers ----------
+SYSTEM_MSG_MULTI = (
+    "You are a disciplined forecasting assistant.\n"
+    "Deliberate internally, then reply with a single JSON object and nothing else."
+)
 
-def load_yaml(path: str, default):
-    if Path(path).exists():
-        with open(path, "r", encoding="utf-8") as f:
-            return yaml.safe_load(f) or default
-    return default
+PROMPT_TMPL_MULTI = (
+    "Grading rubric:\n{rubric}\n\n"
+    "Intervention description:\n{intervention}\n\n"
+    "{context}"
+    "Outcomes to evaluate:\n{outcomes}\n\n"
+    "Using only the information above plus your world knowledge, forecast the most likely grade for each outcome.\n"
+    "Think through causal pathways, historical base‑rates, and similar programs. Weigh arguments for each grade, then decide the single most likely grade.\n"
+    "Reply with a JSON object of the form "
+    "{{\"forecasts\": [{{\"outcome\": \"<outcome>\", \"scratchpad\": \"<your step‑by‑step reasoning>\", "
+    "\"prediction\": \"<1‑3 sentences>\", \"grade\": \"<grade>\"}}]}} "
+    "with one item per outcome, the outcome exactly as written above. "
+    "Each grade is exactly one of: Very significant | Significant | Neutral/mixed results | No effect | Outcome was worsened | No information"
+)
 
+FORECAST_ITEM = obj(outcome=string(), scratchpad=string(), prediction=string(), grade=string(GRADES))
+RESPONSE_FORMAT_MULTI = response_format("outcome_forecasts", obj(forecasts=array(FORECAST_ITEM)))
 
-def append_yaml(path: str, item):
-    mode = "a" if Path(path).exists() else "w"
-    with open(path, mode, encoding="utf-8") as f:
-        yaml.safe_dump([item], f, allow_unicode=True, sort_keys=False)
+# --retrieve: inserted after the intervention; empty without retrieval
+CONTEXT_TMPL = (
+    "Similar past interventions, published before this one, and the grade the outcome received:\n"
+    "{examples}\n\n"
+)
+EXAMPLE_TMPL = "- ({year}) {intervention} → {grade}"
+TERM_EXAMPLES_TMPL = "{outcome}:\n{examples}"
+
+# Canned answer used by the offline --local-batch stand-in
+LOCAL_REPLY = (
+    '{"scratchpad": "local batch stand-in, no model was called.", '
+    '"prediction": "No prediction.", "grade": "No information"}'
+)
+
+# ---------- helpers ----------
+
+def output_key(row: dict) -> tuple:
+    return row["record_id"], row["term"]
 
 
 def is_informative(rec):
@@ -105,97 +168,259 @@ def is_informative(rec):
     return True
 
 
-def ask_chatgpt(prompt: str) -> str:
-    for attempt in range(1, RETRY_LIMIT + 1):
-        try:
-            resp = client.chat.completions.create(
-                model=MODEL,
-                messages=[
-                    {"role": "system", "content": SYSTEM_MSG},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0
-            )
-            return resp.choices[0].message.content.strip()
-        except Exception as e:
-            if attempt < RETRY_LIMIT:
-                time.sleep(WAIT_TIME)
-            else:
-                raise RuntimeError(f"OpenAI call failed after {RETRY_LIMIT} attempts: {e}")
+def past_results(rid, terms, interventions, retriever, k) -> str:
+    """The --retrieve block for ``terms`` of record ``rid`` ("" without hits).
+
+    Only interventions published in an earlier year than ``rid`` are shown;
+    a record whose year is unknown gets none.
+    """
+    if retriever is None or k <= 0 or (year := retriever.year(rid)) < 0:
+        return ""
+    text = interventions.get(rid, "")
+    blocks = []
+    for term in terms:
+        hits = retriever.search(text, term, before=year, k=k, exclude=rid)
+        examples = "\n".join(EXAMPLE_TMPL.format(year=h.year, intervention=" ".join(h.snippet.split()),
+                                                 grade=h.grade.capitalize()) for h in hits)
+        if examples:
+            blocks.append(examples if len(terms) == 1 else
+                          TERM_EXAMPLES_TMPL.format(outcome=term, examples=examples))
+    return CONTEXT_TMPL.format(examples="\n\n".join(blocks)) if blocks else ""
+
+
+def forecast_job(rid, term, interventions, retriever=None, k=RETRIEVAL_K) -> Job:
+    prompt = PROMPT_TMPL.format(
+        rubric=RUBRIC,
+        intervention=interventions.get(rid, "No Intervention Described."),
+        context=past_results(rid, [term], interventions, retriever, k),
+        outcome=term,
+    )
+    return Job(prompt, {"record_id": rid, "term": term})
+
+
+def multi_forecast_job(rid, terms, interventions, retriever=None, k=RETRIEVAL_K) -> Job:
+    prompt = PROMPT_TMPL_MULTI.format(
+        rubric=RUBRIC,
+        intervention=interventions.get(rid, "No Intervention Described."),
+        context=past_results(rid, terms, interventions, retriever, k),
+        outcomes="\n".join(f"- {t}" for t in terms),
+    )
+    return Job(prompt, {"record_id": rid, "terms": list(terms)})
+
+
+def parse_reply(reply: str | None) -> tuple:
+    """((scratchpad, prediction, grade), None) from a JSON answer, or (None, what was wrong)."""
+    value, error = parse(reply, FORECAST_SCHEMA)
+    if error:
+        return None, error
+    return (value["scratchpad"].strip(), value["prediction"].strip(), normalize(value["grade"])), None
+
+
+def sample_texts(result) -> list:
+    """Every completion of a result (one unless --samples)."""
+    return result.samples or [result.text]
+
+
+def combine_samples(forecasts: list) -> tuple:
+    """(scratchpad, prediction, modal grade, extra fields) over sampled forecasts.
+
+    ``forecasts`` are (scratchpad, prediction, grade) per sample.  Only the
+    five forecast grades count towards the distribution; ties go to the grade
+    sampled first.  The reasoning saved is that of the first modal sample.
+    """
+    graded = [f for f in forecasts if f[2] in FORECAST_GRADES]
+    if not graded:
+        return (*forecasts[0], {"samples": 0})
+    counts = collections.Counter(f[2] for f in graded)    # in order of first sample
+    modal = max(counts, key=counts.get)
+    shares = {g: counts[g] / len(graded) for g in FORECAST_GRADES}
+    entropy = -sum(p * math.log2(p) for p in shares.values() if p > 0)
+    scratchpad, prediction, _ = next(f for f in graded if f[2] == modal)
+    return scratchpad, prediction, modal, {
+        "distribution": {g: round(p, 4) for g, p in shares.items()},
+        "entropy": round(entropy, 4), "samples": len(graded)}
+
+
+def parse_forecast(result) -> tuple:
+    """((scratchpad, prediction, grade[, extra]), None) of a one-outcome result,
+    or (None, what was wrong) if no sample parsed."""
+    parsed = [parse_reply(text) for text in sample_texts(result)]
+    forecasts = [f for f, error in parsed if error is None]
+    if not forecasts:
+        return None, parsed[0][1]
+    return (forecasts[0] if result.samples is None else combine_samples(forecasts)), None
+
+
+def parse_multi_forecasts(result) -> dict:
+    """{term: (scratchpad, prediction, grade[, extra])} for terms with a valid grade.
+
+    With several samples a term counts as answered if any sample graded it.
+    """
+    per_sample = [parse_multi_text(text, result.job.meta["terms"])
+                  for text in sample_texts(result)]
+    if result.samples is None:
+        return per_sample[0]
+    out = {}
+    for term in result.job.meta["terms"]:
+        forecasts = [sample[term] for sample in per_sample if term in sample]
+        if forecasts:
+            out[term] = combine_samples(forecasts)
+    return out
+
+
+def parse_multi_text(text: str | None, terms: list) -> dict:
+    """{term: (scratchpad, prediction, grade)} for the items of one JSON answer that validate."""
+    forecasts = {item["outcome"].strip(): (item["scratchpad"].strip(), item["prediction"].strip(),
+                                           normalize(item["grade"]))
+                 for item in parse_items(text, "forecasts", FORECAST_ITEM)}
+    return {term: forecasts[term.strip()] for term in terms if term.strip() in forecasts}
+
 
 # ---------- main ----------
 
-def main():
-    records_in  = load_yaml(YAML_INPUT, [])
-    existing    = load_yaml(YAML_OUTPUT, [])
-
-    done_keys = {(r["record_id"], r["term"]) for r in existing}
-
-    # Map record_id -> intervention text
-    interventions = {
-        rec["record_id"]: rec.get("response", "No Intervention Described.")
-        for rec in records_in if rec.get("kind") == "intervention"
-    }
-
-    count = 0
-    for rec in records_in[:500]:
-        if not is_informative(rec):
-            continue
-        rid, term = rec["record_id"], rec["term"]
-        if (rid, term) in done_keys:
-            continue
-
-        count += 1
-        print(f"[{count}] Forecasting {rid} – {term}…")
-
-        prompt = PROMPT_TMPL.format(
-            rubric=RUBRIC,
-            intervention=interventions.get(rid, "No Intervention Described."),
-            outcome=term,
-        )
-        # import pprint
-        # pprint.pprint(prompt)
-
-        try:
-            reply = ask_chatgpt(prompt)
-        except RuntimeError as err:
-            print(f"{rid} – {term}: {err}")
-            continue
-
-        # Expect three labelled lines; tolerate multi‑line scratchpad
-        scratchpad, prediction, grade = "", "", ""
-        lines = [l.strip() for l in reply.splitlines() if l.strip()]
-        section = None
-        for line in lines:
-            low = line.lower()
-            if low.startswith("scratchpad thoughts"):
-                section = "scratchpad"
-                scratchpad = line.split(":",1)[1].strip()
-            elif low.startswith("prediction"):
-                section = "prediction"
-                prediction = line.split(":",1)[1].strip()
-            elif low.startswith("grade"):
-                section = "grade"
-                grade = line.split(":",1)[1].strip().lower()
-            else:
-                if section == "scratchpad":
-                    scratchpad += (" " if scratchpad else "") + line
-                elif section == "prediction":
-                    prediction += (" " if prediction else "") + line
-        if grade not in VALID_GRADES:
-            print(f"{rid} – {term}: unexpected grade '{grade}', saving anyway")
+def main(batch: bool = False, local_batch: str | None = None,
+         poll_interval: float = POLL_INTERVAL, per_record: bool = False,
+         max_outcomes: int = MAX_OUTCOMES_PER_CALL, db: str | None = None,
+         shard: tuple | None = None, samples: int = SAMPLES, retrieve: int = RETRIEVAL_K):
+    if db:
+        store         = Store(db)
+        records_in    = store.extractions(text=False)
+        interventions = store.interventions()
+        input_keys    = store.table("extractions").keys()
+        outputs       = store.table("forecasts", FLUSH_EVERY)
+    else:
+        outputs     = open_output(YAML_OUTPUT, shard, output_key, lambda path: JournaledYaml(
+            path, output_key, flush_every=FLUSH_EVERY, flush_interval=FLUSH_INTERVAL))
+
+        # Map record_id -> intervention text (first streaming pass)
+        interventions = {}
+        input_ids     = set()
+        for rec in iter_rows(YAML_INPUT, text=False):   # either artifact layout
+            input_ids.add(rec["record_id"])
+            if rec.get("kind") == "intervention":
+                interventions[rec["record_id"]] = rec.get("response", "No Intervention Described.")
+        input_keys = [(rid,) for rid in input_ids]
+        records_in = iter_rows(YAML_INPUT, text=False)  # second pass, consumed by pending()
 
+    check_stable(input_keys, db or YAML_INPUT)
+    check_stable(outputs.keys(), db or YAML_OUTPUT)
+
+    queued = set()   # keys handed out this run; earlier runs' keys are looked up in outputs
+
+    def pending():
+        for rec in itertools.islice(records_in, 500):
+            if not is_informative(rec) or not in_shard(rec["record_id"], shard):
+                continue
+            rid, term = rec["record_id"], rec["term"]
+            if (rid, term) in queued or (rid, term) in outputs:
+                continue
+            queued.add((rid, term))
+            yield rec
+
+    retriever = Index(RETRIEVAL_INDEX) if retrieve > 0 else None
+    if retriever is not None:
+        print(f"Adding up to {retrieve} earlier interventions per outcome from {RETRIEVAL_INDEX}")
+
+    cache = LLMCache()
+    batch_dir = BATCH_DIR if shard is None else f"{BATCH_DIR}/shard{shard[0]}of{shard[1]}"
+    temperature = SAMPLE_TEMPERATURE if samples > 1 else 0
+    if samples > 1:
+        print(f"Sampling {samples} forecasts per prompt at temperature {temperature}")
+    if batch:
+        backend = LocalBatchBackend(local_batch, LOCAL_REPLY) if local_batch else OpenAIBatchBackend()
+
+    def execute(jobs, system=SYSTEM_MSG, response_format=RESPONSE_FORMAT,
+                accept=accepts(parse_forecast)):
+        if batch:
+            return run_batch(backend, jobs, MODEL, system, batch_dir, poll_interval,
+                             temperature, cache=cache, response_format=response_format,
+                             n=samples, accept=accept)
+        runner = LLMRunner(MODEL, system, temperature, response_format=response_format,
+                           max_concurrency=MAX_CONCURRENCY, cache=cache, n=samples,
+                           accept=accept)
+        return runner.run(jobs)
+
+    def save(rid, term, scratchpad, prediction, grade, extra=None):
         record = {
             "record_id": rid,
             "term": term,
             "scratchpad": scratchpad,
             "prediction": prediction,
             "grade": grade,
+            **(extra or {}),
         }
-        append_yaml(YAML_OUTPUT, record)
-        done_keys.add((rid, term))
-        time.sleep(WAIT_TIME)
+        outputs.append(record)
+
+    with outputs:
+        if per_record:
+            size = chunk_size(max_outcomes, MAX_OUTPUT_TOKENS, TOKENS_PER_OUTCOME)
+            multi_jobs = (
+                multi_forecast_job(rid, chunk, interventions, retriever, retrieve)
+                for rid, recs in group_by_record(pending())
+                for chunk in chunked([r["term"] for r in recs], size)
+            )
+
+            def sub_job(job, terms):
+                return multi_forecast_job(job.meta["record_id"], terms, interventions,
+                                          retriever, retrieve)
+
+            def execute_multi(jobs):
+                return execute(jobs, SYSTEM_MSG_MULTI, RESPONSE_FORMAT_MULTI,
+                               answers_all(parse_multi_forecasts))
+
+            single_jobs = []
+            results = run_multi(execute_multi, multi_jobs, sub_job, parse_multi_forecasts)
+            for result, term, forecast in results:
+                rid = result.job.meta["record_id"]
+                if forecast is None:
+                    single_jobs.append(forecast_job(rid, term, interventions, retriever, retrieve))
+                    continue
+                print(f"Forecast {rid} – {term}: {forecast[2]}")
+                save(rid, term, *forecast)
+            if single_jobs:
+                print(f"Forecasting {len(single_jobs)} outcomes one at a time")
+        else:
+            single_jobs = (forecast_job(rec["record_id"], rec["term"], interventions,
+                                        retriever, retrieve)
+                           for rec in pending())
+
+        count = 0
+        for result, forecast, error in run_validated(execute, single_jobs, parse_forecast):
+            rid, term = result.job.meta["record_id"], result.job.meta["term"]
+            count += 1
+            print(f"[{count}] Forecasting {rid} – {term}…")
+            if error is not None:
+                print(f"{rid} – {term}: {error} (not saved)")
+                continue
+            save(rid, term, *forecast)
+
+    cache.report()
 
 
 if __name__ == "__main__":
-    main()
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument("--batch", action="store_true",
+                   help="submit all pending prompts as one Batch API job, wait for it and merge the results")
+    p.add_argument("--local-batch", metavar="DIR", default=None,
+                   help="with --batch: use the offline file-based batch stand-in rooted at DIR")
+    p.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+                   help="with --batch: seconds between status checks")
+    p.add_argument("--per-record", action="store_true",
+                   help="forecast all informative outcomes of a record in one JSON call")
+    p.add_argument("--max-outcomes", type=int, default=MAX_OUTCOMES_PER_CALL,
+                   help="with --per-record: most outcomes forecast in one call")
+    p.add_argument("--db", metavar="PATH", default=None,
+                   help="read extractions from and write forecasts to this SQLite store "
+                        "instead of the YAML files")
+    p.add_argument("--shard", metavar="I/N", default=None,
+                   help="only forecast records in slice I of N, writing a separate output shard "
+                        "(merge with `python shards.py merge`)")
+    p.add_argument("--samples", type=int, default=SAMPLES,
+                   help="sample K forecasts per prompt in one request and save their grade distribution")
+    p.add_argument("--retrieve", metavar="K", type=int, default=RETRIEVAL_K,
+                   help="show the K most similar earlier interventions per outcome in the prompt "
+                        f"(needs the index in {RETRIEVAL_INDEX}, see retrieval.py)")
+    args = p.parse_args()
+    main(args.batch or bool(args.local_batch), args.local_batch, args.poll_interval,
+         args.per_record, args.max_outcomes, args.db, parse_shard(args.shard), args.samples,
+         args.retrieve)
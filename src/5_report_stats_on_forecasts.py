@@ -2,10 +2,34 @@
 """
 Evaluate outcome-grade forecasts (truth vs forecast YAMLs).
 Adds scatter-plot and two baselines (mode + random).
+
+Every metric gets a bootstrap 95 % interval, and the model is tested against
+each baseline with a permutation test (see metrics.py).  The random baseline
+is the exact expectation of uniform random grades, not a single draw.
+
+Forecasts made with stage 4 ``--samples`` carry a distribution over the
+grades; those are also scored with multi-class Brier and log-loss, next to
+a uniform and a base-rate distribution.
+
+Given several forecast files (or globs), it prints a leaderboard instead:
+the truth is indexed once, every forecaster is scored on the outcomes all of
+them forecast (common overlap) and on its own overlap, and the table can be
+written as CSV, JSON or Markdown (``--leaderboard results.csv``).
+
+``--baselines`` adds the non-LLM forecasters of baselines.py (term/category
+base rates and TF-IDF nearest neighbours, leave-one-record-out) scored on
+the same outcomes as the model.
 """
-import yaml, math, collections, argparse, sys, random
+import collections, argparse, sys, csv, glob, json, os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import matplotlib.pyplot as plt
+import numpy as np
+
+import baselines
+import metrics
+from store import Store
+import yaml_cache
 
 GRADE_TO_SCORE = {
     "outcome was worsened":    0.00,
@@ -15,101 +39,296 @@ GRADE_TO_SCORE = {
     "very significant":        1.00,
 }
 LABELS = list(GRADE_TO_SCORE)          # fixed order
+SCORES = [GRADE_TO_SCORE[l] for l in LABELS]
 VALID  = set(GRADE_TO_SCORE)
+SEED      = 20240601                  # fixes the bootstrap and permutation draws
+RESAMPLES = 100_000                   # per interval / test
+SMOOTHING = 0.5                       # pseudo-count per grade before log-loss (Jeffreys)
+PARALLEL_FROM = 4                     # forecast files from which they are loaded in parallel
+COLUMNS = ["accuracy", "rmse", "brier", "macro_f1", "kappa"]
 
 # ---------- helpers ----------------------------------------------------------
 
 def load_yaml(path):
     if not Path(path).exists():
         sys.exit(f"File not found: {path}")
-    with open(path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f) or []
+    return yaml_cache.load(path, [])
 
-def rmse(y_true, y_pred):
-    return math.sqrt(sum((p - t) ** 2 for p, t in zip(y_pred, y_true)) / len(y_true))
+def grade_index(path) -> dict:
+    """{(record_id, term): normalised grade} of a grades or forecasts file."""
+    return {(r["record_id"], r["term"]): r["grade"].strip().lower()
+            for r in load_yaml(path)}
 
-# ---------- main -------------------------------------------------------------
+def load_pairs(truth, forecasts):
+    """[(true grade, forecast grade or None)] per graded outcome, and all forecast grades."""
+    truth_map = grade_index(truth)
+    pred_map  = grade_index(forecasts)
+    return [(t, pred_map.get(k)) for k, t in truth_map.items()], list(pred_map.values())
+
+def load_distributions(truth, forecasts) -> list:
+    """[(true grade, {grade: share}, samples)] for graded outcomes with a sampled forecast."""
+    truth_map = grade_index(truth)
+    return [(truth_map[k], r["distribution"], r.get("samples"))
+            for r in load_yaml(forecasts)
+            if r.get("distribution") and (k := (r["record_id"], r["term"])) in truth_map]
+
+def score_distributions(rows, base_rates) -> dict:
+    """Multi-class Brier and log-loss of sampled distributions and two reference forecasts."""
+    rows = [(t, d, n) for t, d, n in rows if t in VALID]
+    y_true = metrics.encode((t for t, _, _ in rows), LABELS)
+    raw = metrics.probability_matrix([d for _, d, _ in rows], LABELS)
+    smoothed = metrics.probability_matrix([d for _, d, _ in rows], LABELS,
+                                          [n or 1 for _, _, n in rows], SMOOTHING)
+    references = {"uniform": np.full_like(raw, 1 / len(LABELS)),
+                  "base rate": np.tile(base_rates, (len(rows), 1))}
+    out = {"n": len(rows), "brier": metrics.multiclass_brier(y_true, raw),
+           "log_loss": metrics.log_loss(y_true, smoothed)}
+    for name, probs in references.items():
+        out[name] = {"brier": metrics.multiclass_brier(y_true, probs),
+                     "log_loss": metrics.log_loss(y_true, probs)}
+    return out
+
+def forecasted_keys(forecasts, db=None) -> set:
+    """(record_id, term) of every outcome forecast with a valid grade."""
+    if db:
+        store = Store(db)
+        rows = list(store.table("forecasts").values())
+        store.close()
+        return {(r["record_id"], r["term"]) for r in rows
+                if str(r.get("grade") or "").strip().lower() in VALID}
+    return {k for k, g in grade_index(forecasts).items() if g in VALID}
+
+def baseline_scores(truth, forecasted) -> dict:
+    """{name: scores} of the baselines.py forecasters on the model's overlap.
+
+    They are fitted on the whole truth file (leave-one-record-out), reading
+    the intervention texts and records next to it.
+    """
+    folder = Path(truth).parent
+    data = baselines.load(truth, folder / baselines.EXTRACTIONS, folder / baselines.RECORDS)
+    rows = [i for i, k in enumerate(data.keys) if k in forecasted]
+    return baselines.evaluate_all(data, rows) if rows else {}
+
+def expand_paths(patterns) -> list:
+    """Forecast files named by ``patterns`` (globs allowed), in order, without repeats."""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            sys.exit(f"No forecast files match {pattern}")
+        paths += [m for m in matches if m not in paths]
+    return paths
+
+def print_metric(name, value, ci, fmt=".4f"):
+    print(f"{name:<23}: {value:{fmt}}  [{ci[0]:{fmt}}, {ci[1]:{fmt}}]")
+
+def print_tests(title, tests, sign="+"):
+    print(f"--- {title} ---")
+    for m, (value, p) in tests.items():
+        print(f"{m:<23}: {value:{sign}.4f}  p = {p:.4g}")
+
+def print_per_class(result: metrics.Metrics):
+    print(f"{'Grade':<24} {'Prec':>6} {'Recall':>6} {'F1':>6} {'N':>5}")
+    for label, row in result.per_class().items():
+        print(f"{label:<24} {row['precision']:>6.3f} {row['recall']:>6.3f} "
+              f"{row['f1']:>6.3f} {row['support']:>5}")
+
+# ---------- leaderboard ------------------------------------------------------
+
+def summarize(result: metrics.Metrics | None) -> dict:
+    """{"n", *COLUMNS} of a result (empty cells for no overlap)."""
+    if result is None:
+        return {"n": 0, **dict.fromkeys(COLUMNS)}
+    m = result.as_dict()
+    return {c: m[c] for c in ["n", *COLUMNS]}
+
+def score(keys, truth_map, pred_map) -> metrics.Metrics | None:
+    """A forecaster's metrics over ``keys`` (outcomes with a valid truth)."""
+    if not keys:
+        return None
+    return metrics.evaluate(metrics.encode((truth_map[k] for k in keys), LABELS),
+                            metrics.encode((pred_map.get(k) for k in keys), LABELS),
+                            SCORES, LABELS)
+
+def score_random(keys, truth_map) -> metrics.Metrics | None:
+    """Metrics of the expected confusion matrix of uniformly random grades over ``keys``.
+
+    Exact expected values for accuracy, RMSE and Brier (see ``metrics.expected_random``).
+    """
+    if not keys:
+        return None
+    support = np.bincount(metrics.encode((truth_map[k] for k in keys), LABELS), minlength=len(LABELS))
+    return metrics.from_confusion(metrics.expected_random(np.diag(support)), SCORES, LABELS)
 
-def main(truth, forecasts):
-    truth_recs = load_yaml(truth)
-    pred_recs  = load_yaml(forecasts)
+def board_row(name, common: metrics.Metrics | None, own: metrics.Metrics | None) -> dict:
+    return {"forecaster": name, **summarize(common),
+            **{f"{c}_own": v for c, v in summarize(own).items()}}
 
-    truth_map = {(r["record_id"], r["term"]): r["grade"].strip().lower()
-                 for r in truth_recs}
-    pred_map  = {(r["record_id"], r["term"]): r["grade"].strip().lower()
-                 for r in pred_recs}
+def leaderboard(truth, forecasts, db=None, jobs=None, sort="accuracy") -> list:
+    """One row per forecaster (plus the two baselines), best first by ``sort``.
 
-    y_true, y_pred = [], []
-    for key, t_grade in truth_map.items():
-        p_grade = pred_map.get(key)
-        if t_grade in VALID and p_grade in VALID:
-            y_true.append(GRADE_TO_SCORE[t_grade])
-            y_pred.append(GRADE_TO_SCORE[p_grade])
+    Columns without suffix are over the common overlap, ``*_own`` over the
+    outcomes that forecaster answered with a valid grade.
+    """
+    if db:
+        store = Store(db)
+        truth_map = {(r["record_id"], r["term"]): r["grade"].strip().lower()
+                     for r in store.table("grades").values()}
+        store.close()
+    else:
+        truth_map = grade_index(truth)
+    truth_map = {k: g for k, g in truth_map.items() if g in VALID}
+    print(f"Truth: {len(truth_map)} graded outcomes")
 
-    if not y_true:
+    names = [Path(p).name.split(".")[0] for p in forecasts]
+    if len(set(names)) < len(names):
+        names = list(forecasts)
+    jobs = jobs or (min(len(forecasts), os.cpu_count() or 1) if len(forecasts) >= PARALLEL_FROM else 1)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            pred_maps = list(pool.map(grade_index, forecasts))
+    else:
+        pred_maps = [grade_index(p) for p in forecasts]
+
+    own = [[k for k in truth_map if pred.get(k) in VALID] for pred in pred_maps]
+    common = set(truth_map).intersection(*own)
+    common = [k for k in truth_map if k in common]
+    print(f"Common overlap: {len(common)} outcomes forecast by all {len(forecasts)} files")
+
+    rows = [board_row(name, score(common, truth_map, pred), score(keys, truth_map, pred))
+            for name, pred, keys in zip(names, pred_maps, own)]
+
+    # baselines on the same outcomes; their own overlap is every graded outcome
+    everything = list(truth_map)
+    mode_grade, _ = collections.Counter(truth_map.values()).most_common(1)[0]
+    mode = dict.fromkeys(everything, mode_grade)
+    rows.append(board_row(f"(most common: {mode_grade})", score(common, truth_map, mode),
+                          score(everything, truth_map, mode)))
+    rows.append(board_row("(random)", score_random(common, truth_map),
+                          score_random(everything, truth_map)))
+
+    sign = 1 if sort.removesuffix("_own") in metrics.LOWER_IS_BETTER else -1
+    rows.sort(key=lambda r: (r[sort] is None, sign * (r[sort] or 0)))
+    return rows
+
+def _cell(value) -> str:
+    if value is None:
+        return ""
+    return f"{value:.4f}" if isinstance(value, float) else str(value)
+
+def write_leaderboard(rows, path=None) -> str:
+    """Markdown of ``rows``; also written to ``path`` as .csv, .json or .md."""
+    header = list(rows[0])
+    md = "\n".join(["| " + " | ".join(header) + " |",
+                    "|" + "|".join("---" for _ in header) + "|",
+                    *("| " + " | ".join(_cell(r[c]) for c in header) + " |" for r in rows)])
+    if path:
+        suffix = Path(path).suffix.lower()
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            if suffix == ".csv":
+                writer = csv.DictWriter(f, fieldnames=header)
+                writer.writeheader()
+                writer.writerows(rows)
+            elif suffix == ".json":
+                json.dump(rows, f, indent=2)
+            else:
+                f.write(md + "\n")
+        print(f"Leaderboard written to {path}")
+    return md
+
+# ---------- main -------------------------------------------------------------
+
+def main(truth, forecasts, db=None, seed=SEED, resamples=RESAMPLES, with_baselines=False) -> dict:
+    if db:
+        # grades LEFT JOIN forecasts on (record_id, term), done by SQLite
+        store       = Store(db)
+        pairs       = store.graded_pairs()
+        pred_grades = store.forecast_grades()
+        sampled     = store.graded_distributions()
+    else:
+        pairs, pred_grades = load_pairs(truth, forecasts)
+        sampled     = load_distributions(truth, forecasts)
+
+    # only pairs where both grades are valid are scored
+    scored = [(t, p) for t, p in pairs if t in VALID and p in VALID]
+    if not scored:
         sys.exit("No overlapping records with valid grades.")
 
     # ── metrics ───────────────────────────────────────────────────────────────
-    main_rmse = rmse(y_true, y_pred)
-    main_acc  = sum(p == t for p, t in zip(y_pred, y_true)) / len(y_true)
-
-    # macro-F1 (5-class)
-    conf = collections.Counter((pred_map.get(k), v)
-                               for k, v in truth_map.items() if v in VALID)
-    f1s = []
-    for g in VALID:
-        tp = conf[(g, g)]
-        fp = sum(conf[(g, x)] for x in VALID if x != g)
-        fn = sum(conf[(x, g)] for x in VALID if x != g)
-        prec = tp / (tp + fp) if tp + fp else 0
-        rec  = tp / (tp + fn) if tp + fn else 0
-        f1s.append(0 if prec + rec == 0 else 2*prec*rec/(prec+rec))
-    macro_f1 = sum(f1s) / len(f1s)
+    y_true = metrics.encode((t for t, _ in scored), LABELS)
+    y_pred = metrics.encode((p for _, p in scored), LABELS)
+    model = metrics.evaluate(y_true, y_pred, SCORES, LABELS)
 
     # ── baseline 1: most-common grade ─────────────────────────────────────────
-    mode_grade, _ = collections.Counter(truth_map.values()).most_common(1)[0]
-    mode_score    = GRADE_TO_SCORE[mode_grade]
-    mode_rmse     = rmse(y_true, [mode_score]*len(y_true))
-    mode_acc      = sum(t == mode_score for t in y_true) / len(y_true)
+    mode_grade, _ = collections.Counter(t for t, _ in pairs if t in VALID).most_common(1)[0]
+    mode_pred = np.full(len(scored), LABELS.index(mode_grade))
+    mode = metrics.evaluate(y_true, mode_pred, SCORES, LABELS)
 
-    # ── baseline 2: random grade ──────────────────────────────────────────────
-    random_scores = [GRADE_TO_SCORE[random.choice(LABELS)] for _ in y_true]
-    rand_rmse     = rmse(y_true, random_scores)
-    rand_acc      = sum(r == t for r, t in zip(random_scores, y_true)) / len(y_true)
+    # ── baseline 2: random grade (expected matrix over uniform draws) ────────
+    rand = metrics.from_confusion(metrics.expected_random(model.confusion), SCORES, LABELS)
 
-    # ── metrics ───────────────────────────────────────────────────────────────
-    # Brier Score calculation
-    y_true_binary = [1 if t >= 0.75 else 0 for t in y_true]
-    brier_score = sum((f - t)**2 for f, t in zip(y_pred, y_true_binary)) / len(y_true_binary)
+    # ── uncertainty ───────────────────────────────────────────────────────────
+    rng = np.random.default_rng(seed)
+    ci = metrics.bootstrap(model.confusion, SCORES, resamples, rng)
+    vs_mode = metrics.paired_permutation(y_true, y_pred, mode_pred, SCORES, resamples, rng)
+    vs_chance = metrics.shuffle_test(y_true, y_pred, SCORES, resamples, rng)
+
+    # ── sampled distributions (stage 4 --samples) ─────────────────────────────
+    truth_counts = np.bincount(metrics.encode((t for t, _ in pairs), LABELS) + 1,
+                               minlength=len(LABELS) + 1)[1:]       # +1 drops invalid (-1)
+    proper = score_distributions(sampled, truth_counts / truth_counts.sum()) if sampled else None
+
+    # ── non-LLM baselines (baselines.py) ──────────────────────────────────────
+    fitted = baseline_scores(truth, forecasted_keys(forecasts, db)) if with_baselines else {}
 
     # ── report ────────────────────────────────────────────────────────────────
     print("=== Forecast Evaluation ===")
-    print(f"N overlap              : {len(y_true)}")
-    print(f"RMSE                   : {main_rmse:.4f}")
-    print(f"Accuracy (% correct)   : {main_acc:.3%}")
-    print(f"Macro-F1               : {macro_f1:.4f}")
-    print(f"Brier score (rough)    : {brier_score:.4f}")
+    print(f"N overlap              : {model.n}")
+    print(f"(95% bootstrap intervals, {resamples} resamples, seed {seed})")
+    print_metric("RMSE", model.rmse, ci["rmse"])
+    print_metric("Accuracy (% correct)", model.accuracy, ci["accuracy"], ".3%")
+    print_metric("Macro-F1", model.macro_f1, ci["macro_f1"])
+    print_metric("Brier score (rough)", model.brier, ci["brier"])
+    print_metric("Weighted kappa", model.kappa, ci["kappa"])
     print("--- Baseline: most common grade")
     print(f"Grade                  : {mode_grade}")
-    print(f"RMSE                   : {mode_rmse:.4f}")
-    print(f"Accuracy               : {mode_acc:.3%}")
+    print(f"RMSE                   : {mode.rmse:.4f}")
+    print(f"Accuracy               : {mode.accuracy:.3%}")
     print("--- Baseline: random grade")
-    print(f"RMSE                   : {rand_rmse:.4f}")
-    print(f"Accuracy               : {rand_acc:.3%}")
+    print(f"RMSE                   : {rand.rmse:.4f}")
+    print(f"Accuracy               : {rand.accuracy:.3%}")
 
-    # Brier score for the "most common grade" baseline
-    mode_brier_score = sum((mode_score - t)**2 for t in y_true_binary) / len(y_true_binary)
+    print("--- Baseline Brier Scores ---")
+    print(f"Brier (most common)    : {mode.brier:.4f}")
+    print(f"Brier (random)         : {rand.brier:.4f}")
 
-    # Brier score for the "random grade" baseline
-    rand_brier_score = sum((r - t)**2 for r, t in zip(random_scores, y_true_binary)) / len(y_true_binary)
+    print_tests("Model − most common (paired permutation, two-sided)", vs_mode)
+    print_tests("Model vs chance (forecasts shuffled, one-sided)", vs_chance, sign="-")
 
-    print("--- Baseline Brier Scores ---")
-    print(f"Brier (most common)    : {mode_brier_score:.4f}")
-    print(f"Brier (random)         : {rand_brier_score:.4f}")
+    if proper and proper["n"]:
+        print(f"--- Sampled distributions (multi-class, log-loss with {SMOOTHING} pseudo-counts) ---")
+        print(f"N scored               : {proper['n']}")
+        print(f"Brier                  : {proper['brier']:.4f}")
+        print(f"Log-loss (nats)        : {proper['log_loss']:.4f}")
+        for name in ("uniform", "base rate"):
+            print(f"Brier / log-loss ({name + ')':<10}: "
+                  f"{proper[name]['brier']:.4f} / {proper[name]['log_loss']:.4f}")
+
+    if fitted:
+        print(f"--- Non-LLM baselines (leave-one-record-out, N {next(iter(fitted.values()))['n']}) ---")
+        print(f"{'':<23}{'RMSE':>8} {'Acc':>8} {'MacroF1':>8} {'Kappa':>8} {'Brier':>8} {'LogLoss':>8}")
+        for name, s in fitted.items():
+            print(f"{name:<23}{s['rmse']:>8.4f} {s['accuracy']:>8.3%} {s['macro_f1']:>8.4f} "
+                  f"{s['kappa']:>8.4f} {s['brier_mc']:>8.4f} {s['log_loss']:>8.4f}")
+
+    print("--- Per grade (forecast) ---")
+    print_per_class(model)
+    print("--- Confusion matrix (rows: truth, columns: forecast, label order above) ---")
+    print(model.confusion)
 
     # ── histogram ─────────────────────────────────────────────────────────────
-    truth_cnt = collections.Counter(truth_map.values())
-    pred_cnt  = collections.Counter(pred_map.values())
+    truth_cnt = collections.Counter(t for t, _ in pairs)
+    pred_cnt  = collections.Counter(pred_grades)
     x = range(len(LABELS))
     plt.figure(figsize=(8,4))
     plt.bar(x,                   [truth_cnt[l] for l in LABELS],
@@ -129,9 +348,33 @@ def main(truth, forecasts):
     # plt.tight_layout()
     # plt.show()
 
+    return {"model": model, "most_common": mode, "random": rand, "intervals": ci,
+            "vs_most_common": vs_mode, "vs_chance": vs_chance, "distributions": proper,
+            "baselines": fitted}
+
 if __name__ == "__main__":
     p = argparse.ArgumentParser(description="Evaluate grade forecasts")
     p.add_argument("--truth", default="../data/abstract_outcome_grades.yaml")
-    p.add_argument("--forecasts", default="../data/abstract_outcome_forecasts.yaml")
+    p.add_argument("--forecasts", nargs="+", default=["../data/abstract_outcome_forecasts.yaml"],
+                   help="forecast file(s); several files or globs produce a leaderboard")
+    p.add_argument("--db", metavar="PATH", default=None,
+                   help="join grades and forecasts from this SQLite store instead of the YAML files")
+    p.add_argument("--seed", type=int, default=SEED, help="seed for the resampling")
+    p.add_argument("--resamples", type=int, default=RESAMPLES,
+                   help="bootstrap / permutation resamples (default %(default)s)")
+    p.add_argument("--leaderboard", metavar="OUT", nargs="?", const="", default=None,
+                   help="leaderboard mode even for one file; write it to OUT (.csv, .json or .md)")
+    p.add_argument("--sort", default="accuracy",
+                   choices=COLUMNS + [f"{c}_own" for c in COLUMNS],
+                   help="leaderboard column to rank by (default %(default)s)")
+    p.add_argument("--jobs", type=int, default=None,
+                   help=f"processes loading forecast files (default: one per file from {PARALLEL_FROM} files)")
+    p.add_argument("--baselines", action="store_true",
+                   help="also score the non-LLM base-rate and kNN forecasters (baselines.py)")
     args = p.parse_args()
-    main(args.truth, args.forecasts)
\ No newline at end of file
+    forecasts = expand_paths(args.forecasts)
+    if len(forecasts) > 1 or args.leaderboard is not None:
+        rows = leaderboard(args.truth, forecasts, args.db, args.jobs, args.sort)
+        print(write_leaderboard(rows, args.leaderboard))
+    else:
+        main(args.truth, forecasts[0], args.db, args.seed, args.resamples, args.baselines)
\ No newline at end of file
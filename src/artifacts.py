@@ -0,0 +1,312 @@
+"""
+Normalized on-disk layout for abstract_extractions.yaml.
+
+The old layout is a plain YAML list where every row carries the full
+``abstract`` and the full ``query``, and the query embeds the abstract
+again.  The normalized layout stores each piece of text once:
+
+    format:    normalized/1
+    templates: {template_id: prompt template with an {abstract} slot}
+    abstracts: {record_id: abstract}
+    rows:
+      - record_id, kind, term, template, params, response
+
+A row's prompt is ``templates[template].format(abstract=…, **params)``.
+Template IDs carry a short hash of the template text, so rows asked with an
+older wording keep pointing at the template they were actually sent with.
+
+``read_rows()`` is the compatibility reader: it accepts either layout and
+returns the old row dicts (``query`` and ``abstract`` rebuilt), or the rows
+without that text when ``text=False``.  ``iter_rows()`` / ``write_rows()``
+do the same one row at a time; in the normalized layout only the
+``templates`` and ``abstracts`` head is held in memory.  A path ending in
+``.zst`` is zstd-compressed; that needs the optional ``zstandard`` package.
+"""
+import hashlib
+import io
+import shutil
+import textwrap
+from pathlib import Path
+
+import yaml
+
+import yaml_cache
+
+FORMAT = "normalized/1"
+
+# Wrapper used by stage 2 for every prompt; lets legacy rows be normalized too.
+ABSTRACT_SUFFIX = '\n\nAbstract:\n"""\n{abstract}\n"""'
+QUESTION_TEMPLATE = "{question}" + ABSTRACT_SUFFIX
+QUESTION_TEMPLATE_ID = "question"
+
+LEGACY_KEYS = ("record_id", "kind", "term", "query", "abstract", "response")
+
+
+def template_id(name: str, text: str) -> str:
+    """``outcome-1a2b3c4d``: name plus a hash of the template text."""
+    return f"{name}-{hashlib.sha256(text.encode('utf-8')).hexdigest()[:8]}"
+
+
+def render(template: str, abstract: str, params: dict) -> str:
+    return template.format(abstract=abstract, **params)
+
+
+# ---------- normalize / expand ----------
+
+def _legacy_question(query: str, abstract: str) -> str | None:
+    """The question part of a ``question + abstract`` prompt, if it is one."""
+    suffix = ABSTRACT_SUFFIX.format(abstract=abstract)
+    if query.endswith(suffix):
+        return query[:-len(suffix)]
+    return None
+
+
+def _normalize_row(row: dict, templates: dict) -> tuple[dict, str | None]:
+    """(row without abstract/query, its abstract); may add to ``templates``."""
+    row = dict(row)
+    abstract = row.pop("abstract", None)
+    query = row.pop("query", None)
+    if row.get("template") not in templates:
+        row.pop("template", None)
+        row.pop("params", None)
+        question = (_legacy_question(query, abstract)
+                    if query is not None and abstract is not None else None)
+        if question is not None:
+            templates.setdefault(QUESTION_TEMPLATE_ID, QUESTION_TEMPLATE)
+            row["template"] = QUESTION_TEMPLATE_ID
+            row["params"] = {"question": question}
+        elif query is not None:
+            row["query"] = query
+    return row, abstract
+
+
+def normalize(rows, templates: dict | None = None) -> dict:
+    """Fold old-style rows into the normalized layout.
+
+    ``templates`` maps template IDs to their text; rows that already carry a
+    known ``template`` drop their ``query``.  Rows without one (written before
+    this layout existed) are rewritten to the generic question template when
+    their prompt has the usual shape, and keep their ``query`` otherwise.
+    """
+    templates = dict(templates or {})
+    abstracts, out = {}, []
+    for row in rows:
+        row, abstract = _normalize_row(row, templates)
+        if abstract is not None:
+            if abstracts.setdefault(row["record_id"], abstract) != abstract:
+                row["abstract"] = abstract      # differs from the record's; keep inline
+        out.append(row)
+
+    used = {r["template"] for r in out if "template" in r}
+    return {
+        "format": FORMAT,
+        "templates": {tid: text for tid, text in templates.items() if tid in used},
+        "abstracts": abstracts,
+        "rows": out,
+    }
+
+
+def expand(doc: dict, text: bool = True):
+    """Yield the old row dicts from a normalized document.
+
+    With ``text=False`` the rows are yielded as stored, without rebuilding
+    ``abstract`` and ``query`` (enough for stages that only read responses).
+    """
+    templates, abstracts = doc.get("templates") or {}, doc.get("abstracts") or {}
+    for row in doc.get("rows") or []:
+        if not text:
+            yield row
+            continue
+        abstract = row.get("abstract", abstracts.get(row["record_id"]))
+        query = row.get("query")
+        if query is None and row.get("template") in templates and abstract is not None:
+            query = render(templates[row["template"]], abstract, row.get("params") or {})
+        full = {k: row.get(k) for k in LEGACY_KEYS}
+        full["query"], full["abstract"] = query, abstract
+        full.update((k, v) for k, v in row.items() if k not in full)
+        yield full
+
+
+# ---------- files ----------
+
+def _open_text(path: Path):
+    if path.suffix == ".zst":
+        raw = _zstd().ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        return io.TextIOWrapper(raw, encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def _open_write(path: Path, compress: bool = False):
+    f = open(path, "wb")
+    if compress:
+        f = _zstd().ZstdCompressor(level=10).stream_writer(f, closefd=True)
+    return io.TextIOWrapper(f, encoding="utf-8")
+
+
+def _read_bytes(path: Path) -> bytes:
+    data = path.read_bytes()
+    if path.suffix == ".zst":
+        data = _zstd().ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def _write_bytes(path: Path, data: bytes) -> None:
+    if path.suffix == ".zst":
+        data = _zstd().ZstdCompressor(level=10).compress(data)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    tmp.replace(path)
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise SystemExit("Reading or writing .zst artifacts needs the 'zstandard' package "
+                         "(pip install zstandard)")
+    return zstandard
+
+
+def load(path):
+    """Parsed file contents: a legacy list, a normalized dict, or None if missing."""
+    path = Path(path)
+    if not path.exists():
+        return None
+    return yaml_cache.cached(path, _parse)
+
+
+def _parse(path: Path):
+    return yaml.load(_read_bytes(path).decode("utf-8"), Loader=yaml_cache.Loader)
+
+
+def read_head(path) -> dict | None:
+    """``format``, ``templates`` and ``abstracts`` of a normalized artifact,
+    without its rows; None for a legacy list or a missing file."""
+    path = Path(path)
+    if not path.exists():
+        return None
+    lines = []
+    with _open_text(path) as f:
+        first = f.readline()
+        if first.strip() != f"format: {FORMAT}":
+            return None
+        lines.append(first)
+        for line in f:
+            if line.startswith("rows:"):
+                break
+            lines.append(line)
+    head = yaml.load("".join(lines), Loader=yaml_cache.Loader)
+    head["templates"] = head.get("templates") or {}
+    head["abstracts"] = head.get("abstracts") or {}
+    return head
+
+
+def read_templates(path) -> dict:
+    head = read_head(path)
+    return head["templates"] if head else {}
+
+
+def iter_rows(path, text: bool = True):
+    """Streaming ``read_rows()``: yield rows one at a time, in either layout."""
+    path = Path(path)
+    head = read_head(path)
+    if head is None:
+        yield from yaml_cache.iter_list(path, opener=_open_text)
+        return
+    rows = yaml_cache.iter_list(path, key="rows", opener=_open_text)
+    yield from expand({**head, "rows": rows}, text)
+
+
+def read_doc(path, templates: dict | None = None) -> dict:
+    """The artifact at ``path`` as a normalized document (legacy files are converted)."""
+    data = load(path)
+    if isinstance(data, dict) and data.get("format") == FORMAT:
+        return data
+    return normalize(data or [], templates)
+
+
+def read_rows(path, default=None, text: bool = True) -> list:
+    """Compatibility reader: the old list of row dicts, whatever the layout."""
+    data = load(path)
+    if data is None:
+        return default
+    if isinstance(data, dict) and data.get("format") == FORMAT:
+        return list(expand(data, text))
+    return data or default
+
+
+def write_doc(path, doc: dict) -> None:
+    """Atomically write a normalized document (zstd-compressed for ``.zst``)."""
+    text = yaml.safe_dump(doc, allow_unicode=True, sort_keys=False)
+    _write_bytes(Path(path), text.encode("utf-8"))
+
+
+def _dump(data) -> str:
+    return yaml.dump(data, Dumper=yaml_cache.Dumper, allow_unicode=True, sort_keys=False)
+
+
+def write_rows(path, rows, templates: dict | None = None) -> int:
+    """Normalize ``rows`` (any iterable) against ``templates`` and write them
+    to ``path``, streaming: rows and first-seen abstracts are spooled to two
+    temporary files and joined behind the head once every row is known.
+    Returns the number of rows written.
+    """
+    path = Path(path)
+    templates = dict(templates or {})
+    rows_tmp = path.with_name(path.name + ".rows.tmp")
+    abstracts_tmp = path.with_name(path.name + ".abstracts.tmp")
+    seen, used = {}, set()          # record_id → hash of its abstract; template IDs
+
+    def packed():
+        for row in rows:
+            row, abstract = _normalize_row(row, templates)
+            rid = row["record_id"]
+            if abstract is not None:
+                digest = hashlib.sha1(abstract.encode("utf-8")).digest()
+                if rid not in seen:
+                    seen[rid] = digest
+                    abstracts.write(textwrap.indent(_dump({rid: abstract}), "  "))
+                elif seen[rid] != digest:
+                    row["abstract"] = abstract  # differs from the record's; keep inline
+            if "template" in row:
+                used.add(row["template"])
+            yield row
+
+    with open(rows_tmp, "w", encoding="utf-8") as rows_f, \
+         open(abstracts_tmp, "w", encoding="utf-8") as abstracts:
+        count = yaml_cache.write_items(rows_f, packed())
+
+    head = {"format": FORMAT,
+            "templates": {tid: text for tid, text in templates.items() if tid in used}}
+    tmp = path.with_name(path.name + ".tmp")
+    with _open_write(tmp, compress=path.suffix == ".zst") as out:
+        out.write(_dump(head))
+        out.write("abstracts:\n" if seen else "abstracts: {}\n")
+        with open(abstracts_tmp, "r", encoding="utf-8") as f:
+            shutil.copyfileobj(f, out)
+        out.write("rows:\n" if count else "rows: []\n")
+        with open(rows_tmp, "r", encoding="utf-8") as f:
+            shutil.copyfileobj(f, out)
+    tmp.replace(path)
+    rows_tmp.unlink()
+    abstracts_tmp.unlink()
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+    p = argparse.ArgumentParser(description="Convert abstract_extractions between the legacy and normalized layouts")
+    p.add_argument("src", help="input artifact (either layout; .zst for compressed)")
+    p.add_argument("dst", help="output artifact (.zst for compressed)")
+    p.add_argument("--legacy", action="store_true",
+                   help="write the old one-list-of-full-rows layout instead")
+    args = p.parse_args()
+    doc = read_doc(args.src)
+    if args.legacy:
+        text = yaml.safe_dump(list(expand(doc)), allow_unicode=True, sort_keys=False)
+        _write_bytes(Path(args.dst), text.encode("utf-8"))
+    else:
+        write_doc(args.dst, doc)
+    before, after = Path(args.src).stat().st_size, Path(args.dst).stat().st_size
+    print(f"{args.src} ({before / 1e6:.1f} MB) → {args.dst} ({after / 1e6:.1f} MB), "
+          f"{len(doc['rows'])} rows, {len(doc['abstracts'])} abstracts")
@@ -0,0 +1,253 @@
+"""
+Non-LLM baseline forecasters for the outcome grades.
+
+Both predict a distribution over the five grades for every graded
+(record_id, term) and are scored by leave-one-record-out: nothing a
+record's own grades contributed is used to predict them.
+
+  base rate   grade frequencies of the same outcome term, backed off to the
+              record's intervention categories (the 3ie ``interventions``
+              list of impact_records.yaml, kept by every query profile) and
+              then to the global prior; each level is shrunk towards the
+              next with ``BACKOFF`` pseudo-counts
+  kNN         the ``K`` records whose intervention text (stage 2's
+              extraction) is most similar (TF-IDF cosine), their grades
+              weighted by similarity, plus the global prior with ``BACKOFF``
+              pseudo-counts
+
+Missing inputs are reported: without categories the base rate backs off
+from the term straight to the global prior, and without intervention texts
+kNN is not scored at all (it would only repeat the global prior).
+
+Everything is array arithmetic on counts and one chunked similarity
+product, so the whole grades file is evaluated in seconds and costs no API
+calls.  ``python baselines.py`` prints the scores; stage 5 shows them next
+to the model with ``--baselines``.
+"""
+import time
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+import metrics
+import yaml_cache
+from artifacts import iter_rows
+from record_ids import record_id
+from retrieval import normalize_term, tokenize
+
+GRADES       = "abstract_outcome_grades.yaml"
+EXTRACTIONS  = "abstract_extractions.yaml"
+RECORDS      = "impact_records.yaml"
+LABELS = ["outcome was worsened", "no effect", "neutral/mixed results",
+          "significant", "very significant"]      # stage 5's order
+SCORES = [0.00, 0.25, 0.50, 0.75, 1.00]
+CATEGORY_FIELD = "interventions"   # list of 3ie intervention categories per record
+BACKOFF      = 2.0      # pseudo-counts pulling each level towards the next
+K            = 10       # neighbours for the kNN forecaster
+MAX_FEATURES = 4096     # most frequent words kept for TF-IDF
+MIN_DF       = 2        # words in fewer documents are dropped
+CHUNK        = 1024     # rows of the similarity matrix computed at a time
+
+
+@dataclass
+class Dataset:
+    keys: list              # (record_id, term) per graded outcome
+    y: np.ndarray           # grade index per outcome
+    record: np.ndarray      # record index per outcome
+    term: np.ndarray        # normalized-term index per outcome
+    category_record: np.ndarray   # (record index, category index) pairs,
+    category: np.ndarray          # one pair per category a record lists
+    texts: list             # intervention text per record ("" = none)
+
+    @property
+    def n_categories(self) -> int:
+        return int(self.category.max()) + 1 if len(self.category) else 0
+
+
+def load(grades=GRADES, extractions=EXTRACTIONS, records=RECORDS) -> Dataset:
+    """Graded outcomes with a valid grade, plus their records' categories and texts."""
+    index = {label: i for i, label in enumerate(LABELS)}
+    keys, y, record_of, term_of = [], [], {}, {}
+    rec_idx, term_idx = [], []
+    for row in yaml_cache.iter_list(grades):
+        grade = str(row.get("grade") or "").strip().lower()
+        if grade not in index:
+            continue
+        rid, term = row["record_id"], normalize_term(row["term"])
+        keys.append((rid, row["term"]))
+        y.append(index[grade])
+        rec_idx.append(record_of.setdefault(rid, len(record_of)))
+        term_idx.append(term_of.setdefault(term, len(term_of)))
+
+    pairs, category_of = set(), {}
+    if records and Path(records).exists():
+        for rec in yaml_cache.iter_list(records):
+            if not isinstance(rec, dict) or record_id(rec) not in record_of:
+                continue
+            names = rec.get(CATEGORY_FIELD) or []
+            for name in [names] if isinstance(names, str) else names:
+                if str(name).strip():
+                    pairs.add((record_of[record_id(rec)],
+                               category_of.setdefault(str(name).strip().lower(), len(category_of))))
+    pairs = sorted(pairs)
+    texts = dict.fromkeys(record_of, "")
+    if extractions and Path(extractions).exists():
+        for row in iter_rows(extractions, text=False):
+            if row.get("kind") == "intervention" and row.get("record_id") in texts \
+                    and isinstance(row.get("response"), str):
+                texts[row["record_id"]] = row["response"]
+    return Dataset(keys, np.array(y, dtype=np.int64), np.array(rec_idx, dtype=np.int64),
+                   np.array(term_idx, dtype=np.int64),
+                   np.array([r for r, _ in pairs], dtype=np.int64),
+                   np.array([c for _, c in pairs], dtype=np.int64),
+                   list(texts.values()))
+
+
+def coverage(data: Dataset) -> tuple[int, int]:
+    """(records with a category, records with an intervention text)."""
+    return len(np.unique(data.category_record)), sum(1 for t in data.texts if t.strip())
+
+
+# ---------- forecasters ----------
+
+def _counts(index: np.ndarray, y: np.ndarray, size: int) -> np.ndarray:
+    """(size, k) grade counts per group."""
+    k = len(LABELS)
+    return np.bincount(index * k + y, minlength=size * k).reshape(size, k).astype(float)
+
+
+def _shrink(counts: np.ndarray, prior: np.ndarray, strength: float) -> np.ndarray:
+    """(counts + strength·prior) / (n + strength), row by row."""
+    return (counts + strength * prior) / (counts.sum(axis=1, keepdims=True) + strength)
+
+
+def global_prior(data: Dataset) -> np.ndarray:
+    """(n, k) leave-one-record-out grade frequencies over all other records."""
+    own = _counts(data.record, data.y, len(data.texts))[data.record]
+    return _shrink(np.bincount(data.y, minlength=len(LABELS)) - own,
+                   np.full(len(LABELS), 1 / len(LABELS)), BACKOFF)
+
+
+def base_rate(data: Dataset, backoff: float = BACKOFF) -> np.ndarray:
+    """(n, k) term → category → global base rates, leave-one-record-out.
+
+    A record listing several categories pools their counts.
+    """
+    n_records = len(data.texts)
+    profile = _counts(data.record, data.y, n_records)       # grades per record
+    prior = global_prior(data)
+
+    cat_counts = np.zeros((data.n_categories, len(LABELS)))
+    np.add.at(cat_counts, data.category, profile[data.category_record])
+    pooled = np.zeros_like(profile)                          # other records' grades
+    np.add.at(pooled, data.category_record,
+              cat_counts[data.category] - profile[data.category_record])
+    has = np.bincount(data.category_record, minlength=n_records)[data.record] > 0
+    by_category = np.where(has[:, None], _shrink(pooled[data.record], prior, backoff), prior)
+
+    # terms that normalize alike ("Income", "income ") can occur twice in a
+    # record, so drop all of the record's grades of the term, not just the row
+    n_terms = data.term.max() + 1
+    _, pair = np.unique(data.record * n_terms + data.term, return_inverse=True)
+    own = _counts(pair, data.y, pair.max() + 1)[pair]
+    term_counts = _counts(data.term, data.y, n_terms)[data.term] - own
+    return _shrink(term_counts, by_category, backoff)
+
+
+def tfidf_matrix(texts: list, max_features: int = MAX_FEATURES, min_df: int = MIN_DF) -> np.ndarray:
+    """(documents, words) L2-normalized sublinear TF-IDF, dense float32."""
+    docs = [Counter(tokenize(t)) for t in texts]
+    df = Counter(w for d in docs for w in d)
+    vocab = [w for w, n in df.most_common(max_features) if n >= min_df]
+    column = {w: j for j, w in enumerate(vocab)}
+    X = np.zeros((len(texts), len(vocab)), dtype=np.float32)
+    for i, d in enumerate(docs):
+        for w, tf in d.items():
+            if w in column:
+                X[i, column[w]] = 1 + np.log(tf)
+    idf = np.log((1 + len(texts)) / (1 + np.array([df[w] for w in vocab], dtype=np.float32))) + 1
+    X *= idf
+    X /= np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+    return X
+
+
+def knn(data: Dataset, k: int = K, backoff: float = BACKOFF) -> np.ndarray:
+    """(n, k) similarity-weighted grades of each record's ``k`` nearest other records."""
+    n_records = len(data.texts)
+    profile = _counts(data.record, data.y, n_records)       # grades per record
+    X = tfidf_matrix(data.texts)
+    votes = np.zeros_like(profile)
+    k = min(k, n_records - 1)
+    if k > 0 and X.shape[1]:
+        for start in range(0, n_records, CHUNK):
+            sims = X[start:start + CHUNK] @ X.T
+            rows = np.arange(len(sims))
+            sims[rows, start + rows] = -np.inf                   # leave the record itself out
+            top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            weights = np.maximum(np.take_along_axis(sims, top, axis=1), 0)
+            votes[start:start + CHUNK] = np.einsum("rk,rkg->rg", weights, profile[top])
+    return _shrink(votes[data.record], global_prior(data), backoff)
+
+
+FORECASTERS = {"global prior": global_prior, "base rate": base_rate, "kNN tf-idf": knn}
+
+
+# ---------- evaluation ----------
+
+def score(data: Dataset, probs: np.ndarray, rows=None) -> dict:
+    """Point metrics of the modal grade plus multi-class Brier and log-loss."""
+    rows = np.arange(len(data.y)) if rows is None else np.asarray(rows)
+    y, p = data.y[rows], probs[rows]
+    m = metrics.evaluate(y, p.argmax(axis=1), SCORES, LABELS)
+    return {"n": m.n, "accuracy": m.accuracy, "rmse": m.rmse, "macro_f1": m.macro_f1,
+            "kappa": m.kappa, "brier_mc": metrics.multiclass_brier(y, p),
+            "log_loss": metrics.log_loss(y, p)}
+
+
+def available(data: Dataset, forecasters: dict = FORECASTERS) -> dict:
+    """The forecasters that ``data`` has inputs for, warning about what is missing."""
+    with_category, with_text = coverage(data)
+    n = len(data.texts)
+    if with_category < n:
+        print(f"Warning: {n - with_category} of {n} records have no intervention category "
+              f"({CATEGORY_FIELD} in {RECORDS}); their base rate backs off to the global prior")
+    if with_text < n:
+        print(f"Warning: {n - with_text} of {n} records have no intervention text "
+              f"(from {EXTRACTIONS}); kNN gives them the global prior")
+    if not with_text:
+        print("Warning: no intervention texts at all; kNN is not scored")
+        return {name: f for name, f in forecasters.items() if name != "kNN tf-idf"}
+    return dict(forecasters)
+
+
+def evaluate_all(data: Dataset, rows=None) -> dict:
+    """{forecaster: score()} for every forecaster ``available()`` for ``data``."""
+    return {name: score(data, forecaster(data), rows)
+            for name, forecaster in available(data).items()}
+
+
+if __name__ == "__main__":
+    import argparse
+    p = argparse.ArgumentParser(description="Leave-one-record-out scores of the non-LLM baseline forecasters")
+    p.add_argument("--grades", default=GRADES)
+    p.add_argument("--extractions", default=EXTRACTIONS, help="intervention texts for kNN")
+    p.add_argument("--records", default=RECORDS,
+                   help=f"record {CATEGORY_FIELD} (intervention categories) for the base rates")
+    p.add_argument("-k", type=int, default=K, help="neighbours for kNN")
+    args = p.parse_args()
+
+    started = time.perf_counter()
+    data = load(args.grades, args.extractions, args.records)
+    if not len(data.y):
+        raise SystemExit(f"No valid grades in {args.grades}")
+    print(f"{len(data.y)} graded outcomes, {len(data.texts)} records, "
+          f"{data.term.max() + 1} distinct terms")
+    forecasters = available(data, dict(FORECASTERS, **{"kNN tf-idf": lambda d: knn(d, args.k)}))
+    print(f"{'Forecaster':<14} {'Acc':>7} {'RMSE':>7} {'MacroF1':>7} {'Kappa':>7} {'Brier':>7} {'LogLoss':>7}")
+    for name, forecaster in forecasters.items():
+        s = score(data, forecaster(data))
+        print(f"{name:<14} {s['accuracy']:>7.3%} {s['rmse']:>7.4f} {s['macro_f1']:>7.4f} "
+              f"{s['kappa']:>7.4f} {s['brier_mc']:>7.4f} {s['log_loss']:>7.4f}")
+    print(f"Done in {time.perf_counter() - started:.1f} s")
@@ -0,0 +1,304 @@
+"""
+Offline Batch API submission for the grading and forecasting stages.
+
+All pending prompts are written to a JSONL batch input file, submitted in
+one go, polled until the batch finishes and turned back into
+``llm_runner.Result`` objects in the original job order.
+
+Two backends share the same small interface (submit / status / download):
+
+OpenAIBatchBackend – the real ``/v1/batches`` endpoint
+LocalBatchBackend  – a file-based stand-in that "completes" a batch by
+                     answering every request with a canned reply, so the
+                     whole path can be exercised offline
+
+Prompts already answered in the shared ``LLMCache`` are not submitted, and
+batch answers are written back to the cache.
+
+The id of a submitted batch is kept in a state file in the stage's batch
+directory, with its prompts, model, system message and parameters, so an
+interrupted run resumes polling instead of resubmitting.  A resumed batch
+that does not cover the current jobs (another mode or record set) still
+has all its answers saved to the cache; the rest go into a new batch.
+"""
+import dataclasses
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+
+from llm_cache import cache_key
+from llm_runner import Job, Result, cache_text, cached_result
+
+ENDPOINT      = "/v1/chat/completions"
+POLL_INTERVAL = 60          # seconds between status checks
+DONE_STATES   = {"completed", "failed", "expired", "cancelled"}
+
+
+# ---------- batch files ----------
+
+def request_line(custom_id: str, model: str, system: str, prompt: str,
+                 params: dict) -> dict:
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": ENDPOINT,
+        "body": {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system},
+                {"role": "user",   "content": prompt},
+            ],
+            **params,
+        },
+    }
+
+
+def write_batch_input(path, jobs, model: str, system: str, params: dict) -> int:
+    """Write one request line per job; ``custom_id`` is the job's index."""
+    n = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for n, job in enumerate(jobs, start=1):
+            line = request_line(str(n - 1), model, system, job.prompt, params)
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    return n
+
+
+def read_batch_output(path) -> dict:
+    """Map ``custom_id`` → (text | None, error | None, usage | None, finish_reason | None,
+    samples | None); samples lists every choice when the request asked for several."""
+    out = {}
+    if not path or not Path(path).exists():
+        return out
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            resp = item.get("response") or {}
+            body = resp.get("body") or {}
+            if item.get("error") or resp.get("status_code") != 200:
+                err = item.get("error") or body.get("error") or resp.get("status_code")
+                out[item["custom_id"]] = (None, RuntimeError(f"batch request failed: {err}"),
+                                          None, None, None)
+                continue
+            texts = [(c["message"]["content"] or "").strip() for c in body["choices"]]
+            reasons = [c.get("finish_reason") for c in body["choices"]]
+            out[item["custom_id"]] = (texts[0], None, body.get("usage"),
+                                      "length" if "length" in reasons else reasons[0],
+                                      texts if len(texts) > 1 else None)
+    return out
+
+
+# ---------- backends ----------
+
+class OpenAIBatchBackend:
+    def __init__(self, client=None):
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.client = client
+
+    def submit(self, input_path) -> str:
+        with open(input_path, "rb") as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=uploaded.id,
+                                           endpoint=ENDPOINT,
+                                           completion_window="24h")
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def download(self, batch_id: str, out_path) -> None:
+        batch = self.client.batches.retrieve(batch_id)
+        with open(out_path, "w", encoding="utf-8") as f:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    f.write(self.client.files.content(file_id).text)
+
+
+class LocalBatchBackend:
+    """Stand-in for the batch endpoint that works on a local directory.
+
+    ``submit`` copies the input file to ``root/<batch_id>/input.jsonl``;
+    the first ``status`` call answers every request with ``reply`` and
+    writes ``output.jsonl`` in the same format the real endpoint uses.
+    """
+
+    def __init__(self, root, reply: str = "No information"):
+        self.root = Path(root)
+        self.reply = reply
+
+    def submit(self, input_path) -> str:
+        batch_id = f"local_batch_{uuid.uuid4().hex[:12]}"
+        folder = self.root / batch_id
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / "input.jsonl").write_bytes(Path(input_path).read_bytes())
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        folder = self.root / batch_id
+        if not (folder / "output.jsonl").exists():
+            self._process(folder)
+        return "completed"
+
+    def download(self, batch_id: str, out_path) -> None:
+        Path(out_path).write_bytes((self.root / batch_id / "output.jsonl").read_bytes())
+
+    def _process(self, folder: Path) -> None:
+        tmp = folder / "output.jsonl.tmp"
+        with open(folder / "input.jsonl", "r", encoding="utf-8") as src, \
+                open(tmp, "w", encoding="utf-8") as dst:
+            for line in src:
+                if not line.strip():
+                    continue
+                req = json.loads(line)
+                reply = {
+                    "id": f"local_req_{uuid.uuid4().hex[:12]}",
+                    "custom_id": req["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {
+                            "model": req["body"]["model"],
+                            "choices": [{"index": i, "finish_reason": "stop",
+                                         "message": {"role": "assistant",
+                                                     "content": self.reply}}
+                                        for i in range(req["body"].get("n", 1))],
+                        },
+                    },
+                    "error": None,
+                }
+                dst.write(json.dumps(reply, ensure_ascii=False) + "\n")
+        tmp.replace(folder / "output.jsonl")
+
+
+# ---------- driver ----------
+
+def run_batch(backend, jobs, model: str, system: str, workdir,
+              poll_interval: float = POLL_INTERVAL, temperature: float = 0,
+              cache=None, response_format: dict | None = None, n: int = 1,
+              accept=None):
+    """Submit ``jobs`` as one batch (or resume the one already in flight),
+    wait for it and return a ``Result`` per job, in job order.
+
+    ``accept`` works as for ``LLMRunner``: only answers it accepts are
+    cached, and cached answers it rejects go into the batch again.
+    """
+    jobs   = list(jobs)
+    params = {"temperature": temperature}
+    if n > 1:
+        params["n"] = n
+    if response_format is not None:
+        params["response_format"] = response_format
+    cached = {}
+    if cache is not None:
+        for i, job in enumerate(jobs):
+            hit = cache.get(cache_key(model, system, job.prompt, params))
+            if hit is not None:
+                result = cached_result(job, hit, n)
+                if accept is None or accept(result):
+                    cached[i] = result
+    misses = [job for i, job in enumerate(jobs) if i not in cached]
+
+    def keep(result, model, system, params):
+        # answers for other jobs: ``accept`` needs their job, so they are
+        # checked when a later run reads them from the cache instead
+        if cache is not None and result.error is None and result.finish_reason != "length":
+            cache.put(cache_key(model, system, result.job.prompt, params),
+                      model, cache_text(result), result.usage)
+
+    batched = _run_uncached(backend, misses, model, system, workdir,
+                            poll_interval, params, keep)
+    if cache is not None:
+        for result in batched:
+            if result.error is None and result.finish_reason != "length" \
+                    and (accept is None or accept(result)):
+                cache.put(cache_key(model, system, result.job.prompt, params),
+                          model, cache_text(result), result.usage)
+    by_job = {id(r.job): r for r in batched}
+    return [cached[i] if i in cached else by_job[id(job)]
+            for i, job in enumerate(jobs)
+            if i in cached or id(job) in by_job]
+
+
+def _run_uncached(backend, jobs, model: str, system: str, workdir,
+                  poll_interval: float, params: dict, keep=None) -> list:
+    """``Result``s for ``jobs`` from a resumed batch and/or a new one, in job order.
+
+    A batch found in flight is always collected.  Its answers go to the
+    jobs that ask the same prompt under the same model, system message and
+    parameters; every other answer is handed to ``keep(result, model,
+    system, params)`` (the cache), so a paid batch from another mode or
+    record set is not thrown away.  Jobs it did not cover go into a new
+    batch.  The state file is removed only after all answers were handed on.
+    """
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+    state_path  = workdir / "batch_state.json"
+    input_path  = workdir / "batch_input.jsonl"
+    output_path = workdir / "batch_output.jsonl"
+    results = {}
+
+    if state_path.exists():
+        state = json.loads(state_path.read_text(encoding="utf-8"))
+        print(f"Resuming batch {state['batch_id']} ({state['n']} requests)")
+        # state files from before the settings were recorded: assume they match
+        settings = (state.get("model", model), state.get("system", system),
+                    state.get("params", params))
+        same = settings == (model, system, params)
+        if not same:
+            print(f"Batch {state['batch_id']} was submitted with other settings; "
+                  f"its answers only go to the cache")
+        wanted = {}
+        for job in jobs if same else []:
+            wanted.setdefault(job.prompt, []).append(job)
+        unmatched = 0
+        for result in _collect(backend, state, output_path, poll_interval):
+            if result.job.prompt in wanted:
+                for job in wanted[result.job.prompt]:
+                    results[id(job)] = dataclasses.replace(result, job=job)
+            else:
+                unmatched += 1
+                if keep is not None:
+                    keep(result, *settings)
+        if unmatched:
+            print(f"{unmatched} answers of batch {state['batch_id']} are for prompts this run "
+                  f"does not ask for; saved to the cache for a later run")
+        state_path.unlink()
+
+    rest = [job for job in jobs if id(job) not in results]
+    if rest:
+        n = write_batch_input(input_path, rest, model, system, params)
+        state = {"batch_id": backend.submit(input_path), "n": n,
+                 "prompts": [job.prompt for job in rest],
+                 "model": model, "system": system, "params": params}
+        state_path.write_text(json.dumps(state), encoding="utf-8")
+        print(f"Submitted batch {state['batch_id']} with {n} requests")
+        for job, result in zip(rest, _collect(backend, state, output_path, poll_interval)):
+            results[id(job)] = dataclasses.replace(result, job=job)
+        state_path.unlink()
+    return [results[id(job)] for job in jobs if id(job) in results]
+
+
+def _collect(backend, state: dict, output_path, poll_interval: float) -> list:
+    """Wait for the batch in ``state`` and return a ``Result`` per prompt, in order.
+
+    The state file remembers which prompt every custom_id belongs to, so a
+    resumed batch is matched to jobs by prompt rather than by position.
+    """
+    while (status := backend.status(state["batch_id"])) not in DONE_STATES:
+        print(f"Batch {state['batch_id']}: {status}; checking again in {poll_interval:g}s")
+        time.sleep(poll_interval)
+    print(f"Batch {state['batch_id']}: {status}")
+
+    backend.download(state["batch_id"], output_path)
+    answers = read_batch_output(output_path)
+    missing = (None, RuntimeError(f"no result in batch ({status})"), None, None, None)
+    results = []
+    for custom_id, prompt in enumerate(state["prompts"]):
+        text, error, usage, finish_reason, samples = answers.get(str(custom_id), missing)
+        results.append(Result(Job(prompt), text, error, usage, finish_reason=finish_reason,
+                              samples=samples))
+    return results
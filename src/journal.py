@@ -0,0 +1,262 @@
+"""
+Append-only JSON-lines journal.
+
+Each line is one JSON object.  Entries are only ever appended, so a crash can
+at worst leave a truncated final line, which ``recover()`` cuts off before the
+journal is reopened.  Replaying the journal keeps the *last* entry seen for a
+key, which lets a later line supersede an earlier one without rewriting the
+file.  ``compact_yaml()`` turns the replayed entries into the YAML artifacts
+the rest of the pipeline reads.
+
+Writes are group-committed: ``Journal`` buffers entries and writes them out
+every ``flush_every`` entries or ``flush_interval`` seconds, whichever comes
+first; ``checkpoint()`` additionally fsyncs.  ``JournaledYaml`` pairs a YAML
+artifact with its ``.jsonl`` journal for stages 2–4: rows are appended to
+the journal as they are produced and folded into the YAML file by an
+explicit ``compact()``.
+"""
+import json
+import os
+import time
+from pathlib import Path
+
+import artifacts
+import yaml_cache
+
+
+def recover(path) -> int:
+    """Truncate a partially written last line.  Returns the bytes dropped."""
+    path = Path(path)
+    if not path.exists():
+        return 0
+    with open(path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return 0
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return 0
+        # walk back to the last complete line
+        pos = size - 1
+        chunk = 4096
+        while pos > 0:
+            start = max(0, pos - chunk)
+            f.seek(start)
+            buf = f.read(pos - start)
+            nl = buf.rfind(b"\n")
+            if nl != -1:
+                pos = start + nl + 1
+                break
+            pos = start
+        f.truncate(pos)
+        return size - pos
+
+
+def iter_journal(path):
+    """Yield every complete entry in the journal, in file order."""
+    path = Path(path)
+    if not path.exists():
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break               # torn write from a crash; ignore it
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def read_journal(path, key) -> dict:
+    """Replay the journal into ``{key(entry): entry}``; later lines win."""
+    return {key(entry): entry for entry in iter_journal(path)}
+
+
+class Journal:
+    """Appends JSON entries to ``path``, one per line, with group commit.
+
+    The defaults (``flush_every=1``) write every entry through immediately.
+    """
+
+    def __init__(self, path, flush_every: int = 1, flush_interval: float | None = None):
+        self.path = Path(path)
+        dropped = recover(self.path)
+        if dropped:
+            print(f"Recovered {self.path}: dropped {dropped} bytes of a torn line")
+        self.f = open(self.path, "a", encoding="utf-8")
+        self.flush_every = max(1, flush_every)
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def append(self, entry: dict) -> None:
+        self.buffer.append(json.dumps(entry, ensure_ascii=False) + "\n")
+        due = (self.flush_interval is not None
+               and time.monotonic() - self.last_flush >= self.flush_interval)
+        if len(self.buffer) >= self.flush_every or due:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write buffered entries to the OS (one write call per group)."""
+        if self.buffer:
+            self.f.write("".join(self.buffer))
+            self.buffer.clear()
+        self.f.flush()
+        self.last_flush = time.monotonic()
+
+    def checkpoint(self) -> None:
+        """Flush and fsync, so everything appended so far survives a power cut."""
+        self.flush()
+        os.fsync(self.f.fileno())
+
+    def truncate(self) -> None:
+        """Drop every entry (after they have been compacted elsewhere)."""
+        self.buffer.clear()
+        self.f.truncate(0)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self) -> None:
+        if not self.f.closed:
+            self.checkpoint()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def compact_yaml(path, items) -> None:
+    """Atomically write ``items`` (any iterable) as a single YAML list."""
+    yaml_cache.write_list(path, items)
+
+
+def journal_path(yaml_path) -> Path:
+    """``abstract_extractions.yaml`` → ``abstract_extractions.jsonl``."""
+    return Path(yaml_path).with_suffix(".jsonl")
+
+
+class JournaledYaml:
+    """A YAML list artifact whose new rows go to an append-only journal.
+
+    Only the row keys are held in memory.  ``values()`` streams the YAML rows
+    that the journal has not superseded, then the journal rows (the last one
+    per key).  ``append()`` is cheap; ``compact()`` streams ``values()`` into
+    a new YAML file once and empties the journal.  ``load(path)`` /
+    ``dump(path, rows)`` override how the artifact itself is read and
+    written (default: a plain YAML list, streamed both ways).
+    """
+
+    def __init__(self, yaml_path, key, load=None, dump=None,
+                 flush_every: int = 50, flush_interval: float | None = 5.0):
+        self.yaml_path = Path(yaml_path)
+        self.journal_path = journal_path(self.yaml_path)
+        self.key = key
+        self.load = load or yaml_cache.iter_list
+        self.dump = dump or compact_yaml
+        self.seen = {key(r) for r in self.load(self.yaml_path)}
+        replayed = 0
+        for row in iter_journal(self.journal_path):
+            self.seen.add(key(row))
+            replayed += 1
+        if replayed:
+            print(f"Replayed {replayed} rows from {self.journal_path}")
+        self.journal = Journal(self.journal_path, flush_every, flush_interval)
+
+    def __contains__(self, k) -> bool:
+        return k in self.seen
+
+    def __len__(self) -> int:
+        return len(self.seen)
+
+    def keys(self) -> list:
+        return list(self.seen)
+
+    def values(self):
+        """Yield every current row: the YAML rows first, then the journal's."""
+        self.journal.flush()
+        last = {}
+        for i, row in enumerate(iter_journal(self.journal_path)):
+            last[self.key(row)] = i
+        for row in self.load(self.yaml_path):
+            if self.key(row) not in last:
+                yield row
+        for i, row in enumerate(iter_journal(self.journal_path)):
+            if last[self.key(row)] == i:
+                yield row
+
+    def append(self, row: dict) -> None:
+        self.seen.add(self.key(row))
+        self.journal.append(row)
+
+    def replace_all(self, rows) -> None:
+        """Replace the whole artifact (e.g. after dropping stale rows) and compact.
+
+        ``rows`` may be a generator over ``values()``; the old file is only
+        replaced once the new one is complete.
+        """
+        self.journal.checkpoint()
+        seen = set()
+
+        def unique():
+            for row in rows:
+                k = self.key(row)
+                if k not in seen:
+                    seen.add(k)
+                    yield row
+
+        self.dump(self.yaml_path, unique())
+        self.journal.truncate()
+        self.seen = seen
+
+    def checkpoint(self) -> None:
+        self.journal.checkpoint()
+
+    def compact(self) -> None:
+        self.replace_all(self.values())
+
+    def close(self, compact: bool = True) -> None:
+        if compact:
+            self.compact()
+        self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # on an exception keep the journal as-is; the next run replays it
+        self.close(compact=exc_type is None)
+
+
+def row_key(row: dict) -> tuple:
+    """Resume key shared by the stage artifacts: (record_id, kind, term).
+
+    Grade and forecast rows have no ``kind``, which simply becomes None.
+    """
+    return row.get("record_id"), row.get("kind"), row.get("term")
+
+
+def open_artifact(path, key=row_key, templates: dict | None = None, **kwargs) -> JournaledYaml:
+    """A ``JournaledYaml`` for any stage artifact; a normalized extraction
+    file is read and written back in the normalized layout.  ``templates``
+    adds prompt templates to keep (and writes the normalized layout)."""
+    head = artifacts.read_head(path)
+    if head is None and templates is None:
+        return JournaledYaml(path, key, **kwargs)
+    templates = {**(head["templates"] if head else {}), **(templates or {})}
+    return JournaledYaml(path, key, load=artifacts.iter_rows,
+                         dump=lambda out, rows: artifacts.write_rows(out, rows, templates),
+                         **kwargs)
+
+
+if __name__ == "__main__":
+    import argparse
+    p = argparse.ArgumentParser(description="Fold a stage's .jsonl journal into its YAML artifact")
+    p.add_argument("yaml_paths", nargs="+", help="YAML artifacts to compact, e.g. abstract_outcome_grades.yaml")
+    args = p.parse_args()
+    for path in args.yaml_paths:
+        artifact = open_artifact(path)
+        artifact.close(compact=True)
+        print(f"Compacted {path}: {len(artifact)} rows")
@@ -0,0 +1,148 @@
+"""
+Content-addressed SQLite cache for chat-completion calls.
+
+The key is a SHA-256 of (model, system message, user prompt, sampling
+parameters), so the same prompt is only ever paid for once – across stages,
+across runs, and across machines that point ``LLM_CACHE_PATH`` at the same
+file.  Each entry stores the raw response text, token usage and latency.
+
+Eviction is explicit: ``evict(max_age_days=…, max_bytes=…)`` drops entries
+older than the age limit and then the least recently used entries until the
+stored responses fit in the size budget.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key        TEXT PRIMARY KEY,
+    model      TEXT NOT NULL,
+    response   TEXT NOT NULL,
+    usage      TEXT,
+    latency    REAL,
+    size       INTEGER NOT NULL,
+    created    REAL NOT NULL,
+    last_used  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used);
+CREATE TABLE IF NOT EXISTS counters (
+    name  TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def cache_key(model: str, system: str, prompt: str, params: dict | None = None) -> str:
+    blob = json.dumps({"model": model, "system": system, "prompt": prompt,
+                       "params": params or {}}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> dict | None:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT response, usage, latency FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            name = "hits" if row else "misses"
+            if row:
+                self.hits += 1
+                self.db.execute("UPDATE responses SET last_used = ? WHERE key = ?",
+                                (time.time(), key))
+            else:
+                self.misses += 1
+            self.db.execute(
+                "INSERT INTO counters(name, value) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+            self.db.commit()
+        if row is None:
+            return None
+        return {"text": row[0], "usage": json.loads(row[1]) if row[1] else None,
+                "latency": row[2]}
+
+    def put(self, key: str, model: str, text: str, usage: dict | None = None,
+            latency: float | None = None) -> None:
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, model, response, usage, latency, size, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, model, text, json.dumps(usage) if usage else None, latency,
+                 len(text.encode("utf-8")), now, now))
+            self.db.commit()
+
+    def evict(self, max_age_days: float | None = None, max_bytes: int | None = None) -> int:
+        """Drop old entries, then least recently used ones over ``max_bytes``."""
+        removed = 0
+        with self.lock:
+            if max_age_days is not None:
+                cutoff = time.time() - max_age_days * 86400
+                removed += self.db.execute(
+                    "DELETE FROM responses WHERE created < ?", (cutoff,)).rowcount
+            if max_bytes is not None:
+                total = self.db.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                rows = self.db.execute(
+                    "SELECT key, size FROM responses ORDER BY last_used").fetchall()
+                doomed = []
+                for key, size in rows:
+                    if total <= max_bytes:
+                        break
+                    doomed.append((key,))
+                    total -= size
+                self.db.executemany("DELETE FROM responses WHERE key = ?", doomed)
+                removed += len(doomed)
+            self.db.commit()
+        return removed
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries, size = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            totals = dict(self.db.execute("SELECT name, value FROM counters"))
+        return {"hits": self.hits, "misses": self.misses, "entries": entries,
+                "bytes": size, "total_hits": totals.get("hits", 0),
+                "total_misses": totals.get("misses", 0)}
+
+    def report(self) -> None:
+        s = self.stats()
+        looked_up = s["hits"] + s["misses"]
+        rate = s["hits"] / looked_up if looked_up else 0.0
+        print(f"LLM cache {self.path}: {s['hits']} hits / {s['misses']} misses "
+              f"({rate:.1%}) this run; {s['entries']} entries, {s['bytes'] / 1e6:.1f} MB")
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    p = argparse.ArgumentParser(description="Inspect or trim the LLM response cache")
+    p.add_argument("--path", default=DEFAULT_PATH)
+    p.add_argument("--max-age", type=float, default=None, metavar="DAYS",
+                   help="drop entries created more than DAYS ago")
+    p.add_argument("--max-mb", type=float, default=None,
+                   help="drop least recently used entries until responses fit in this size")
+    args = p.parse_args()
+    cache = LLMCache(args.path)
+    if args.max_age is not None or args.max_mb is not None:
+        max_bytes = int(args.max_mb * 1e6) if args.max_mb is not None else None
+        print(f"Evicted {cache.evict(args.max_age, max_bytes)} entries")
+    print(json.dumps(cache.stats(), indent=2))
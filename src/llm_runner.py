@@ -0,0 +1,245 @@
+"""
+Shared OpenAI job runner for stages 2, 3 and 4.
+
+Every prompt becomes a ``Job``.  ``LLMRunner.run()`` executes jobs on a
+thread pool and yields a ``Result`` per job **in submission order**, so the
+output files are written in the same order as the old serial loops.
+
+Answers are looked up in, and stored to, the shared ``LLMCache`` first, so an
+identical prompt is never sent twice.  With ``accept`` set, only answers it
+accepts are stored, and a cached answer it rejects is asked for again.
+
+With ``n`` > 1 every request asks for n samples at once (the API's ``n``
+parameter); ``Result.samples`` holds all of them, ``Result.text`` the first.
+The cache stores such an answer as a JSON list of the samples.
+
+Throughput is bounded by
+  • a requests-per-minute and a tokens-per-minute token bucket per model
+    (``MODEL_LIMITS``), and
+  • an adaptive concurrency limit that grows by one slot per window of
+    successful calls and halves on a 429 or a timeout (AIMD).
+"""
+import collections
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import openai
+from openai import OpenAI
+
+from llm_cache import LLMCache, cache_key
+from rate_limit import TokenBucket, retry_after, backoff_delay
+
+# requests/min, tokens/min – keep these at or below the account's tier limits
+MODEL_LIMITS = {
+    "gpt-4.1-mini":       (500, 200_000),
+    "gpt-4.1-2025-04-14": (500,  30_000),
+    "gpt-4.1":            (500,  30_000),
+    "gpt-4o-mini":        (500, 200_000),
+}
+DEFAULT_LIMITS   = (60, 30_000)
+MAX_CONCURRENCY  = 16
+RETRY_LIMIT      = 5
+CHARS_PER_TOKEN  = 4       # rough estimate used to charge the TPM bucket
+OUTPUT_TOKENS    = 512     # expected completion size when max_tokens is unset
+
+THROTTLE_ERRORS  = (openai.RateLimitError, openai.APITimeoutError)
+TRANSIENT_ERRORS = THROTTLE_ERRORS + (openai.APIConnectionError,
+                                      openai.InternalServerError)
+
+
+@dataclass
+class Job:
+    prompt: str
+    meta: dict = field(default_factory=dict)   # whatever the stage needs to save the result
+
+
+@dataclass
+class Result:
+    job: Job
+    text: str | None = None
+    error: Exception | None = None
+    usage: dict | None = None
+    latency: float = 0.0
+    cached: bool = False
+    finish_reason: str | None = None
+    samples: list | None = None      # every choice when n > 1
+
+
+def cached_result(job: Job, hit: dict, n: int = 1) -> Result:
+    """A ``Result`` from an ``LLMCache`` entry (see ``cache_text()``)."""
+    samples = json.loads(hit["text"]) if n > 1 else None
+    return Result(job, samples[0] if samples else hit["text"], usage=hit["usage"],
+                  latency=hit["latency"] or 0.0, cached=True, samples=samples)
+
+
+def cache_text(result: Result) -> str:
+    """What the cache stores for ``result``: the text, or the JSON list of samples."""
+    return result.text if result.samples is None else json.dumps(result.samples, ensure_ascii=False)
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on the number of calls in flight."""
+
+    def __init__(self, start: int = 2, maximum: int = MAX_CONCURRENCY):
+        self.maximum = maximum
+        self.limit = float(max(1, min(start, maximum)))
+        self.in_flight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self) -> None:
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, throttled: bool = False) -> None:
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+
+class LLMRunner:
+    """Runs chat-completion prompts for one model and system message."""
+
+    def __init__(self, model: str, system: str, temperature: float = 0,
+                 response_format: dict | None = None,
+                 max_concurrency: int = MAX_CONCURRENCY,
+                 rpm: int | None = None, tpm: int | None = None,
+                 retry_limit: int = RETRY_LIMIT, client=None, cache=None, n: int = 1,
+                 accept=None):
+        """``cache`` defaults to the shared on-disk cache; pass False to disable it.
+
+        ``accept(result)`` → bool decides whether an answer may be cached
+        (e.g. whether it passes the stage's schema validation).
+        """
+        self.model = model
+        self.system = system
+        self.temperature = temperature
+        self.n = n
+        self.response_format = response_format
+        self.retry_limit = retry_limit
+        self.client = client or OpenAI(api_key=os.getenv("OPENAI_API_KEY"),
+                                       max_retries=0)   # retries are handled here
+        default_rpm, default_tpm = MODEL_LIMITS.get(model, DEFAULT_LIMITS)
+        rpm = rpm or default_rpm
+        tpm = tpm or default_tpm
+        self.requests = TokenBucket(rpm / 60, burst=max(1, rpm // 10))
+        self.tokens = TokenBucket(tpm / 60, burst=max(1, tpm // 10))
+        self.concurrency = AdaptiveConcurrency(maximum=max_concurrency)
+        self.max_workers = max_concurrency
+        self.cache = LLMCache() if cache is None else (cache or None)
+        self.accept = accept
+
+    # ---------- single call ----------
+    def estimate_tokens(self, prompt: str) -> int:
+        return (len(self.system) + len(prompt)) // CHARS_PER_TOKEN + OUTPUT_TOKENS * self.n
+
+    def params(self) -> dict:
+        """Sampling/format parameters sent with every request (part of the cache key)."""
+        params = {"temperature": self.temperature}
+        if self.n > 1:
+            params["n"] = self.n
+        if self.response_format is not None:
+            params["response_format"] = self.response_format
+        return params
+
+    def key(self, prompt: str) -> str:
+        return cache_key(self.model, self.system, prompt, self.params())
+
+    def cacheable(self, result: Result) -> bool:
+        """Whether ``result`` may be stored: no error, not truncated, and accepted."""
+        # truncated answers are not worth keeping; the caller will ask differently
+        return (result.error is None and result.finish_reason != "length"
+                and (self.accept is None or self.accept(result)))
+
+    def call(self, prompt: str, job: Job | None = None) -> Result:
+        job = job or Job(prompt)
+        if self.cache is not None:
+            key = self.key(prompt)
+            hit = self.cache.get(key)
+            if hit is not None:
+                result = cached_result(job, hit, self.n)
+                if self.accept is None or self.accept(result):
+                    return result
+        result = self._call_api(job)
+        if self.cache is not None and self.cacheable(result):
+            self.cache.put(key, self.model, cache_text(result), result.usage, result.latency)
+        return result
+
+    def _call_api(self, job: Job) -> Result:
+        prompt = job.prompt
+        for attempt in range(1, self.retry_limit + 1):
+            self.requests.acquire()
+            self.tokens.acquire(self.estimate_tokens(prompt))
+            self.concurrency.acquire()
+            started = time.monotonic()
+            throttled = False
+            try:
+                resp = self.client.chat.completions.create(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": self.system},
+                        {"role": "user",   "content": prompt}
+                    ],
+                    **self.params()
+                )
+                usage = resp.usage.model_dump() if resp.usage else None
+                texts = [(c.message.content or "").strip() for c in resp.choices]
+                reasons = [c.finish_reason for c in resp.choices]
+                return Result(job, texts[0], usage=usage, latency=time.monotonic() - started,
+                              finish_reason="length" if "length" in reasons else reasons[0],
+                              samples=texts if self.n > 1 else None)
+            except TRANSIENT_ERRORS as e:
+                throttled = isinstance(e, THROTTLE_ERRORS)
+                if attempt == self.retry_limit:
+                    return Result(job, error=RuntimeError(
+                        f"OpenAI call failed after {self.retry_limit} attempts: {e}"))
+                response = getattr(e, "response", None)
+                delay = retry_after(response.headers.get("retry-after")) if response is not None else None
+                if delay is None:
+                    delay = backoff_delay(attempt)
+                if isinstance(e, openai.RateLimitError):
+                    self.requests.pause(delay)
+            except Exception as e:
+                return Result(job, error=RuntimeError(f"OpenAI call failed: {e}"))
+            finally:
+                self.concurrency.release(throttled)
+            time.sleep(delay)
+
+    def ask(self, prompt: str) -> str:
+        """Drop-in replacement for the stages' old ``ask_chatgpt()``."""
+        result = self.call(prompt)
+        if result.error is not None:
+            raise result.error
+        return result.text
+
+    # ---------- many calls ----------
+    def run(self, jobs):
+        """Yield a ``Result`` for every job in ``jobs``, in the same order.
+
+        ``jobs`` may be a generator; at most a few windows of jobs are held
+        in memory at a time.
+        """
+        window = self.max_workers * 4
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for job in jobs:
+                pending.append((job, pool.submit(self.call, job.prompt, job)))
+                if len(pending) >= window:
+                    yield self._finish(*pending.popleft())
+            while pending:
+                yield self._finish(*pending.popleft())
+
+    @staticmethod
+    def _finish(job: Job, future) -> Result:
+        result = future.result()
+        result.job = job
+        return result
@@ -0,0 +1,285 @@
+"""
+Forecast metrics computed from one confusion matrix.
+
+Grades are integer-coded against a fixed label order (``encode()``), the
+pairs are counted into a k×k confusion matrix with a single ``bincount``,
+and every metric is read off that matrix:
+
+  accuracy          trace / n
+  RMSE              over the labels' numeric scores, weighted by the cells
+  Brier (rough)     forecast score vs. "true grade is significant or better"
+  precision/recall  per class, from the column / row sums
+  F1, macro-F1      per class in label order, then their mean
+  weighted kappa    quadratic weights, agreement beyond the marginals
+
+``evaluate()`` returns a ``Metrics`` object; stage 5 prints it, other code
+can use its fields (or ``as_dict()``) directly.
+
+Forecasts that come with a probability per grade (stage 4 ``--samples``)
+are scored by the proper scores ``multiclass_brier()`` and ``log_loss()``
+on an (n, k) matrix from ``probability_matrix()``.
+
+Uncertainty is vectorized over whole stacks of matrices:
+
+  bootstrap()           percentile CIs; resampling n pairs with replacement is
+                        one multinomial draw over the k² cells per resample
+  paired_permutation()  model vs. baseline on the same pairs, swapping the two
+                        forecasts of each pair at random
+  shuffle_test()        model vs. chance, shuffling forecasts across pairs
+
+The two tests build a (resamples × pairs) array per step; the number of
+resamples per step shrinks with the number of pairs so that array stays
+within ``MAX_CELLS`` entries.
+
+All take a ``numpy.random.Generator`` so a fixed seed reproduces the output.
+"""
+import math
+from dataclasses import dataclass
+
+import numpy as np
+
+SIGNIFICANT = 0.75      # score from which a true grade counts as a "hit" for Brier
+METRIC_NAMES = ("accuracy", "rmse", "brier", "macro_f1", "kappa")
+LOWER_IS_BETTER = {"rmse", "brier"}
+CHUNK = 20_000          # most resamples evaluated per vectorized step
+MAX_CELLS = 1 << 24     # most (resample × pair) entries built per step (~128 MB of float64)
+
+
+def encode(grades, labels) -> np.ndarray:
+    """Label indices for ``grades``; -1 for anything not in ``labels`` (or None)."""
+    index = {label: i for i, label in enumerate(labels)}
+    return np.fromiter((index.get(g, -1) for g in grades), dtype=np.int64)
+
+
+def confusion_matrix(y_true: np.ndarray, y_pred: np.ndarray, k: int) -> np.ndarray:
+    """``C[i, j]`` = number of pairs with true label i and forecast j.
+
+    Pairs where either side is -1 (invalid or missing) are left out.
+    """
+    ok = (y_true >= 0) & (y_pred >= 0)
+    return np.bincount(y_true[ok] * k + y_pred[ok], minlength=k * k).reshape(k, k)
+
+
+def _ratio(num: np.ndarray, den: np.ndarray) -> np.ndarray:
+    """num / den, with 0 where den is 0 (the convention the old report used)."""
+    out = np.zeros_like(num, dtype=float)
+    np.divide(num, den, out=out, where=den != 0)
+    return out
+
+
+@dataclass
+class Metrics:
+    labels: list
+    confusion: np.ndarray
+    n: int
+    accuracy: float
+    rmse: float
+    brier: float
+    precision: np.ndarray
+    recall: np.ndarray
+    f1: np.ndarray
+    macro_f1: float
+    kappa: float
+
+    def per_class(self) -> dict:
+        """{label: {"precision", "recall", "f1", "support"}} in label order."""
+        support = self.confusion.sum(axis=1)
+        return {label: {"precision": float(self.precision[i]), "recall": float(self.recall[i]),
+                        "f1": float(self.f1[i]), "support": int(support[i])}
+                for i, label in enumerate(self.labels)}
+
+    def as_dict(self) -> dict:
+        return {"n": self.n, "accuracy": self.accuracy, "rmse": self.rmse,
+                "brier": self.brier, "macro_f1": self.macro_f1, "kappa": self.kappa,
+                "per_class": self.per_class(), "confusion": self.confusion.tolist()}
+
+
+def _summaries(c: np.ndarray, scores) -> dict:
+    """Every metric for a stack of confusion matrices ``c[..., k, k]``.
+
+    Scalars come back with the leading shape of ``c``, per-class arrays with
+    an extra last axis of length k.  Counts may be fractional (expected
+    matrices); a stack with an empty matrix gives NaN for it.
+    """
+    c = np.asarray(c, dtype=float)
+    s = np.asarray(scores, dtype=float)
+    k = c.shape[-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n = c.sum(axis=(-2, -1))
+        truth, forecast = c.sum(axis=-1), c.sum(axis=-2)
+        diag = np.diagonal(c, axis1=-2, axis2=-1)
+
+        sq_err = (s[:, None] - s[None, :]) ** 2
+        hit = (s >= SIGNIFICANT).astype(float)
+        brier_err = (s[None, :] - hit[:, None]) ** 2
+
+        precision = _ratio(diag, forecast)
+        recall = _ratio(diag, truth)
+        f1 = _ratio(2 * precision * recall, precision + recall)
+
+        weights = (np.arange(k)[:, None] - np.arange(k)[None, :]) ** 2 / max(1, k - 1) ** 2
+        expected = truth[..., :, None] * forecast[..., None, :] / n[..., None, None]
+        disagreement = (weights * expected).sum(axis=(-2, -1))
+        observed = (weights * c).sum(axis=(-2, -1))
+        kappa = np.where(disagreement > 0, 1 - observed / disagreement, 1.0)
+
+        return {
+            "n": n,
+            "accuracy": diag.sum(axis=-1) / n,
+            "rmse": np.sqrt((c * sq_err).sum(axis=(-2, -1)) / n),
+            "brier": (c * brier_err).sum(axis=(-2, -1)) / n,
+            "precision": precision, "recall": recall, "f1": f1,
+            "macro_f1": f1.mean(axis=-1),
+            "kappa": kappa,
+        }
+
+
+def from_confusion(confusion: np.ndarray, scores, labels) -> Metrics:
+    """Every metric of a confusion matrix; ``scores`` are the labels' numeric values."""
+    if np.asarray(confusion).sum() == 0:
+        raise ValueError("no valid (truth, forecast) pairs to evaluate")
+    m = _summaries(confusion, scores)
+    n = float(m["n"])
+    return Metrics(
+        labels=list(labels), confusion=confusion, n=round(n) if math.isclose(n, round(n)) else n,
+        accuracy=float(m["accuracy"]), rmse=float(m["rmse"]), brier=float(m["brier"]),
+        precision=m["precision"], recall=m["recall"], f1=m["f1"],
+        macro_f1=float(m["macro_f1"]), kappa=float(m["kappa"]),
+    )
+
+
+def expected_random(confusion: np.ndarray) -> np.ndarray:
+    """Expected confusion matrix of forecasts drawn uniformly at random.
+
+    Each true grade's count is spread evenly over the k forecast columns.
+    Accuracy, MSE and Brier are linear in the cells, so for them this matrix
+    gives the random baseline's exact expected values (no noisy single
+    draw).  F1 and kappa are not linear: theirs are the scores of the
+    expected matrix, not the expected scores of random draws.
+    """
+    confusion = np.asarray(confusion, dtype=float)
+    k = confusion.shape[-1]
+    return np.repeat(confusion.sum(axis=-1, keepdims=True) / k, k, axis=-1)
+
+
+def evaluate(y_true, y_pred, scores, labels) -> Metrics:
+    """Metrics for two sequences of label indices (see ``encode()``)."""
+    confusion = confusion_matrix(np.asarray(y_true), np.asarray(y_pred), len(labels))
+    return from_confusion(confusion, scores, labels)
+
+
+# ---------- probabilistic forecasts ----------
+
+def probability_matrix(distributions, labels, samples=None, smoothing: float = 0.0) -> np.ndarray:
+    """(n, k) probabilities from ``{label: p}`` dicts, rows in label order.
+
+    With ``samples`` (the number of draws behind each row) ``smoothing``
+    pseudo-counts are added to every label, so a grade no sample chose
+    keeps a small probability.
+    """
+    p = np.array([[float(d.get(label) or 0.0) for label in labels] for d in distributions])
+    if samples is not None and smoothing:
+        counts = p * np.asarray(samples, dtype=float)[:, None]
+        p = counts + smoothing
+    total = p.sum(axis=1, keepdims=True)
+    return _ratio(p, total)
+
+
+def multiclass_brier(y_true, probs: np.ndarray) -> float:
+    """Mean over pairs of Σ_j (p_j − [truth = j])²; 0 is perfect, 2 the worst."""
+    probs = np.asarray(probs, dtype=float)
+    onehot = np.eye(probs.shape[1])[np.asarray(y_true)]
+    return float(((probs - onehot) ** 2).sum(axis=1).mean())
+
+
+def log_loss(y_true, probs: np.ndarray, eps: float = 1e-15) -> float:
+    """Mean negative log probability (nats) given to the true label."""
+    probs = np.asarray(probs, dtype=float)
+    p = probs[np.arange(len(probs)), np.asarray(y_true)]
+    return float(-np.log(np.clip(p, eps, 1.0)).mean())
+
+
+# ---------- uncertainty ----------
+
+def bootstrap(confusion: np.ndarray, scores, resamples: int, rng,
+              level: float = 0.95) -> dict:
+    """{metric: (low, high)} percentile intervals over ``resamples`` bootstrap samples."""
+    confusion = np.asarray(confusion)
+    k, n = confusion.shape[-1], int(confusion.sum())
+    p = confusion.ravel() / n
+    stats = {m: [] for m in METRIC_NAMES}
+    for start in range(0, resamples, CHUNK):
+        size = min(CHUNK, resamples - start)
+        draws = rng.multinomial(n, p, size=size).reshape(size, k, k)
+        summary = _summaries(draws, scores)
+        for m in METRIC_NAMES:
+            stats[m].append(summary[m])
+    tail = (1 - level) / 2
+    return {m: tuple(float(q) for q in np.nanquantile(np.concatenate(v), [tail, 1 - tail]))
+            for m, v in stats.items()}
+
+
+def _chunk(n: int) -> int:
+    """Resamples per step so that a (resamples, n) array stays within ``MAX_CELLS``."""
+    return max(1, min(CHUNK, MAX_CELLS // max(1, n)))
+
+
+def _one_hot_cells(y_true, y_pred, k) -> np.ndarray:
+    """(n, k²) indicator of each pair's confusion cell."""
+    return np.eye(k * k)[np.asarray(y_true) * k + np.asarray(y_pred)]
+
+
+def _difference(a: dict, b: dict) -> dict:
+    return {m: a[m] - b[m] for m in METRIC_NAMES}
+
+
+def _p_values(observed: dict, hits: dict, resamples: int) -> dict:
+    return {m: (float(observed[m]), (1 + hits[m]) / (1 + resamples)) for m in METRIC_NAMES}
+
+
+def paired_permutation(y_true, pred_a, pred_b, scores, resamples: int, rng) -> dict:
+    """{metric: (a − b, two-sided p)} for two forecasts of the same pairs.
+
+    Under the null the two forecasters are exchangeable, so each pair's two
+    forecasts are swapped with probability ½.  A swap moves one count
+    between the two matrices, so every permutation is ``base ± S @ delta``.
+    """
+    k = len(scores)
+    a, b = _one_hot_cells(y_true, pred_a, k), _one_hot_cells(y_true, pred_b, k)
+    base_a, base_b, delta = a.sum(axis=0), b.sum(axis=0), b - a
+    observed = _difference(_summaries(base_a.reshape(k, k), scores),
+                           _summaries(base_b.reshape(k, k), scores))
+    hits = dict.fromkeys(METRIC_NAMES, 0)
+    chunk = _chunk(len(delta))
+    for start in range(0, resamples, chunk):
+        size = min(chunk, resamples - start)
+        swap = (rng.random((size, len(delta))) < 0.5).astype(float)
+        shift = swap @ delta
+        diff = _difference(_summaries((base_a + shift).reshape(size, k, k), scores),
+                           _summaries((base_b - shift).reshape(size, k, k), scores))
+        for m in METRIC_NAMES:
+            hits[m] += int((np.abs(diff[m]) >= abs(observed[m]) - 1e-12).sum())
+    return _p_values(observed, hits, resamples)
+
+
+def shuffle_test(y_true, y_pred, scores, resamples: int, rng) -> dict:
+    """{metric: (observed, one-sided p)} against forecasts unrelated to the truth.
+
+    The forecasts are shuffled across pairs (keeping their distribution);
+    p is the share of shuffles that score at least as well as observed.
+    """
+    y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+    k, n = len(scores), len(y_true)
+    observed = _summaries(confusion_matrix(y_true, y_pred, k), scores)
+    hits = dict.fromkeys(METRIC_NAMES, 0)
+    chunk = _chunk(n)
+    for start in range(0, resamples, chunk):
+        size = min(chunk, resamples - start)
+        shuffled = rng.permuted(np.broadcast_to(y_pred, (size, n)), axis=1)
+        cells = (y_true * k + shuffled) + np.arange(size)[:, None] * k * k
+        counts = np.bincount(cells.ravel(), minlength=size * k * k).reshape(size, k, k)
+        summary = _summaries(counts, scores)
+        for m in METRIC_NAMES:
+            better = summary[m] <= observed[m] if m in LOWER_IS_BETTER else summary[m] >= observed[m]
+            hits[m] += int(better.sum())
+    return _p_values(observed, hits, resamples)
@@ -0,0 +1,93 @@
+"""
+Helpers for grading / forecasting all outcomes of one record in a single call.
+
+Stages 3 and 4 build one ``Job`` per record (or per chunk of at most
+``max_outcomes`` terms) whose ``meta["terms"]`` lists the outcome terms it
+covers, ask for a JSON object keyed by term, and hand the results to
+``run_multi()``.  Answers are still saved per ``(record_id, term)``.
+
+A multi-outcome answer that was cut off (``finish_reason == "length"``) or
+failed outright is split in half and retried; terms that are simply missing
+from an otherwise valid answer are re-asked together.  A single term that
+still fails is handed back to the stage with ``value=None`` so it can use
+its ordinary one-outcome prompt.
+"""
+import itertools
+import json
+
+
+def chunk_size(max_outcomes: int, max_output_tokens: int, tokens_per_outcome: int) -> int:
+    """Largest chunk whose expected answer still fits in ``max_output_tokens``."""
+    return max(1, min(max_outcomes, max_output_tokens // max(1, tokens_per_outcome)))
+
+
+def chunked(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def group_by_record(rows):
+    """Yield ``(record_id, [row, …])`` for each run of consecutive rows of a record.
+
+    The artifacts keep a record's rows together, so this streams with one
+    record in memory; a record whose rows are split up yields several groups.
+    """
+    for rid, group in itertools.groupby(rows, key=lambda row: row["record_id"]):
+        yield rid, list(group)
+
+
+def parse_json_field(text: str | None, field: str) -> dict:
+    """``json.loads(text)[field]`` if that is an object, else ``{}``."""
+    if not text:
+        return {}
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return {}
+    value = data.get(field) if isinstance(data, dict) else None
+    return value if isinstance(value, dict) else {}
+
+
+def answers_all(parse_terms):
+    """``accept`` callback for the runners: cache only answers covering every term.
+
+    A partial answer is not cached; its valid terms are saved by the stage,
+    so a later run builds a different prompt for the rest anyway.
+    """
+    return lambda result: len(parse_terms(result)) == len(result.job.meta["terms"])
+
+
+def run_multi(execute, jobs, make_job, parse_terms):
+    """Run multi-outcome jobs until every term is answered or has failed alone.
+
+    execute(jobs)            → iterable of ``Result`` in job order
+    make_job(job, terms)     → a new Job like ``job`` covering only ``terms``
+    parse_terms(result)      → ``{term: value}`` for the terms that parsed
+
+    Yields ``(result, term, value)``; ``value`` is None for a term that could
+    not be answered even on its own.
+    """
+    while jobs:
+        retry = []
+        for result in execute(jobs):
+            terms = result.job.meta["terms"]
+            truncated = getattr(result, "finish_reason", None) == "length"
+            got = {} if result.error is not None else parse_terms(result)
+            answered = [t for t in terms if t in got]
+            missing = [t for t in terms if t not in got]
+
+            for term in answered:
+                yield result, term, got[term]
+            if not missing:
+                continue
+            if len(missing) == 1:
+                yield result, missing[0], None
+            elif truncated or not answered:
+                mid = len(missing) // 2
+                retry += [make_job(result.job, missing[:mid]),
+                          make_job(result.job, missing[mid:])]
+            else:
+                retry.append(make_job(result.job, missing))
+        if retry:
+            print(f"Retrying {len(retry)} smaller multi-outcome calls")
+        jobs = retry
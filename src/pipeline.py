@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Make-style runner for stages 1–5.
+
+The stages form a chain: 1 → 2 → copy → 3, 4 → 5, where "copy" is the
+abstract_extractions.yaml → abstract_extractions_copy.yaml step that used to
+be done by hand.  pipeline_state.json remembers, for each stage's last
+successful run,
+
+  settings – a hash of the CONFIG constants that shape its answers
+             (model, prompt templates, rubric, …), of the modes it is run
+             in (--combined, --per-record, --samples, --retrieve) and of
+             the retrieval index it reads with --retrieve
+  inputs   – a content hash of each input file
+  records  – for stages 2–4, a hash of every record's input rows (for
+             stage 4 only the parts it reads: the intervention text and
+             which outcomes are informative)
+
+A stage whose inputs and settings are unchanged is skipped.  Otherwise its
+output rows for records whose input changed or disappeared (all rows, if
+the settings changed) are dropped and the stage is run; its own resume
+logic then asks only for what is missing.  Editing the forecast prompt
+therefore re-runs stage 4 and then stage 5, and nothing else.
+
+    python pipeline.py              # bring every stage up to date
+    python pipeline.py --dry-run    # what would run, and how many LLM calls
+    python pipeline.py --until 3    # stop after stage 3
+    python pipeline.py --touch      # record the current files as up to date
+
+Run it in the data directory, like the stages themselves.
+"""
+import argparse, hashlib, importlib.util, json, shutil, subprocess, sys
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import artifacts
+import yaml_cache
+from journal import iter_journal, journal_path, open_artifact
+from multi_outcome import chunk_size
+from record_ids import record_id
+# ────────────── CONFIG ──────────────
+STATE_FILE = "pipeline_state.json"
+SRC        = Path(__file__).resolve().parent
+# ─────────────────────────────────────
+
+
+@dataclass
+class Stage:
+    name: str
+    script: str | None                  # None: copy the input to the output
+    inputs: list
+    output: str
+    settings: tuple = ()                # CONFIG names whose values are fingerprinted
+    per_record: bool = False            # track input hashes per record
+    args: list = field(default_factory=list)
+    modes: dict = field(default_factory=dict)   # non-default CLI modes, fingerprinted
+    index: str | None = None            # directory whose content is fingerprinted
+    row_part: object = None             # row → the parts of it the stage reads
+
+
+def stages(combined: bool = False, per_record: bool = False,
+           samples: int | None = None, retrieve: int | None = None) -> list:
+    s1, s2 = module("1_make_database.py"), module("2_classify_abstract_outcomes_and_interventions.py")
+    s3, s4 = module("3_grade_outcomes.py"), module("4_predict_the_grade_based_on_intervention.py")
+    multi = ["--per-record"] if per_record else []
+    forecast_modes = dict({"per_record": True} if per_record else {},
+                          **({"samples": samples} if samples else {}),
+                          **({"retrieve": retrieve} if retrieve else {}))
+    forecast_args = multi + (["--samples", str(samples)] if samples else []) \
+                          + (["--retrieve", str(retrieve)] if retrieve else [])
+    retrieving = retrieve if retrieve is not None else s4.RETRIEVAL_K
+    return [
+        Stage("1", "1_make_database.py", [s1.FILE_WITH_URLS], s1.OUTPUT_YAML,
+              ("GRAPHQL_URL", "PROFILES", "DEFAULT_PROFILE")),
+        Stage("2", "2_classify_abstract_outcomes_and_interventions.py", [s2.YAML_INPUT], s2.YAML_OUTPUT,
+              ("MODEL", "SYSTEM_MSG", "QUESTION_TMPL_INTERVENTION", "QUESTION_TMPL_OUTCOME",
+               "SYSTEM_MSG_COMBINED", "QUESTION_TMPL_COMBINED"),
+              per_record=True, args=["--combined"] if combined else [],
+              modes={"combined": True} if combined else {}),
+        Stage("copy", None, [s2.YAML_OUTPUT], s3.YAML_INPUT),
+        Stage("3", "3_grade_outcomes.py", [s3.YAML_INPUT], s3.YAML_OUTPUT,
+              ("MODEL", "GRADING_SCHEME", "SYSTEM_MSG", "PROMPT_TMPL", "SYSTEM_MSG_MULTI",
+               "PROMPT_TMPL_MULTI", "OUTCOME_TMPL_MULTI",
+               "RESPONSE_FORMAT", "RESPONSE_FORMAT_MULTI"),
+              per_record=True, args=multi, modes={"per_record": True} if per_record else {}),
+        Stage("4", "4_predict_the_grade_based_on_intervention.py", [s4.YAML_INPUT], s4.YAML_OUTPUT,
+              ("MODEL", "RUBRIC", "SYSTEM_MSG", "PROMPT_TMPL", "SYSTEM_MSG_MULTI",
+               "PROMPT_TMPL_MULTI", "SAMPLES", "SAMPLE_TEMPERATURE",
+               "RESPONSE_FORMAT", "RESPONSE_FORMAT_MULTI", "RETRIEVAL_K", "CONTEXT_TMPL",
+               "EXAMPLE_TMPL", "TERM_EXAMPLES_TMPL"),
+              per_record=True, args=forecast_args, modes=forecast_modes,
+              index=s4.RETRIEVAL_INDEX if retrieving else None,
+              row_part=lambda row: [row.get("kind"), row.get("term"),
+                                    row.get("response") if row.get("kind") == "intervention"
+                                    else s4.is_informative(row)]),
+        Stage("5", "5_report_stats_on_forecasts.py", [s3.YAML_OUTPUT, s4.YAML_OUTPUT], "",
+              ("GRADE_TO_SCORE",),
+              args=["--truth", s3.YAML_OUTPUT, "--forecasts", s4.YAML_OUTPUT]),
+    ]
+
+# ---------- helpers ----------
+_modules = {}
+
+def module(script: str):
+    """Import a numbered stage script (for its CONFIG and helpers) without running it."""
+    if script not in _modules:
+        spec = importlib.util.spec_from_file_location(Path(script).stem, SRC / script)
+        _modules[script] = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_modules[script])
+    return _modules[script]
+
+def digest(*parts) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(json.dumps(part, sort_keys=True, ensure_ascii=False, default=repr).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+def file_hash(path) -> str | None:
+    path = Path(path)
+    if not path.exists():
+        return None
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+def dir_hash(path) -> str | None:
+    """Content hash of every file under ``path`` (None if it does not exist)."""
+    path = Path(path)
+    if not path.is_dir():
+        return None
+    return digest([(str(p.relative_to(path)), file_hash(p))
+                   for p in sorted(path.rglob("*")) if p.is_file()])
+
+def settings_hash(stage: Stage) -> str:
+    if stage.script is None:
+        return ""
+    mod = module(stage.script)
+    values = {name: getattr(mod, name) for name in stage.settings}
+    values = {k: sorted(v) if isinstance(v, set) else v for k, v in values.items()}
+    # only added when set, so the default runs keep the hashes they had
+    if stage.modes:
+        values["modes"] = stage.modes
+    if stage.index is not None:
+        values["index"] = dir_hash(stage.index)
+    return digest(values)
+
+def record_hashes(path, row_part=None) -> dict:
+    """{record_id: hash of that record's input} for impact records or extraction rows.
+
+    ``row_part(row)`` picks what counts of an extraction row (default: kind,
+    term and response).
+    """
+    rows = {}
+    for row in artifacts.iter_rows(path, text=False):
+        if not isinstance(row, dict):
+            continue
+        if "record_id" in row:      # extraction row
+            rid = row["record_id"]
+            part = row_part(row) if row_part else [row.get("kind"), row.get("term"), row.get("response")]
+        else:                       # impact record
+            rid = record_id(row)
+            part = [row.get("abstract"), row.get("outcome"), row.get("interventions")]
+        rows.setdefault(rid, []).append(digest(part))
+    return {rid: digest(sorted(parts)) for rid, parts in rows.items()}
+
+def output_rows(path):
+    """Rows of a stage output, journal included, without building a JournaledYaml."""
+    yield from artifacts.iter_rows(path, text=False)
+    yield from iter_journal(journal_path(path))
+
+def load_state(path=STATE_FILE) -> dict:
+    return json.loads(Path(path).read_text(encoding="utf-8")) if Path(path).exists() else {}
+
+def save_state(state: dict, path=STATE_FILE) -> None:
+    tmp = Path(path).with_suffix(".tmp")
+    tmp.write_text(json.dumps(state, indent=1, sort_keys=True), encoding="utf-8")
+    tmp.replace(path)
+
+# ---------- planning ----------
+def plan(stage: Stage, state: dict) -> dict:
+    """Whether ``stage`` is out of date, why, and which records to redo."""
+    prev = state.get(stage.name)
+    now = {"settings": settings_hash(stage),
+           "inputs": {p: file_hash(p) for p in stage.inputs}}
+    todo = {"run": True, "drop_all": False, "stale": set(), "state": now}
+    if missing := [p for p in stage.inputs if now["inputs"][p] is None]:
+        todo.update(run=False, reason=f"waiting for {', '.join(missing)}")
+        return todo
+    if stage.per_record and (prev is None or prev.get("inputs") != now["inputs"]):
+        now["records"] = record_hashes(stage.inputs[0], stage.row_part)
+    elif prev is not None:
+        now["records"] = prev.get("records")
+
+    if stage.output and not Path(stage.output).exists():
+        todo["reason"] = f"{stage.output} does not exist"
+    elif prev is None:
+        todo["reason"] = "no earlier run recorded"
+    elif not prev.get("complete", True):
+        todo["reason"] = "the last run did not finish"      # its stale rows are already gone
+    elif prev["settings"] != now["settings"]:
+        todo.update(reason="settings changed", drop_all=True)
+    elif prev["inputs"] != now["inputs"]:
+        todo["reason"] = "inputs changed"
+        if stage.per_record:
+            old, new = prev.get("records") or {}, now["records"]
+            todo["stale"] = {rid for rid, h in old.items() if new.get(rid) != h}
+            added = len(new.keys() - old.keys())
+            todo["reason"] = f"{len(todo['stale'])} records changed or removed, {added} new"
+            if not todo["stale"] and not added:
+                todo.update(run=False, refresh=True,
+                            reason="inputs changed, but no record's rows did")
+    else:
+        todo.update(run=False, reason="up to date")
+    return todo
+
+def drop_stale(stage: Stage, todo: dict) -> int:
+    """Remove output rows that have to be redone; returns how many were dropped."""
+    if not stage.per_record or not Path(stage.output).exists() \
+            or not (todo["drop_all"] or todo["stale"]):
+        return 0
+    artifact = open_artifact(stage.output)
+    before = len(artifact)
+    keep = (lambda row: False) if todo["drop_all"] else \
+           (lambda row: row.get("record_id") not in todo["stale"])
+    artifact.replace_all(row for row in artifact.values() if keep(row))
+    artifact.close(compact=False)
+    return before - len(artifact)
+
+def pending_calls(stage: Stage, todo: dict, combined: bool, per_record: bool) -> str:
+    """Rough count of the requests ``stage`` would make from the current files."""
+    if stage.script is None or stage.name == "5":
+        return "no LLM calls"
+    mod = module(stage.script)
+    if stage.name == "1":
+        done = {entry["id"] for entry in iter_journal(mod.JOURNAL)}
+        return f"{len(set(mod.read_ids(stage.inputs[0])) - done)} records to fetch, no LLM calls"
+
+    dropped = lambda row: todo["drop_all"] or row.get("record_id") in todo["stale"]
+    keys = set() if todo["drop_all"] else \
+           {mod.output_key(r) for r in output_rows(stage.output) if not dropped(r)}
+    if stage.name == "2":
+        records = yaml_cache.iter_list(stage.inputs[0])
+        if combined:
+            plain = []
+            n = sum(1 for _ in mod.iter_combined_jobs(records, keys, plain))
+            return f"{n} combined + {len(plain)} single LLM calls (plus re-asks for missing terms)"
+        return f"{sum(1 for _ in mod.iter_jobs(records, keys))} LLM calls"
+
+    # stages 3 and 4: one call per informative outcome, or per chunk of a record's outcomes
+    per_rec = {}
+    for row in artifacts.iter_rows(stage.inputs[0], text=False):
+        key = (row["record_id"], row.get("term"))
+        if mod.is_informative(row) and key not in keys:
+            keys.add(key)
+            per_rec[row["record_id"]] = per_rec.get(row["record_id"], 0) + 1
+    if per_record:
+        size = chunk_size(mod.MAX_OUTCOMES_PER_CALL, mod.MAX_OUTPUT_TOKENS, mod.TOKENS_PER_OUTCOME)
+        return f"{sum(-(-n // size) for n in per_rec.values())} LLM calls (per record)"
+    return f"{sum(per_rec.values())} LLM calls"
+
+# ---------- main ----------
+def main(until: str = "5", dry_run: bool = False, touch: bool = False,
+         combined: bool = False, per_record: bool = False,
+         samples: int | None = None, retrieve: int | None = None):
+    state = load_state()
+    upstream = None       # first stage of this run that would change its output
+    for stage in stages(combined, per_record, samples, retrieve):
+        todo = plan(stage, state)
+        label = f"[{stage.name}] {stage.script or 'copy ' + stage.inputs[0]}"
+
+        if dry_run:
+            if upstream is not None and not todo["run"]:
+                todo["reason"] = f"after stage {upstream} (inputs will change)"
+            if todo["run"] or upstream is not None:
+                upstream = upstream or stage.name
+                print(f"{label}: would run – {todo['reason']}; "
+                      f"{pending_calls(stage, todo, combined, per_record)}")
+            else:
+                print(f"{label}: {todo['reason']}")
+        elif touch:
+            state[stage.name] = todo["state"]
+            print(f"{label}: marked up to date")
+        elif not todo["run"]:
+            print(f"{label}: {todo['reason']}")
+            if todo.get("refresh"):
+                state[stage.name] = todo["state"]       # remember the new input hashes
+                save_state(state)
+        else:
+            print(f"{label}: {todo['reason']}")
+            if dropped := drop_stale(stage, todo):
+                print(f"{label}: dropped {dropped} rows of {stage.output} to redo")
+                # an interrupted run must resume, not drop (and redo) everything again
+                state[stage.name] = dict(todo["state"], complete=False)
+                save_state(state)
+            if stage.script is None:
+                shutil.copyfile(stage.inputs[0], stage.output)
+            else:
+                cmd = [sys.executable, str(SRC / stage.script), *stage.args]
+                if subprocess.run(cmd).returncode != 0:
+                    save_state(state)
+                    sys.exit(f"{label} failed; fix it and re-run (finished stages are kept)")
+            state[stage.name] = todo["state"]
+            save_state(state)
+
+        if stage.name == until:
+            break
+    if touch:
+        save_state(state)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Run the out-of-date pipeline stages, in order")
+    p.add_argument("--until", choices=["1", "2", "copy", "3", "4", "5"], default="5",
+                   help="last stage to bring up to date")
+    p.add_argument("--dry-run", action="store_true",
+                   help="only report which stages would run and how many LLM calls they would make")
+    p.add_argument("--touch", action="store_true",
+                   help="record the current files as up to date without running anything")
+    p.add_argument("--combined", action="store_true", help="pass --combined to stage 2")
+    p.add_argument("--per-record", action="store_true", help="pass --per-record to stages 3 and 4")
+    p.add_argument("--samples", type=int, default=None, help="pass --samples K to stage 4")
+    p.add_argument("--retrieve", metavar="K", type=int, default=None,
+                   help="pass --retrieve K to stage 4 (its index is fingerprinted too)")
+    args = p.parse_args()
+    main(args.until, args.dry_run, args.touch, args.combined, args.per_record,
+         args.samples, args.retrieve)
@@ -0,0 +1,75 @@
+"""
+Small rate-limiting helpers shared by the crawler and the LLM stages.
+
+TokenBucket     – thread-safe token bucket (``rate`` tokens/s, ``burst`` capacity)
+retry_after     – parse an HTTP ``Retry-After`` header into seconds
+backoff_delay   – exponential backoff with full jitter
+"""
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket:
+    """Token bucket that refills continuously at ``rate`` tokens per second.
+
+    ``acquire()`` blocks until the requested number of tokens is available.
+    ``pause()`` empties the bucket and blocks every caller for a while, which
+    is what we want when the server tells us to back off (HTTP 429).
+    """
+
+    def __init__(self, rate: float, burst: float | None = None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        tokens = min(float(tokens), self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = max(self.blocked_until - now,
+                           (tokens - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.tokens = 0.0
+            self.updated = now
+
+
+def retry_after(value: str | None) -> float | None:
+    """Return the delay in seconds encoded in a Retry-After header, if any."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """Exponential backoff with full jitter for the given 1-based attempt."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
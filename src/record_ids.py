@@ -0,0 +1,115 @@
+"""
+Stable record identifiers.
+
+Stage 2 used to name records after their position in impact_records.yaml
+(``R00001`` is the first record).  A re-crawl that inserts, drops or
+re-orders records then silently re-points every key in the extraction,
+grade and forecast files.  Record IDs are now derived from where the record
+came from and that source's own ID:
+
+    3ie-28503        3ie record 28503
+    scopus-…, wos-…  room for other sources (a record's ``source`` field)
+
+A record without a source ID gets a hash of its title and abstract instead
+(``3ie-h1a2b3c4d5e6``), which is just as independent of file order.
+
+``python record_ids.py`` is the one-time migration: it maps the positional
+IDs in existing artifacts (and the ``--db`` store) to stable ones, using the
+impact_records.yaml the artifacts were produced from.
+"""
+import hashlib
+import re
+from pathlib import Path
+
+import yaml_cache
+from journal import open_artifact
+
+DEFAULT_SOURCE = "3ie"
+POSITIONAL = re.compile(r"R\d{5,}")
+
+
+def record_id(rec: dict, source: str | None = None) -> str:
+    """``3ie-28503``: the record's source prefix plus its source ID."""
+    source = source or rec.get("source") or DEFAULT_SOURCE
+    if rec.get("id") not in (None, ""):
+        return f"{source}-{rec['id']}"
+    text = f"{rec.get('title') or ''}\n{rec.get('abstract') or ''}"
+    return f"{source}-h{hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]}"
+
+
+def is_positional(rid) -> bool:
+    """True for the old ``R00001``-style IDs."""
+    return isinstance(rid, str) and POSITIONAL.fullmatch(rid) is not None
+
+
+def positional_map(records) -> dict:
+    """{``R00001``: stable ID} for records in their impact_records.yaml order."""
+    return {f"R{idx:05}": record_id(rec)
+            for idx, rec in enumerate(records, start=1) if isinstance(rec, dict)}
+
+
+def check_stable(keys, path) -> None:
+    """Exit with a pointer to the migration if ``keys`` still use positional IDs."""
+    if any(is_positional(k[0]) for k in keys):
+        raise SystemExit(f"{path} still uses positional record IDs (R00001, …); "
+                         f"run `python record_ids.py` once to migrate it")
+
+
+# ---------- migration ----------
+
+def rekey(rows, mapping: dict, counts: dict):
+    """Yield ``rows`` with positional record IDs replaced through ``mapping``."""
+    for row in rows:
+        rid = row.get("record_id")
+        if is_positional(rid):
+            if rid in mapping:
+                row = dict(row, record_id=mapping[rid])
+                counts["migrated"] += 1
+            else:
+                counts["unmapped"] += 1
+        yield row
+
+
+def migrate_yaml(path, mapping: dict) -> dict:
+    """Re-key one artifact in place (its journal is folded in first)."""
+    counts = {"migrated": 0, "unmapped": 0}
+    artifact = open_artifact(path)
+    before = len(artifact)
+    artifact.replace_all(rekey(artifact.values(), mapping, counts))
+    artifact.close(compact=False)
+    counts["merged"] = before - len(artifact)   # rows whose new key already existed
+    return counts
+
+
+if __name__ == "__main__":
+    import argparse
+    from store import Store
+
+    p = argparse.ArgumentParser(description="Re-key artifacts from positional (R00001) to stable record IDs")
+    p.add_argument("paths", nargs="*",
+                   default=["abstract_extractions.yaml", "abstract_extractions_copy.yaml",
+                            "abstract_outcome_grades.yaml", "abstract_outcome_forecasts.yaml"],
+                   help="artifacts to migrate (missing ones are skipped)")
+    p.add_argument("--records", default="impact_records.yaml",
+                   help="the impact_records.yaml the artifacts were produced from (its order matters)")
+    p.add_argument("--db", metavar="PATH", default=None,
+                   help="also migrate this SQLite store (mapped from its own records table)")
+    args = p.parse_args()
+
+    mapping = positional_map(yaml_cache.iter_list(args.records))
+    if len(set(mapping.values())) < len(mapping):
+        print(f"Warning: {args.records} has records sharing a source ID; "
+              f"their rows are merged, keeping the first")
+    print(f"{len(mapping)} positional IDs mapped from {args.records}")
+    for path in args.paths:
+        if not Path(path).exists():
+            print(f"Skipping {path}: not found")
+            continue
+        counts = migrate_yaml(path, mapping)
+        print(f"{path}: {counts['migrated']} rows re-keyed, {counts['unmapped']} left as-is "
+              f"(no such record), {counts['merged']} duplicates dropped")
+    if args.db:
+        store = Store(args.db)
+        for table, n in store.migrate_record_ids().items():
+            print(f"{args.db} {table}: {n} rows re-keyed")
+        store.close()
@@ -0,0 +1,246 @@
+"""
+Local retrieval index of past interventions for the forecast prompts.
+
+Each document is one record's intervention text (stage 2 extractions),
+with the record's publication year (impact_records.yaml) and the grades
+its outcomes received (stage 3).  ``build()`` turns them into plain NumPy
+arrays in a directory, so ``Index()`` memory-maps them and a query
+touches only the postings of its own words:
+
+    meta.json                   vocabulary, record IDs, outcome terms, snippets
+    idf.npy, years.npy          per word / per document
+    indptr.npy, docs.npy        word → documents (CSR postings)
+    bm25.npy, tfidf.npy         the matching BM25 and L2-normalized TF-IDF weights
+    out_indptr.npy, out_docs.npy, out_grades.npy
+                                outcome term → graded documents and their grades
+
+``Index.search(text, term, before=year)`` scores every document with one
+``bincount`` over the query's postings and returns the best ``k`` documents
+that graded the same outcome term (case-insensitively) and were published
+strictly before ``before``, so a forecast never sees later results.
+
+    python retrieval.py build
+    python retrieval.py query "cash transfers to mothers" --term "School enrolment" --before 2020
+"""
+import json
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+import yaml_cache
+from artifacts import iter_rows
+from record_ids import record_id
+
+INDEX_DIR    = "retrieval_index"
+RECORDS      = "impact_records.yaml"
+EXTRACTIONS  = "abstract_extractions.yaml"
+GRADES       = "abstract_outcome_grades.yaml"
+K1, B        = 1.2, 0.75      # BM25 parameters
+SNIPPET_CHARS = 300           # intervention text kept per document for prompts
+SKIP_GRADES  = {"no information"}
+
+STOPWORDS = set("""
+a an and are as at be by for from has have in is it its of on or that the this to
+was were which with who will their they these those into than then also such not
+""".split())
+
+ARRAYS = ("idf", "years", "indptr", "docs", "bm25", "tfidf",
+          "out_indptr", "out_docs", "out_grades")
+
+
+def tokenize(text: str) -> list:
+    return [w for w in re.findall(r"[a-z0-9]+", (text or "").lower())
+            if len(w) > 1 and w not in STOPWORDS]
+
+
+def normalize_term(term: str) -> str:
+    return " ".join(str(term).lower().split())
+
+
+def publication_year(rec: dict) -> int:
+    """The record's year of publication, or -1 if it has none."""
+    match = re.search(r"\d{4}", str(rec.get("year_of_publication") or ""))
+    return int(match.group()) if match else -1
+
+
+@dataclass
+class Hit:
+    record_id: str
+    year: int
+    score: float
+    grade: str
+    snippet: str
+
+
+# ---------- build ----------
+
+def build(out_dir=INDEX_DIR, records=RECORDS, extractions=EXTRACTIONS, grades=GRADES) -> dict:
+    """Write the index for the current artifacts; returns a few counts."""
+    years = {record_id(r): publication_year(r)
+             for r in yaml_cache.iter_list(records) if isinstance(r, dict)}
+    texts = {}
+    for row in iter_rows(extractions, text=False):
+        if row.get("kind") == "intervention" and isinstance(row.get("response"), str):
+            texts.setdefault(row["record_id"], row["response"].strip())
+    rids = list(texts)
+    doc_of = {rid: i for i, rid in enumerate(rids)}
+
+    # word → {doc: tf}
+    vocab, postings, lengths = {}, [], np.zeros(len(rids), dtype=np.float32)
+    for d, rid in enumerate(rids):
+        words = tokenize(texts[rid])
+        lengths[d] = len(words)
+        for w, tf in Counter(words).items():
+            if w not in vocab:
+                vocab[w] = len(postings)
+                postings.append([])
+            postings[vocab[w]].append((d, tf))
+
+    n = max(1, len(rids))
+    avg_len = float(lengths.mean()) if len(rids) else 0.0
+    indptr = np.zeros(len(postings) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(p) for p in postings])
+    docs = np.fromiter((d for p in postings for d, _ in p), dtype=np.int32, count=indptr[-1])
+    tf = np.fromiter((t for p in postings for _, t in p), dtype=np.float32, count=indptr[-1])
+    df = np.diff(indptr).astype(np.float64)
+    idf = np.log(1 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+    word_idf = np.repeat(idf, np.diff(indptr))
+    norm = K1 * (1 - B + B * lengths[docs] / max(avg_len, 1e-9))
+    bm25 = word_idf * tf * (K1 + 1) / (tf + norm)
+    tfidf = (1 + np.log(np.maximum(tf, 1))) * word_idf
+    doc_norm = np.sqrt(np.bincount(docs, tfidf ** 2, minlength=len(rids)))
+    tfidf = tfidf / np.maximum(doc_norm[docs], 1e-12)
+
+    # outcome term → graded documents
+    outcomes = {}
+    labels = []
+    for row in yaml_cache.iter_list(grades):
+        grade = str(row.get("grade") or "").strip().lower()
+        if row.get("record_id") not in doc_of or not grade or grade in SKIP_GRADES:
+            continue
+        if grade not in labels:
+            labels.append(grade)
+        outcomes.setdefault(normalize_term(row["term"]), {})[doc_of[row["record_id"]]] = labels.index(grade)
+    terms = sorted(outcomes)
+    out_indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    out_indptr[1:] = np.cumsum([len(outcomes[t]) for t in terms])
+    out_docs = np.array([d for t in terms for d in outcomes[t]], dtype=np.int32)
+    out_grades = np.array([g for t in terms for g in outcomes[t].values()], dtype=np.int8)
+
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    arrays = {"idf": idf, "years": np.array([years.get(r, -1) for r in rids], dtype=np.int32),
+              "indptr": indptr, "docs": docs, "bm25": bm25.astype(np.float32),
+              "tfidf": tfidf.astype(np.float32), "out_indptr": out_indptr,
+              "out_docs": out_docs, "out_grades": out_grades}
+    for name, array in arrays.items():
+        np.save(out / f"{name}.npy", array)
+    meta = {"vocab": list(vocab), "records": rids, "terms": terms, "grades": labels,
+            "snippets": [texts[r][:SNIPPET_CHARS] for r in rids]}
+    (out / "meta.json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+    return {"documents": len(rids), "words": len(vocab), "terms": len(terms),
+            "graded": int(out_indptr[-1])}
+
+
+# ---------- search ----------
+
+class Index:
+    """A built index, memory-mapped read-only (see the module docstring)."""
+
+    def __init__(self, path=INDEX_DIR):
+        path = Path(path)
+        if not (path / "meta.json").exists():
+            raise SystemExit(f"No retrieval index at {path}; run `python retrieval.py build` first")
+        meta = json.loads((path / "meta.json").read_text(encoding="utf-8"))
+        self.vocab = {w: i for i, w in enumerate(meta["vocab"])}
+        self.records = meta["records"]
+        self.doc_of = {rid: i for i, rid in enumerate(self.records)}
+        self.terms = {t: i for i, t in enumerate(meta["terms"])}
+        self.grades = meta["grades"]
+        self.snippets = meta["snippets"]
+        for name in ARRAYS:
+            setattr(self, name, np.load(path / f"{name}.npy", mmap_mode="r"))
+
+    def year(self, rid: str) -> int:
+        """Publication year of an indexed record (-1 if unknown or not indexed)."""
+        d = self.doc_of.get(rid)
+        return -1 if d is None else int(self.years[d])
+
+    def scores(self, text: str, method: str = "bm25") -> np.ndarray:
+        """Similarity of ``text`` to every document."""
+        counts = Counter(self.vocab[w] for w in tokenize(text) if w in self.vocab)
+        if not counts:
+            return np.zeros(len(self.records), dtype=np.float32)
+        words = np.fromiter(counts, dtype=np.int64)
+        starts, ends = self.indptr[words], self.indptr[words + 1]
+        idx = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+        weights = np.asarray((self.bm25 if method == "bm25" else self.tfidf)[idx], dtype=np.float64)
+        if method == "bm25":
+            q = np.fromiter(counts.values(), dtype=np.float64)
+        else:
+            q = (1 + np.log(np.fromiter(counts.values(), dtype=np.float64))) * self.idf[words]
+            q /= max(np.linalg.norm(q), 1e-12)
+        weights *= np.repeat(q, ends - starts)
+        return np.bincount(self.docs[idx], weights, minlength=len(self.records))
+
+    def search(self, text: str, term: str, before: int | None = None, k: int = 5,
+               exclude: str | None = None, method: str = "bm25") -> list:
+        """The ``k`` most similar documents that graded ``term``, best first.
+
+        With ``before``, only documents published in an earlier (known) year.
+        """
+        t = self.terms.get(normalize_term(term))
+        if t is None or k <= 0:
+            return []
+        a, b = self.out_indptr[t], self.out_indptr[t + 1]
+        docs, grades = np.asarray(self.out_docs[a:b]), np.asarray(self.out_grades[a:b])
+        keep = np.ones(len(docs), dtype=bool)
+        if before is not None:
+            years = self.years[docs]
+            keep &= (years >= 0) & (years < before)
+        if exclude in self.doc_of:
+            keep &= docs != self.doc_of[exclude]
+        docs, grades = docs[keep], grades[keep]
+        if not len(docs):
+            return []
+        s = self.scores(text, method)[docs]
+        top = np.argsort(-s, kind="stable")[:k]
+        return [Hit(self.records[docs[i]], int(self.years[docs[i]]), float(s[i]),
+                    self.grades[grades[i]], self.snippets[docs[i]]) for i in top]
+
+
+if __name__ == "__main__":
+    import argparse
+    p = argparse.ArgumentParser(description="Build or query the retrieval index used by stage 4 --retrieve")
+    sub = p.add_subparsers(dest="action", required=True)
+    b = sub.add_parser("build")
+    b.add_argument("--records", default=RECORDS)
+    b.add_argument("--extractions", default=EXTRACTIONS)
+    b.add_argument("--grades", default=GRADES)
+    b.add_argument("--index", default=INDEX_DIR)
+    q = sub.add_parser("query")
+    q.add_argument("text")
+    q.add_argument("--term", required=True, help="outcome term the past interventions must have graded")
+    q.add_argument("--before", type=int, default=None, help="only results published before this year")
+    q.add_argument("-k", type=int, default=5)
+    q.add_argument("--method", choices=["bm25", "tfidf"], default="bm25")
+    q.add_argument("--index", default=INDEX_DIR)
+    args = p.parse_args()
+
+    if args.action == "build":
+        started = time.perf_counter()
+        counts = build(args.index, args.records, args.extractions, args.grades)
+        print(f"Indexed {counts['documents']} interventions ({counts['words']} words, "
+              f"{counts['graded']} graded outcomes over {counts['terms']} terms) "
+              f"in {time.perf_counter() - started:.1f} s → {args.index}")
+    else:
+        index = Index(args.index)
+        started = time.perf_counter()
+        hits = index.search(args.text, args.term, args.before, args.k, method=args.method)
+        print(f"{len(hits)} hits in {1000 * (time.perf_counter() - started):.2f} ms")
+        for hit in hits:
+            print(f"{hit.score:7.3f}  {hit.record_id} ({hit.year})  {hit.grade:<22} {hit.snippet[:80]}")
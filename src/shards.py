@@ -0,0 +1,220 @@
+"""
+Sharded runs of stages 2–4 and the merge that joins them.
+
+``--shard i/N`` makes a stage handle only the records whose ID hashes to
+slice ``i`` of ``N`` (1-based), so N processes or machines can share a run
+without touching the same file.  Each writes its own shard of the output:
+
+    abstract_outcome_grades.yaml  →  abstract_outcome_grades.shard2of4.yaml
+                                     (+ its .jsonl journal, as usual)
+
+Rows already in the canonical artifact count as done, so a shard resumes
+exactly like an unsharded run.  ``python shards.py merge OUTPUT…`` folds the
+shards into the canonical file in a fixed order (canonical rows, then shard
+1, 2, …), whatever order the workers finished in.  A key that two sources
+answered differently is a conflict: it is reported and the first answer is
+kept, or the merge is refused with ``--strict``.
+
+With ``--db`` the shards of one machine write to the same SQLite store
+instead, so there is nothing to merge.  SQLite locking is not reliable on
+network filesystems, so shards on other machines write YAML shards.
+"""
+import hashlib
+import json
+from pathlib import Path
+
+import artifacts
+from journal import iter_journal, journal_path, open_artifact, row_key
+
+
+def parse_shard(spec: str | None) -> tuple | None:
+    """``"2/4"`` → ``(2, 4)``; None stays None."""
+    if spec is None:
+        return None
+    try:
+        i, n = (int(x) for x in spec.split("/"))
+    except ValueError:
+        raise SystemExit(f"--shard expects i/N, e.g. 2/4 (got {spec!r})")
+    if not 1 <= i <= n:
+        raise SystemExit(f"--shard {spec}: i must be between 1 and N")
+    return i, n
+
+
+def in_shard(record_id: str, shard: tuple | None) -> bool:
+    """Whether ``record_id`` belongs to ``shard`` (always true without one)."""
+    if shard is None:
+        return True
+    i, n = shard
+    h = int.from_bytes(hashlib.sha1(str(record_id).encode("utf-8")).digest()[:8], "big")
+    return h % n == i - 1
+
+
+def _split_name(path: Path) -> tuple:
+    base, _, ext = path.name.partition(".")
+    return base, ext
+
+
+def shard_path(path, shard: tuple | None) -> Path:
+    """``grades.yaml`` → ``grades.shard2of4.yaml`` (``path`` itself without a shard)."""
+    path = Path(path)
+    if shard is None:
+        return path
+    base, ext = _split_name(path)
+    return path.with_name(f"{base}.shard{shard[0]}of{shard[1]}.{ext}")
+
+
+def shard_files(path) -> list:
+    """Existing shard files of ``path``, in shard order."""
+    path = Path(path)
+    base, ext = _split_name(path)
+    found = {}
+    pattern = f"{base}.shard*of*.{ext}"
+    for p in list(path.parent.glob(pattern)) + \
+             list(path.parent.glob(journal_path(pattern).name)):
+        spec = p.name[len(base) + len(".shard"):].split(".", 1)[0]
+        i, _, n = spec.partition("of")
+        if i.isdigit() and n.isdigit():
+            found.setdefault((int(n), int(i)), shard_path(path, (int(i), int(n))))
+    return [found[k] for k in sorted(found)]
+
+
+def read_keys(path, key) -> set:
+    """Keys of every row of an artifact, its journal included."""
+    keys = {key(row) for row in artifacts.iter_rows(path, text=False)}
+    keys.update(key(row) for row in iter_journal(journal_path(path)))
+    return keys
+
+
+class ShardOutput:
+    """Shard ``i/N`` of a stage output, standing in for its ``JournaledYaml``.
+
+    New rows go to the shard artifact; keys in ``done`` (the canonical
+    artifact's) count as already answered.
+    """
+
+    def __init__(self, artifact, done: set):
+        self.artifact = artifact
+        self.done = done
+
+    def __contains__(self, k) -> bool:
+        return k in self.done or k in self.artifact
+
+    def keys(self) -> list:
+        return list(self.done | set(self.artifact.keys()))
+
+    def values(self):
+        return self.artifact.values()
+
+    def append(self, row: dict) -> None:
+        self.artifact.append(row)
+
+    def replace_all(self, rows) -> None:
+        self.artifact.replace_all(rows)
+
+    def checkpoint(self) -> None:
+        self.artifact.checkpoint()
+
+    def close(self, compact: bool = True) -> None:
+        self.artifact.close(compact)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return self.artifact.__exit__(*exc)
+
+
+def open_output(path, shard: tuple | None, key, open_shard):
+    """The output a stage writes: ``open_shard(path)`` without a shard,
+    else a ``ShardOutput`` over ``open_shard(shard_path(path, shard))``."""
+    if shard is None:
+        return open_shard(path)
+    print(f"Shard {shard[0]}/{shard[1]}: writing {shard_path(path, shard)}")
+    return ShardOutput(open_shard(shard_path(path, shard)), read_keys(path, key))
+
+
+# ---------- merge ----------
+
+def _digest(row: dict) -> bytes:
+    return hashlib.sha1(json.dumps(row, sort_keys=True, ensure_ascii=False,
+                                   default=str).encode("utf-8")).digest()
+
+
+def merge(path, key=row_key, strict: bool = False, keep: bool = False) -> dict:
+    """Fold every shard of ``path`` into it; returns counts and the conflicting keys."""
+    path = Path(path)
+    shards = shard_files(path)
+    stats = {"shards": len(shards), "added": 0, "duplicates": 0, "conflicts": []}
+    if not shards:
+        return stats
+    templates = {}
+    for p in [path, *shards]:
+        head = artifacts.read_head(p)
+        if head is not None:
+            templates.update(head["templates"])
+    target = open_artifact(path, key, templates=templates or None)
+
+    seen = {}        # key → digest of the row kept for it
+
+    def rows():
+        for row in target.values():
+            seen.setdefault(key(row), _digest(row))
+            yield row
+        for p in shards:
+            shard = open_artifact(p, key)
+            for row in shard.values():
+                k, d = key(row), _digest(row)
+                if k not in seen:
+                    seen[k] = d
+                    stats["added"] += 1
+                    yield row
+                elif seen[k] == d:
+                    stats["duplicates"] += 1
+                else:
+                    stats["conflicts"].append((k, p.name))
+            shard.close(compact=False)
+
+    if strict:
+        for _ in rows():    # dry pass: find conflicts before writing anything
+            pass
+        if stats["conflicts"]:
+            target.close(compact=False)
+            return stats
+        seen.clear()
+        stats.update(added=0, duplicates=0)
+    target.replace_all(rows())
+    target.close(compact=False)
+    if not keep:
+        for p in shards:
+            p.unlink(missing_ok=True)
+            journal_path(p).unlink(missing_ok=True)
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    p = argparse.ArgumentParser(description="Merge the --shard outputs of stages 2–4 into their canonical artifacts")
+    p.add_argument("action", choices=["merge", "list"])
+    p.add_argument("paths", nargs="+",
+                   help="canonical artifacts, e.g. abstract_outcome_grades.yaml")
+    p.add_argument("--strict", action="store_true",
+                   help="write nothing if two shards disagree about a row")
+    p.add_argument("--keep", action="store_true", help="keep the shard files after merging")
+    args = p.parse_args()
+    failed = False
+    for path in args.paths:
+        if args.action == "list":
+            for shard in shard_files(path):
+                print(shard)
+            continue
+        stats = merge(path, strict=args.strict, keep=args.keep)
+        for k, name in stats["conflicts"]:
+            print(f"  conflict: {k} differs in {name}")
+        if args.strict and stats["conflicts"]:
+            print(f"{path}: {len(stats['conflicts'])} conflicts, nothing merged")
+            failed = True
+            continue
+        print(f"{path}: merged {stats['shards']} shards, {stats['added']} rows added, "
+              f"{stats['duplicates']} duplicates, {len(stats['conflicts'])} conflicts (first answer kept)")
+    if failed:
+        raise SystemExit(1)
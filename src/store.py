@@ -0,0 +1,422 @@
+"""
+Optional SQLite store for everything the pipeline hands between stages.
+
+One file (``pipeline.sqlite`` by default, or ``PIPELINE_DB``) holds
+
+  records      – impact_records.yaml, one row per record in file order
+  extractions  – abstract_extractions.yaml, keyed by (record_id, kind, term)
+  grades       – abstract_outcome_grades.yaml, keyed by (record_id, term)
+  forecasts    – abstract_outcome_forecasts.yaml, keyed by (record_id, term)
+
+plus the ``templates`` and ``abstracts`` side tables of the normalized
+extraction layout (see artifacts.py), so an abstract is stored once.
+
+Each stage takes ``--db PATH`` to read and write here instead of the YAML
+files.  ``StoreTable`` has the same interface as ``journal.JournaledYaml``
+(``in``, ``append``, ``values``, ``replace_all``, context manager), so resume
+checks become primary-key lookups.  ``python store.py import|export`` moves
+data between the store and the YAML files.
+"""
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import artifacts
+import yaml_cache
+from record_ids import record_id
+
+DEFAULT_PATH = os.getenv("PIPELINE_DB", "pipeline.sqlite")
+PAGE_SIZE    = 500     # rows fetched per query when iterating a table
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    idx        INTEGER PRIMARY KEY,         -- 1-based position in the YAML file
+    record_id  TEXT NOT NULL UNIQUE,        -- stable ID, see record_ids.py
+    id         TEXT,                        -- 3ie id
+    data       TEXT NOT NULL                -- the record as JSON
+);
+CREATE TABLE IF NOT EXISTS templates (
+    template_id TEXT PRIMARY KEY,
+    text        TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS abstracts (
+    record_id  TEXT PRIMARY KEY,
+    abstract   TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS extractions (
+    record_id  TEXT NOT NULL,
+    kind       TEXT NOT NULL,
+    term       TEXT NOT NULL,
+    template   TEXT,
+    params     TEXT,                        -- JSON
+    query      TEXT,                        -- only for prompts with no template
+    abstract   TEXT,                        -- only if it differs from abstracts
+    response   TEXT,
+    PRIMARY KEY (record_id, kind, term)
+);
+CREATE INDEX IF NOT EXISTS extractions_kind ON extractions(kind);
+CREATE INDEX IF NOT EXISTS extractions_term ON extractions(record_id, term);
+CREATE TABLE IF NOT EXISTS grades (
+    record_id  TEXT NOT NULL,
+    term       TEXT NOT NULL,
+    grade      TEXT,
+    PRIMARY KEY (record_id, term)
+);
+CREATE TABLE IF NOT EXISTS forecasts (
+    record_id  TEXT NOT NULL,
+    term       TEXT NOT NULL,
+    scratchpad TEXT,
+    prediction TEXT,
+    grade      TEXT,
+    distribution TEXT,                      -- JSON {grade: share of samples}, --samples runs
+    entropy    REAL,
+    samples    INTEGER,
+    PRIMARY KEY (record_id, term)
+);
+"""
+
+# columns added after the first release: (table, column, type), added to older stores on open
+ADDED_COLUMNS = [
+    ("forecasts", "distribution", "TEXT"),
+    ("forecasts", "entropy",      "REAL"),
+    ("forecasts", "samples",      "INTEGER"),
+]
+JSON_COLUMNS = {"extractions": ("params",), "forecasts": ("distribution",)}
+
+# table → (key columns, value columns)
+TABLES = {
+    "extractions": (("record_id", "kind", "term"),
+                    ("template", "params", "query", "abstract", "response")),
+    "grades":      (("record_id", "term"), ("grade",)),
+    "forecasts":   (("record_id", "term"),
+                    ("scratchpad", "prediction", "grade", "distribution", "entropy", "samples")),
+}
+
+# default YAML file for each table (the stage CONFIG names)
+YAML_FILES = {
+    "records":     "impact_records.yaml",
+    "extractions": "abstract_extractions.yaml",
+    "grades":      "abstract_outcome_grades.yaml",
+    "forecasts":   "abstract_outcome_forecasts.yaml",
+}
+
+
+class Store:
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        for table, column, kind in ADDED_COLUMNS:
+            have = {c[1] for c in self.db.execute(f"PRAGMA table_info({table})")}
+            if column not in have:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+        self._templates = None      # template_id → text, loaded on first use
+
+    # ---------- records ----------
+    def replace_records(self, records) -> int:
+        """Replace the records table with ``records`` (impact_records.yaml order).
+
+        Records sharing a source ID are kept once, the first one winning, as
+        ``python record_ids.py`` does for the YAML artifacts; ``idx`` stays
+        the file position, so the positional-ID migration still lines up.
+        """
+        seen, duplicates = set(), []
+
+        def rows():
+            for idx, rec in enumerate(records, start=1):
+                if not isinstance(rec, dict):
+                    continue
+                rid = record_id(rec)
+                if rid in seen:
+                    duplicates.append(rid)
+                    continue
+                seen.add(rid)
+                yield idx, rid, rec.get("id"), json.dumps(rec, ensure_ascii=False)
+
+        with self.lock:
+            self.db.execute("DELETE FROM records")
+            cur = self.db.executemany(
+                "INSERT INTO records (idx, record_id, id, data) VALUES (?, ?, ?, ?)", rows())
+            self.db.commit()
+        if duplicates:
+            print(f"Warning: {len(duplicates)} records share a source ID with an earlier one "
+                  f"(e.g. {duplicates[0]}); kept the first of each")
+        return cur.rowcount
+
+    def migrate_record_ids(self) -> dict:
+        """Re-key positional ``R00001`` IDs to stable ones; {table: rows changed}."""
+        counts = {}
+        with self.lock:
+            mapping = [(record_id(json.loads(data)), f"R{idx:05}")
+                       for idx, data in self.db.execute("SELECT idx, data FROM records")]
+            for table in ("records", "abstracts", *TABLES):
+                # a row whose stable key already exists is left under its old ID
+                cur = self.db.executemany(
+                    f"UPDATE OR IGNORE {table} SET record_id = ? WHERE record_id = ?", mapping)
+                counts[table] = cur.rowcount
+            self.db.commit()
+        return counts
+
+    def records(self):
+        """Yield the records in file order, one page at a time."""
+        for values, _ in self._pages("SELECT idx, data FROM records", ("idx",)):
+            yield json.loads(values[0])
+
+    def _pages(self, select: str, order: tuple, where: str = "", args: tuple = (),
+               size: int = PAGE_SIZE):
+        """Yield ``(values, description)`` for ``select`` in keyset-paged batches.
+
+        ``select`` must start with the ``order`` columns; they are stripped
+        from the yielded values.  Only one page is in memory at a time and
+        the lock is not held between pages, so callers may write meanwhile.
+        """
+        last = None
+        cols = ", ".join(order)
+        while True:
+            cond, params = ([where] if where else []), list(args)
+            if last is not None:
+                cond.append(f"({cols}) > ({', '.join('?' * len(order))})")
+                params += last
+            sql = select + (" WHERE " + " AND ".join(cond) if cond else "")
+            with self.lock:
+                cur = self.db.execute(f"{sql} ORDER BY {cols} LIMIT {size}", params)
+                page, description = cur.fetchall(), cur.description[len(order):]
+            if not page:
+                return
+            for values in page:
+                yield values[len(order):], description
+            last = list(page[-1][:len(order)])
+
+    # ---------- extraction side tables ----------
+    def templates(self) -> dict:
+        with self.lock:
+            return dict(self.db.execute("SELECT template_id, text FROM templates"))
+
+    def put_templates(self, templates: dict) -> None:
+        with self.lock:
+            self._insert_templates(templates)
+            self.db.commit()
+
+    def _insert_templates(self, templates: dict) -> None:
+        self.db.executemany(
+            "INSERT OR IGNORE INTO templates (template_id, text) VALUES (?, ?)",
+            templates.items())
+        if self._templates is not None:
+            self._templates.update(templates)
+
+    def _known_templates(self) -> dict:
+        if self._templates is None:
+            self._templates = dict(self.db.execute("SELECT template_id, text FROM templates"))
+        return self._templates
+
+    def abstracts(self) -> dict:
+        with self.lock:
+            return dict(self.db.execute("SELECT record_id, abstract FROM abstracts"))
+
+    # ---------- stage queries ----------
+    def extractions(self, kind: str | None = None, text: bool = True):
+        """Yield extraction rows in the old row-dict shape, optionally of one ``kind``."""
+        where, args = ("kind = ?", (kind,)) if kind is not None else ("", ())
+        pages = self._pages("SELECT record_id, rowid, * FROM extractions",
+                            ("record_id", "rowid"), where, args)
+        rows = (self._unpack("extractions", v, d) for v, d in pages)
+        if not text:
+            yield from rows
+            return
+        doc = {"templates": self.templates(), "abstracts": self.abstracts(), "rows": rows}
+        yield from artifacts.expand(doc)
+
+    def interventions(self) -> dict:
+        """{record_id: intervention text} straight from the kind index."""
+        with self.lock:
+            return dict(self.db.execute(
+                "SELECT record_id, response FROM extractions WHERE kind = 'intervention'"))
+
+    def graded_pairs(self) -> list:
+        """[(true grade, forecast grade or None)] for every graded outcome."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT lower(trim(g.grade)), lower(trim(f.grade)) "
+                "FROM grades g LEFT JOIN forecasts f USING (record_id, term) "
+                "ORDER BY g.rowid").fetchall()
+
+    def graded_distributions(self) -> list:
+        """[(true grade, {grade: share}, samples)] for graded outcomes with a --samples forecast."""
+        with self.lock:
+            return [(g, json.loads(d), n) for g, d, n in self.db.execute(
+                "SELECT lower(trim(g.grade)), f.distribution, f.samples "
+                "FROM grades g JOIN forecasts f USING (record_id, term) "
+                "WHERE f.distribution IS NOT NULL ORDER BY g.rowid")]
+
+    def forecast_grades(self) -> list:
+        with self.lock:
+            return [g for (g,) in self.db.execute(
+                "SELECT lower(trim(grade)) FROM forecasts ORDER BY rowid")]
+
+    # ---------- rows ----------
+    def table(self, name: str, commit_every: int = 50) -> "StoreTable":
+        return StoreTable(self, name, commit_every)
+
+    def _pack(self, name: str, row: dict) -> tuple:
+        """Column values for ``row``; extraction rows are normalized first."""
+        if name == "extractions":
+            doc = artifacts.normalize([row], self._known_templates())
+            packed = doc["rows"][0]
+            for rid, abstract in doc["abstracts"].items():
+                stored = self.db.execute(
+                    "SELECT abstract FROM abstracts WHERE record_id = ?", (rid,)).fetchone()
+                if stored is None:
+                    self.db.execute("INSERT INTO abstracts (record_id, abstract) VALUES (?, ?)",
+                                    (rid, abstract))
+                elif stored[0] != abstract:
+                    packed["abstract"] = abstract
+            if doc["templates"].keys() - self._templates.keys():
+                self._insert_templates(doc["templates"])
+            row = dict(packed, params=packed.get("params"))
+        for c in JSON_COLUMNS.get(name, ()):
+            if row.get(c) is not None:
+                row = dict(row, **{c: json.dumps(row[c], ensure_ascii=False)})
+        keys, values = TABLES[name]
+        return tuple(row.get(c) for c in keys + values)
+
+    @staticmethod
+    def _unpack(name: str, values, description) -> dict:
+        row = {d[0]: v for d, v in zip(description, values) if v is not None}
+        for c in JSON_COLUMNS.get(name, ()):
+            if c in row:
+                row[c] = json.loads(row[c])
+        return row
+
+    # ---------- YAML import / export ----------
+    def import_yaml(self, name: str, path) -> int:
+        if name == "records":
+            return self.replace_records(yaml_cache.iter_list(path))
+        head = artifacts.read_head(path) if name == "extractions" else None
+        if head is not None:
+            self.put_templates(head["templates"])
+            with self.lock:
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO abstracts (record_id, abstract) VALUES (?, ?)",
+                    head["abstracts"].items())
+                self.db.commit()
+            rows = artifacts.iter_rows(path, text=False)
+        else:
+            # legacy extraction rows are normalized one by one as they are stored
+            rows = artifacts.iter_rows(path)
+        with self.table(name) as table:
+            count = 0
+            for row in rows:
+                table.append(row)
+                count += 1
+        return count
+
+    def export_yaml(self, name: str, path) -> int:
+        if name == "records":
+            return yaml_cache.write_list(path, self.records())
+        if name == "extractions":
+            return artifacts.write_rows(path, self.extractions(), self.templates())
+        return yaml_cache.write_list(path, self.table(name).values())
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+class StoreTable:
+    """One keyed table, used by stages 2–4 in place of a ``JournaledYaml``.
+
+    Appends are committed every ``commit_every`` rows and on ``checkpoint()``
+    / exit, the same group commit the YAML journal uses.
+    """
+
+    def __init__(self, store: Store, name: str, commit_every: int = 50):
+        self.store = store
+        self.name = name
+        self.commit_every = max(1, commit_every)
+        self.uncommitted = 0
+        self.keys_cols, self.value_cols = TABLES[name]
+        cols = self.keys_cols + self.value_cols
+        self.where = " AND ".join(f"{c} = ?" for c in self.keys_cols)
+        self.upsert = (
+            f"INSERT INTO {name} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))}) "
+            f"ON CONFLICT ({', '.join(self.keys_cols)}) DO UPDATE SET "
+            + ", ".join(f"{c} = excluded.{c}" for c in self.value_cols))
+
+    def __contains__(self, key) -> bool:
+        with self.store.lock:
+            return self.store.db.execute(
+                f"SELECT 1 FROM {self.name} WHERE {self.where}", tuple(key)).fetchone() is not None
+
+    def keys(self) -> list:
+        with self.store.lock:
+            return self.store.db.execute(
+                f"SELECT {', '.join(self.keys_cols)} FROM {self.name}").fetchall()
+
+    def values(self):
+        if self.name == "extractions":
+            return self.store.extractions()
+        pages = self.store._pages(f"SELECT rowid, * FROM {self.name}", ("rowid",))
+        return (self.store._unpack(self.name, v, d) for v, d in pages)
+
+    def append(self, row: dict) -> None:
+        with self.store.lock:
+            self.store.db.execute(self.upsert, self.store._pack(self.name, row))
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self._commit()
+
+    def replace_all(self, rows) -> None:
+        rows = list(rows)       # may be reading this very table
+        with self.store.lock:
+            self.store.db.execute(f"DELETE FROM {self.name}")
+        for row in rows:
+            self.append(row)
+        self.checkpoint()
+
+    def _commit(self) -> None:
+        self.store.db.commit()
+        self.uncommitted = 0
+
+    def checkpoint(self) -> None:
+        with self.store.lock:
+            self._commit()
+
+    def close(self, compact: bool = True) -> None:
+        self.checkpoint()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # rows appended before an exception are kept either way
+        self.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    p = argparse.ArgumentParser(description="Import YAML artifacts into the pipeline store, or export them back")
+    p.add_argument("action", choices=["import", "export"])
+    p.add_argument("--db", default=DEFAULT_PATH)
+    for name, default in YAML_FILES.items():
+        p.add_argument(f"--{name}", default=default, metavar="YAML",
+                       help=f"{name} artifact (default: {default})")
+    p.add_argument("--only", choices=list(YAML_FILES), nargs="+", default=list(YAML_FILES),
+                   help="tables to move (default: all)")
+    args = p.parse_args()
+    store = Store(args.db)
+    for name in args.only:
+        path = getattr(args, name)
+        if args.action == "import":
+            if not Path(path).exists():
+                print(f"Skipping {name}: {path} not found")
+                continue
+            print(f"Imported {store.import_yaml(name, path)} {name} rows from {path}")
+        else:
+            print(f"Exported {store.export_yaml(name, path)} {name} rows to {path}")
+    store.close()
@@ -0,0 +1,149 @@
+"""
+Schema-constrained JSON answers for stages 3 and 4.
+
+Both stages ask for a JSON object through the API's ``json_schema``
+response format, with the grade as an enum, instead of scraping labelled
+lines or free text.  The answer is still validated here (a cached answer,
+the --local-batch stand-in or a model without strict mode can drift):
+
+  parse()        one object against its schema → (value, None) or (None, why)
+  parse_items()  the valid items of a list field; invalid items are dropped
+                 so --per-record re-asks only those outcomes
+
+``run_validated()`` gives every malformed answer one retry whose prompt
+names what was wrong; answers that fail twice come back with their error.
+The stages hand ``accepts(parse_result)`` to the runner as well, so a
+malformed answer (first try or retry) is never cached and a later run asks
+the model again.
+"""
+import json
+
+from llm_runner import Job
+
+GRADES = ["Very significant", "Significant", "Neutral/mixed results",
+          "No effect", "Outcome was worsened", "No information"]
+
+RETRY_NOTE = (
+    "\n\nYour previous reply could not be used ({error}). "
+    "Reply again with a single JSON object that follows the required format exactly."
+)
+
+
+def obj(**properties) -> dict:
+    """Strict object schema: every property required, nothing else allowed."""
+    return {"type": "object", "properties": properties,
+            "required": list(properties), "additionalProperties": False}
+
+
+def string(enum: list | None = None) -> dict:
+    return {"type": "string", "enum": list(enum)} if enum else {"type": "string"}
+
+
+def array(items: dict) -> dict:
+    return {"type": "array", "items": items}
+
+
+def response_format(name: str, schema: dict) -> dict:
+    """The ``response_format`` argument asking for ``schema`` in strict mode."""
+    return {"type": "json_schema",
+            "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+def validate(value, schema: dict, path: str = "$") -> list:
+    """Problems with ``value`` against the subset of JSON Schema built above."""
+    kind = schema.get("type")
+    if kind == "object":
+        if not isinstance(value, dict):
+            return [f"{path} is not an object"]
+        errors = [f"{path}.{k} is missing" for k in schema.get("required", []) if k not in value]
+        for k, sub in schema.get("properties", {}).items():
+            if k in value:
+                errors += validate(value[k], sub, f"{path}.{k}")
+        return errors
+    if kind == "array":
+        if not isinstance(value, list):
+            return [f"{path} is not a list"]
+        return [e for i, item in enumerate(value)
+                for e in validate(item, schema["items"], f"{path}[{i}]")]
+    if kind == "string":
+        if not isinstance(value, str):
+            return [f"{path} is not a string"]
+        if "enum" in schema and normalize(value) not in {normalize(e) for e in schema["enum"]}:
+            return [f"{path} {value!r} is not one of: {', '.join(schema['enum'])}"]
+    return []
+
+
+def normalize(grade: str) -> str:
+    """Grades are compared and saved lower-cased, as before."""
+    return grade.strip().lower()
+
+
+def loads(text: str | None):
+    """(data, None) or (None, why) for a JSON answer."""
+    if not text:
+        return None, "the reply was empty"
+    try:
+        return json.loads(text), None
+    except json.JSONDecodeError as e:
+        return None, f"the reply is not valid JSON: {e.msg}"
+
+
+def parse(text: str | None, schema: dict) -> tuple:
+    """(value, None) if ``text`` is JSON matching ``schema``, else (None, why)."""
+    data, error = loads(text)
+    if error:
+        return None, error
+    errors = validate(data, schema)
+    if errors:
+        return None, "; ".join(errors[:3])
+    return data, None
+
+
+def parse_items(text: str | None, field: str, item_schema: dict) -> list:
+    """The items of ``data[field]`` that match ``item_schema`` (others are dropped)."""
+    data, _ = loads(text)
+    items = data.get(field) if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return []
+    return [item for item in items if not validate(item, item_schema)]
+
+
+def accepts(parse_result):
+    """``accept`` callback for the runners: cache only answers ``parse_result`` takes."""
+    return lambda result: parse_result(result)[1] is None
+
+
+def retry_job(job: Job, error: str) -> Job:
+    return Job(job.prompt + RETRY_NOTE.format(error=error), dict(job.meta, retry_of=error))
+
+
+def run_validated(execute, jobs, parse_result):
+    """Run ``jobs``, retrying each malformed answer once.
+
+    execute(jobs)          → iterable of ``Result`` in job order
+    parse_result(result)   → (value, None) or (None, why)
+
+    Yields ``(result, value, error)``.  API errors are passed through
+    without a retry (the runner has already retried them); a malformed
+    answer is re-asked after the first pass, and yields its error only if
+    the retry fails as well.
+    """
+    retry = []
+    for result in execute(jobs):
+        if result.error is not None:
+            yield result, None, str(result.error)
+            continue
+        value, error = parse_result(result)
+        if error is None:
+            yield result, value, None
+        else:
+            retry.append(retry_job(result.job, error))
+    if not retry:
+        return
+    print(f"Re-asking {len(retry)} malformed answers once")
+    for result in execute(retry):
+        if result.error is not None:
+            yield result, None, str(result.error)
+            continue
+        value, error = parse_result(result)
+        yield result, value, error
@@ -0,0 +1,197 @@
+"""
+Fast YAML loading shared by the stages and scripts/.
+
+``load(path)`` parses with libyaml's ``CSafeLoader`` when PyYAML was built
+with it (pure-Python ``SafeLoader`` otherwise) and keeps a pickle sidecar
+next to the file (``abstract_extractions.yaml.pickle``).  The sidecar is
+keyed by the file's resolved path, size and mtime, so an unchanged file is
+unpickled in milliseconds and any rewrite invalidates it.
+
+Each load prints whether the sidecar was used and how long it took;
+``report()`` sums up the run.  Set ``YAML_CACHE=0`` to skip the sidecars.
+
+For files too large to hold at once, ``iter_list()`` yields the items of a
+top-level list one at a time and ``write_list()`` writes items as they come;
+both work on the block-style lists PyYAML writes, where every item starts
+with "- " in column 0, and parse/dump ``CHUNK_ITEMS`` items per call.
+"""
+import itertools
+import os
+import pickle
+import time
+from pathlib import Path
+
+import yaml
+
+Loader  = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+Dumper  = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+ENABLED = os.getenv("YAML_CACHE", "1") != "0"
+VERSION = 1        # bump when the pickled layout changes
+CHUNK_ITEMS = 256  # list items parsed or dumped per libyaml call when streaming
+
+STATS = {"hits": 0, "misses": 0, "parse_seconds": 0.0, "load_seconds": 0.0}
+
+
+def sidecar_path(path) -> Path:
+    path = Path(path)
+    return path.with_name(path.name + ".pickle")
+
+
+def file_key(path) -> tuple:
+    st = Path(path).stat()
+    return VERSION, str(Path(path).resolve()), st.st_size, st.st_mtime_ns
+
+
+def parse_yaml(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return yaml.load(f, Loader=Loader)
+
+
+def cached(path, parse=parse_yaml):
+    """``parse(path)``, served from the pickle sidecar while the file is unchanged."""
+    path = Path(path)
+    started = time.perf_counter()
+    key = file_key(path)
+    sidecar = sidecar_path(path)
+    if ENABLED and sidecar.exists():
+        try:
+            with open(sidecar, "rb") as f:
+                stored_key, data = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            stored_key = None
+        if stored_key == key:
+            elapsed = time.perf_counter() - started
+            STATS["hits"] += 1
+            STATS["load_seconds"] += elapsed
+            print(f"Loaded {path} from {sidecar.name} in {elapsed * 1000:.0f} ms")
+            return data
+
+    data = parse(path)
+    elapsed = time.perf_counter() - started
+    STATS["misses"] += 1
+    STATS["parse_seconds"] += elapsed
+    STATS["load_seconds"] += elapsed
+    print(f"Parsed {path} with {Loader.__name__} in {elapsed:.2f} s")
+    if ENABLED:
+        _write_sidecar(sidecar, key, data)
+    return data
+
+
+def _write_sidecar(sidecar: Path, key: tuple, data) -> None:
+    tmp = sidecar.with_name(sidecar.name + ".tmp")
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump((key, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp.replace(sidecar)
+    except OSError as e:           # read-only data dir etc.; caching is best effort
+        print(f"Could not write {sidecar}: {e}")
+
+
+def load(path, default=None):
+    """The YAML document at ``path`` (``default`` if missing or empty)."""
+    if not Path(path).exists():
+        return default
+    return cached(path) or default
+
+
+# ---------- streaming ----------
+
+def iter_list(path, key: str | None = None, opener=None):
+    """Yield the items of the YAML list at ``path`` without loading it whole.
+
+    ``key`` streams the list under that top-level mapping key instead (e.g.
+    ``rows`` of a normalized artifact).  A missing file yields nothing; a
+    document that is not a block-style list is parsed in one go instead.
+    """
+    path = Path(path)
+    if not path.exists():
+        return
+    with (opener or _open_text)(path) as f:
+        if key is not None:
+            for line in f:
+                if line.startswith(f"{key}:"):
+                    if line[len(key) + 1:].strip():      # "rows: []" or flow style
+                        yield from yaml.load(line, Loader=Loader)[key] or []
+                        return
+                    break
+            else:
+                return
+        items, chunk, n = [], [], 0
+        for line in f:
+            if line.startswith("- ") or line.rstrip("\n") == "-":
+                if chunk:
+                    items.append("".join(chunk))
+                    if len(items) >= CHUNK_ITEMS:
+                        yield from _parse_items(items)
+                        items = []
+                chunk = [line]
+                n += 1
+            elif chunk and (line[:1] in (" ", "#", "\n") or not line.strip()):
+                chunk.append(line)
+            elif not chunk and (not line.strip() or line.startswith("#")):
+                continue
+            elif key is not None:
+                break                               # next top-level key ends the list
+            elif n == 0:
+                # not a block list we can split (flow style, a mapping, "[]"); parse it whole
+                rest = line + f.read()
+                yield from yaml.load(rest, Loader=Loader) or []
+                return
+            else:
+                raise ValueError(f"{path}: unexpected top-level line while streaming: {line[:60]!r}")
+        if chunk:
+            items.append("".join(chunk))
+        if items:
+            yield from _parse_items(items)
+
+
+def _parse_items(items: list) -> list:
+    return yaml.load("".join(items), Loader=Loader) or []
+
+
+def _open_text(path):
+    return open(path, "r", encoding="utf-8")
+
+
+def dump_items(items) -> str:
+    """YAML text for ``items`` as a block list (concatenations stay one list)."""
+    return yaml.dump(list(items), Dumper=Dumper, allow_unicode=True, sort_keys=False)
+
+
+def write_items(f, items) -> int:
+    """Write ``items`` to the open text file ``f`` in chunks; returns the count."""
+    count = 0
+    it = iter(items)
+    while chunk := list(itertools.islice(it, CHUNK_ITEMS)):
+        f.write(dump_items(chunk))
+        count += len(chunk)
+    return count
+
+
+def write_list(path, items) -> int:
+    """Atomically write ``items`` (any iterable) as one YAML list, streaming."""
+    path = Path(path)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        count = write_items(f, items)
+        if not count:
+            f.write("[]\n")
+    tmp.replace(path)
+    return count
+
+
+def report() -> None:
+    looked_up = STATS["hits"] + STATS["misses"]
+    if looked_up:
+        print(f"YAML loads: {STATS['hits']} sidecar hits / {STATS['misses']} parses, "
+              f"{STATS['parse_seconds']:.2f} s parsing, {STATS['load_seconds']:.2f} s total")
+
+
+if __name__ == "__main__":
+    import argparse
+    p = argparse.ArgumentParser(description="Load YAML files (building their pickle sidecars) and report timings")
+    p.add_argument("paths", nargs="+")
+    args = p.parse_args()
+    for path in args.paths:
+        load(path)
+    report()
@@ -0,0 +1,15 @@
+"""The pipeline modules live in src/ and import each other as top-level modules."""
+import importlib.util
+import sys
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+sys.path.insert(0, str(SRC))
+
+
+def load_stage(script: str):
+    """Import a numbered stage script (``1_make_database.py`` …) as a module."""
+    spec = importlib.util.spec_from_file_location(Path(script).stem, SRC / script)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
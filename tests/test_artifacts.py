@@ -0,0 +1,111 @@
+import pytest
+import yaml
+
+import artifacts
+
+ABSTRACT = {"3ie-1": "Cash transfers raised income.", "3ie-2": "Microcredit: no effect.\n\nSecond paragraph."}
+
+
+def question(rid, kind, term, q, response, abstract=None):
+    abstract = abstract or ABSTRACT[rid]
+    return {"record_id": rid, "kind": kind, "term": term,
+            "query": q + artifacts.ABSTRACT_SUFFIX.format(abstract=abstract),
+            "abstract": abstract, "response": response}
+
+
+# the old layout: one full dict per row, abstract repeated inside every query
+LEGACY = [
+    question("3ie-1", "intervention", None, "What was the intervention?", "cash transfers"),
+    question("3ie-1", "outcome", "Income", "Describe the outcome 'Income'.", "rose by 10%"),
+    question("3ie-2", "intervention", None, "What was the intervention?", "microcredit"),
+    # a re-crawl changed the abstract: kept inline on its row
+    question("3ie-2", "outcome", "Profit", "Describe 'Profit'.", "none", abstract="Revised abstract."),
+    # a prompt of another shape keeps its query
+    {"record_id": "3ie-2", "kind": "outcome", "term": "Sales", "query": "free-form prompt",
+     "abstract": ABSTRACT["3ie-2"], "response": "flat"},
+]
+
+
+def old_keys(rows):
+    """The fields of the old layout (expanded rows also keep template/params)."""
+    return [{k: row.get(k) for k in artifacts.LEGACY_KEYS} for row in rows]
+
+
+def write_legacy(path, rows):
+    path.write_text(yaml.safe_dump(rows, allow_unicode=True, sort_keys=False), encoding="utf-8")
+    return path
+
+
+def test_normalized_round_trip_matches_the_legacy_file(tmp_path):
+    legacy = write_legacy(tmp_path / "legacy.yaml", LEGACY)
+    normalized = tmp_path / "normalized.yaml"
+    assert artifacts.write_rows(normalized, artifacts.iter_rows(legacy)) == len(LEGACY)
+
+    assert list(artifacts.iter_rows(legacy)) == LEGACY
+    assert old_keys(artifacts.iter_rows(normalized)) == LEGACY
+    assert old_keys(artifacts.read_rows(normalized)) == LEGACY
+    assert normalized.stat().st_size < legacy.stat().st_size
+
+    head = artifacts.read_head(normalized)
+    assert head["abstracts"] == ABSTRACT
+    assert set(head["templates"]) == {artifacts.QUESTION_TEMPLATE_ID}
+    assert artifacts.read_head(legacy) is None
+    assert artifacts.read_doc(normalized)["rows"] == artifacts.read_doc(legacy)["rows"]
+
+
+def test_text_false_skips_rebuilding_the_prompt(tmp_path):
+    normalized = tmp_path / "normalized.yaml"
+    artifacts.write_rows(normalized, LEGACY)
+    rows = list(artifacts.iter_rows(normalized, text=False))
+    assert [r["response"] for r in rows] == [r["response"] for r in LEGACY]
+    assert "abstract" not in rows[0] and "query" not in rows[0]
+    assert rows[4]["query"] == "free-form prompt"
+
+
+def test_rows_keep_the_template_they_were_asked_with(tmp_path):
+    old = "Old wording.{abstract}"
+    new = "New wording: {term}.{abstract}"
+    templates = {artifacts.template_id("outcome", old): old,
+                 artifacts.template_id("outcome", new): new,
+                 artifacts.template_id("unused", "x"): "x"}
+    old_id, new_id, _ = templates
+    rows = [{"record_id": "3ie-1", "kind": "outcome", "term": "Income", "template": old_id,
+             "params": {}, "query": "ignored", "abstract": ABSTRACT["3ie-1"], "response": "a"},
+            {"record_id": "3ie-1", "kind": "outcome", "term": "Jobs", "template": new_id,
+             "params": {"term": "Jobs"}, "query": "ignored", "abstract": ABSTRACT["3ie-1"],
+             "response": "b"}]
+    path = tmp_path / "normalized.yaml"
+    artifacts.write_rows(path, iter(rows), templates)
+    assert set(artifacts.read_templates(path)) == {old_id, new_id}
+    assert [r["query"] for r in artifacts.iter_rows(path)] == [
+        "Old wording." + ABSTRACT["3ie-1"], "New wording: Jobs." + ABSTRACT["3ie-1"]]
+
+
+def test_write_rows_spools_and_cleans_up(tmp_path):
+    path = tmp_path / "normalized.yaml"
+    consumed = []
+
+    def rows():
+        for row in LEGACY:
+            consumed.append(row["term"])
+            yield row
+
+    assert artifacts.write_rows(path, rows()) == len(LEGACY)
+    assert len(consumed) == len(LEGACY)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["normalized.yaml"]
+    assert artifacts.write_rows(path, []) == 0
+    assert list(artifacts.iter_rows(path)) == []
+    assert artifacts.read_head(path)["abstracts"] == {}
+
+
+def test_zstd_round_trip(tmp_path):
+    pytest.importorskip("zstandard")
+    path = tmp_path / "normalized.yaml.zst"
+    artifacts.write_rows(path, LEGACY)
+    assert b"Cash transfers" not in path.read_bytes()
+    assert old_keys(artifacts.iter_rows(path)) == LEGACY
+    assert old_keys(artifacts.read_rows(path)) == LEGACY
+
+    doc = tmp_path / "doc.yaml.zst"
+    artifacts.write_doc(doc, artifacts.read_doc(path))
+    assert old_keys(artifacts.read_rows(doc)) == LEGACY
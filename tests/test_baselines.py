@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+import yaml
+
+import baselines
+
+
+def write(path, rows):
+    path.write_text(yaml.safe_dump(rows, sort_keys=False), encoding="utf-8")
+    return path
+
+
+@pytest.fixture
+def files(tmp_path):
+    grades = [
+        {"record_id": "3ie-1", "term": "Income", "grade": "Significant"},
+        {"record_id": "3ie-1", "term": "Forest cover", "grade": "No effect"},
+        {"record_id": "3ie-2", "term": "income", "grade": "Significant"},
+        {"record_id": "3ie-3", "term": "Income", "grade": "No effect"},
+        {"record_id": "3ie-4", "term": "Yields", "grade": "Very significant"},
+        {"record_id": "3ie-4", "term": "Skipped", "grade": "No information"},
+    ]
+    records = [
+        {"id": 1, "title": "a", "interventions": ["Cash transfers"]},
+        {"id": 2, "title": "b", "interventions": ["Cash transfers", "Microcredit"]},
+        {"id": 3, "title": "c", "interventions": []},
+        {"id": 4, "title": "d", "interventions": ["Microcredit"]},
+    ]
+    extractions = [
+        {"record_id": "3ie-1", "kind": "intervention", "term": None,
+         "response": "cash transfers to poor households"},
+        {"record_id": "3ie-2", "kind": "intervention", "term": None,
+         "response": "cash transfers to farmers"},
+        {"record_id": "3ie-4", "kind": "intervention", "term": None,
+         "response": "microcredit for farmers"},
+    ]
+    return (write(tmp_path / "grades.yaml", grades),
+            write(tmp_path / "extractions.yaml", extractions),
+            write(tmp_path / "records.yaml", records))
+
+
+def test_load_reads_categories_from_interventions(files):
+    data = baselines.load(*files)
+    assert len(data.y) == 5                              # "No information" is not a grade
+    assert data.n_categories == 2
+    assert baselines.coverage(data) == (3, 3)            # 3ie-3 has neither
+
+
+def test_global_prior_leaves_own_record_out(files):
+    data = baselines.load(*files)
+    prior = baselines.global_prior(data)
+    assert np.allclose(prior.sum(axis=1), 1)
+    # 3ie-4's one grade is "very significant", the only one in the file
+    vs = baselines.LABELS.index("very significant")
+    row = data.keys.index(("3ie-4", "Yields"))
+    assert prior[row, vs] == pytest.approx(baselines.BACKOFF / len(baselines.LABELS)
+                                           / (4 + baselines.BACKOFF))
+
+
+def test_base_rate_uses_other_records_only(files):
+    data = baselines.load(*files)
+    probs = baselines.base_rate(data)
+    assert np.allclose(probs.sum(axis=1), 1)
+    # changing 3ie-1's own grades does not change its forecast
+    flipped = baselines.load(*files)
+    flipped.y = flipped.y.copy()
+    rows = [i for i, (rid, _) in enumerate(data.keys) if rid == "3ie-1"]
+    flipped.y[rows] = 0
+    assert np.allclose(baselines.base_rate(flipped)[rows], probs[rows])
+    assert np.allclose(baselines.knn(flipped)[rows], baselines.knn(data)[rows])
+
+
+def test_base_rate_leaves_out_terms_that_collide_in_a_record(files, tmp_path):
+    grades, extractions, records = files
+    rows = yaml.safe_load(grades.read_text(encoding="utf-8"))
+    rows.append({"record_id": "3ie-1", "term": "income ", "grade": "No effect"})
+    data = baselines.load(write(tmp_path / "collide.yaml", rows), extractions, records)
+    probs = baselines.base_rate(data)
+    flipped = baselines.load(write(tmp_path / "collide.yaml", rows), extractions, records)
+    flipped.y = flipped.y.copy()
+    own = [i for i, (rid, _) in enumerate(data.keys) if rid == "3ie-1"]
+    flipped.y[own] = 2
+    assert np.allclose(baselines.base_rate(flipped)[own], probs[own])
+
+
+def test_knn_is_skipped_without_texts(files, capsys):
+    grades, _, records = files
+    data = baselines.load(grades, None, records)
+    assert "kNN tf-idf" not in baselines.available(data)
+    assert "no intervention texts" in capsys.readouterr().out
+    assert set(baselines.evaluate_all(data)) == {"global prior", "base rate"}
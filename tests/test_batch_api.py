@@ -0,0 +1,77 @@
+import pytest
+
+from batch_api import LocalBatchBackend, run_batch
+from llm_cache import LLMCache, cache_key
+from llm_runner import Job
+
+
+class Interrupted(Exception):
+    pass
+
+
+class FlakyBackend(LocalBatchBackend):
+    """Local backend whose first status check is interrupted (like Ctrl-C)."""
+
+    def __init__(self, root, reply):
+        super().__init__(root, reply)
+        self.interrupt = True
+        self.submitted = []
+
+    def submit(self, input_path):
+        batch_id = super().submit(input_path)
+        self.submitted.append(batch_id)
+        return batch_id
+
+    def status(self, batch_id):
+        if self.interrupt:
+            self.interrupt = False
+            raise Interrupted
+        return super().status(batch_id)
+
+
+def jobs(*prompts):
+    return [Job(p, {"prompt": p}) for p in prompts]
+
+
+def start_interrupted(tmp_path, prompts, system="system"):
+    backend = FlakyBackend(tmp_path / "batches", '{"grade": "No effect"}')
+    with pytest.raises(Interrupted):
+        run_batch(backend, jobs(*prompts), "m", system, tmp_path / "work", poll_interval=0)
+    assert (tmp_path / "work" / "batch_state.json").exists()
+    return backend
+
+
+def test_resume_covers_matching_jobs_and_caches_the_rest(tmp_path):
+    backend = start_interrupted(tmp_path, ["a", "b", "c"])
+    cache = LLMCache(tmp_path / "cache.sqlite")
+    results = run_batch(backend, jobs("b", "d"), "m", "system", tmp_path / "work",
+                        poll_interval=0, cache=cache)
+    assert [(r.job.prompt, r.job.meta, r.text) for r in results] == [
+        ("b", {"prompt": "b"}, '{"grade": "No effect"}'),
+        ("d", {"prompt": "d"}, '{"grade": "No effect"}')]
+    assert len(backend.submitted) == 2                   # "d" went into a new batch
+    for prompt in "abcd":                                # nothing paid for is lost
+        assert cache.get(cache_key("m", "system", prompt, {"temperature": 0})) is not None
+    assert not (tmp_path / "work" / "batch_state.json").exists()
+
+
+def test_resume_with_other_settings_only_caches(tmp_path):
+    backend = start_interrupted(tmp_path, ["a", "b"], system="per-record system")
+    cache = LLMCache(tmp_path / "cache.sqlite")
+    results = run_batch(backend, jobs("a"), "m", "single system", tmp_path / "work",
+                        poll_interval=0, cache=cache)
+    assert [r.job.prompt for r in results] == ["a"]
+    assert len(backend.submitted) == 2                   # asked again under its own settings
+    assert cache.get(cache_key("m", "per-record system", "b", {"temperature": 0})) is not None
+    assert cache.get(cache_key("m", "single system", "a", {"temperature": 0})) is not None
+
+
+def test_cached_answers_are_not_submitted(tmp_path):
+    backend = FlakyBackend(tmp_path / "batches", "fresh")
+    backend.interrupt = False
+    cache = LLMCache(tmp_path / "cache.sqlite")
+    cache.put(cache_key("m", "system", "a", {"temperature": 0}), "m", "cached")
+    results = run_batch(backend, jobs("a", "b"), "m", "system", tmp_path / "work",
+                        poll_interval=0, cache=cache)
+    assert [(r.text, r.cached) for r in results] == [("cached", True), ("fresh", False)]
+    assert len(backend.submitted) == 1
@@ -0,0 +1,86 @@
+import json
+
+import yaml
+
+from journal import Journal, JournaledYaml, iter_journal, read_journal, recover, row_key
+
+
+def test_recover_cuts_torn_last_line(tmp_path):
+    path = tmp_path / "impact_records.jsonl"
+    path.write_text('{"id": 1}\n{"id": 2}\n{"id": 3, "rec', encoding="utf-8")
+    assert recover(path) == len('{"id": 3, "rec')
+    assert path.read_text(encoding="utf-8") == '{"id": 1}\n{"id": 2}\n'
+    assert recover(path) == 0
+
+
+def test_recover_without_any_complete_line(tmp_path):
+    path = tmp_path / "impact_records.jsonl"
+    path.write_text('{"id": 1', encoding="utf-8")
+    recover(path)
+    assert path.read_text(encoding="utf-8") == ""
+    assert recover(tmp_path / "missing.jsonl") == 0
+
+
+def test_iter_journal_skips_torn_line_without_truncating(tmp_path):
+    path = tmp_path / "impact_records.jsonl"
+    path.write_text('{"id": 1}\n\n{"id": 2}\n{"id": 3', encoding="utf-8")
+    assert [e["id"] for e in iter_journal(path)] == [1, 2]
+    assert path.read_text(encoding="utf-8").endswith('{"id": 3')
+
+
+def test_journal_resumes_after_crash_and_later_entries_win(tmp_path):
+    path = tmp_path / "impact_records.jsonl"
+    with Journal(path) as journal:
+        journal.append({"id": 1, "title": "old"})
+        journal.append({"id": 2, "title": "b"})
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"id": 9, "ti')                   # crash mid-write
+    with Journal(path) as journal:
+        journal.append({"id": 1, "title": "new"})
+    replayed = read_journal(path, key=lambda e: e["id"])
+    assert {rid: e["title"] for rid, e in replayed.items()} == {1: "new", 2: "b"}
+    assert all(json.loads(line) for line in path.read_text(encoding="utf-8").splitlines())
+
+
+def test_group_commit_buffers_until_flush(tmp_path):
+    path = tmp_path / "grades.jsonl"
+    journal = Journal(path, flush_every=3)
+    journal.append({"n": 1})
+    journal.append({"n": 2})
+    assert list(iter_journal(path)) == []
+    journal.append({"n": 3})
+    assert [e["n"] for e in iter_journal(path)] == [1, 2, 3]
+    journal.append({"n": 4})
+    journal.close()
+    assert [e["n"] for e in iter_journal(path)] == [1, 2, 3, 4]
+
+
+def test_journaled_yaml_resumes_and_compacts(tmp_path):
+    path = tmp_path / "abstract_outcome_grades.yaml"
+    path.write_text(yaml.safe_dump([{"record_id": "3ie-1", "term": "Income", "grade": "no effect"}]),
+                    encoding="utf-8")
+    artifact = JournaledYaml(path, row_key, flush_every=2)
+    artifact.append({"record_id": "3ie-2", "term": "Income", "grade": "significant"})
+    artifact.append({"record_id": "3ie-1", "term": "Income", "grade": "significant"})
+    artifact.close(compact=False)                        # e.g. interrupted run
+
+    artifact = JournaledYaml(path, row_key)
+    assert ("3ie-2", None, "Income") in artifact and len(artifact) == 2
+    assert [r["grade"] for r in artifact.values()] == ["significant", "significant"]
+    artifact.close()                                     # compacts
+    assert yaml.safe_load(path.read_text(encoding="utf-8")) == [
+        {"record_id": "3ie-2", "term": "Income", "grade": "significant"},
+        {"record_id": "3ie-1", "term": "Income", "grade": "significant"}]
+    assert list(iter_journal(path.with_suffix(".jsonl"))) == []
+
+
+def test_journaled_yaml_keeps_journal_on_error(tmp_path):
+    path = tmp_path / "abstract_outcome_grades.yaml"
+    try:
+        with JournaledYaml(path, row_key) as artifact:
+            artifact.append({"record_id": "3ie-1", "term": "Income", "grade": "no effect"})
+            raise KeyboardInterrupt
+    except KeyboardInterrupt:
+        pass
+    assert not path.exists()
+    assert len(list(iter_journal(path.with_suffix(".jsonl")))) == 1
@@ -0,0 +1,49 @@
+import time
+
+from llm_cache import LLMCache, cache_key
+
+
+def test_cache_key_covers_every_input():
+    base = cache_key("gpt-4.1-mini", "system", "prompt", {"temperature": 0})
+    assert base == cache_key("gpt-4.1-mini", "system", "prompt", {"temperature": 0})
+    assert len(base) == 64
+    changed = [
+        cache_key("gpt-4.1", "system", "prompt", {"temperature": 0}),
+        cache_key("gpt-4.1-mini", "other", "prompt", {"temperature": 0}),
+        cache_key("gpt-4.1-mini", "system", "prompt!", {"temperature": 0}),
+        cache_key("gpt-4.1-mini", "system", "prompt", {"temperature": 1}),
+        cache_key("gpt-4.1-mini", "system", "prompt", {"temperature": 0, "n": 5}),
+    ]
+    assert base not in changed and len(set(changed)) == len(changed)
+
+
+def test_cache_key_ignores_param_order():
+    assert cache_key("m", "s", "p", {"temperature": 0, "n": 2}) == \
+           cache_key("m", "s", "p", {"n": 2, "temperature": 0})
+    assert cache_key("m", "s", "p") == cache_key("m", "s", "p", {})
+
+
+def test_put_get_and_counters(tmp_path):
+    cache = LLMCache(tmp_path / "cache.sqlite")
+    assert cache.get("k") is None
+    cache.put("k", "m", "answer", {"total_tokens": 3}, 0.5)
+    assert cache.get("k") == {"text": "answer", "usage": {"total_tokens": 3}, "latency": 0.5}
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+    cache.close()
+    reopened = LLMCache(tmp_path / "cache.sqlite")
+    assert reopened.stats()["total_hits"] == 1
+    assert reopened.get("k")["text"] == "answer"
+
+
+def test_evict_by_age_and_size(tmp_path):
+    cache = LLMCache(tmp_path / "cache.sqlite")
+    for i in range(4):
+        cache.put(f"k{i}", "m", "x" * 100)
+        time.sleep(0.01)
+    cache.get("k0")                                      # k0 becomes the most recently used
+    assert cache.evict(max_bytes=250) == 2
+    assert cache.get("k0") is not None and cache.get("k3") is not None
+    assert cache.get("k1") is None and cache.get("k2") is None
+    assert cache.evict(max_age_days=0) == 2
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,103 @@
+import threading
+import time
+
+from conftest import load_stage
+
+crawler = load_stage("1_make_database.py")
+
+
+def test_crawl_stops_fetching_when_closed_early(monkeypatch):
+    fetched = []
+    lock = threading.Lock()
+
+    def fetch_record(session, bucket, rid, query):
+        time.sleep(0.01)
+        with lock:
+            fetched.append(rid)
+        return {"id": rid, "title": None}
+
+    monkeypatch.setattr(crawler, "fetch_record", fetch_record)
+    ids = list(range(1000))
+    results = crawler.crawl(None, None, ids, crawler.DEFAULT_PROFILE, 2,
+                            crawler.AdaptiveBatchSize(1, 1))
+    first = [next(results) for _ in range(3)]
+    assert all(record["id"] == rid and exc is None for rid, record, exc in first)
+
+    started = time.monotonic()
+    results.close()
+    assert time.monotonic() - started < 0.5
+    time.sleep(0.1)
+    assert len(fetched) < 10               # the rest of the crawl was not run
+
+
+def test_crawl_yields_every_id_once(monkeypatch):
+    monkeypatch.setattr(crawler, "fetch_record",
+                        lambda session, bucket, rid, query: {"id": rid})
+    ids = list(range(50))
+    results = crawler.crawl(None, None, ids, crawler.DEFAULT_PROFILE, 4,
+                            crawler.AdaptiveBatchSize(1, 1))
+    assert sorted(rid for rid, _, _ in results) == ids
+
+
+def test_refresh_keeps_the_wider_stored_profile(monkeypatch):
+    queries = {}
+
+    def fetch_record(session, bucket, rid, query):
+        queries[rid] = query
+        return {"id": rid}
+
+    monkeypatch.setattr(crawler, "fetch_record", fetch_record)
+    done = {1: {"id": 1, "profile": "full", "record": {}},
+            2: {"id": 2, "profile": "pipeline-minimal", "record": {}}}
+    groups = crawler.fetch_profiles([1, 2, 3], done, "pipeline-minimal")
+    assert groups == {"pipeline-minimal": [2, 3], "full": [1]}
+
+    fetched = {rid: profile for profile, rid, _, _ in crawler.crawl_profiles(
+        None, None, groups, 2, crawler.AdaptiveBatchSize(1, 1))}
+    assert fetched == {1: "full", 2: "pipeline-minimal", 3: "pipeline-minimal"}
+    assert queries[1] == crawler.build_query("full")
+    assert queries[3] == crawler.build_query("pipeline-minimal")
+
+
+class DyingSizer(crawler.AdaptiveBatchSize):
+    """Batch size 1 that makes the worker asking for the third batch die."""
+
+    def __init__(self):
+        super().__init__(1, 1)
+        self.calls = 0
+
+    def current(self):
+        self.calls += 1
+        if self.calls == 3:
+            raise RuntimeError("worker died")
+        return super().current()
+
+
+def test_crawl_reports_ids_of_a_dead_worker_as_failed(monkeypatch):
+    monkeypatch.setattr(crawler, "fetch_record",
+                        lambda session, bucket, rid, query: {"id": rid})
+    ids = list(range(10))
+    results = list(crawler.crawl(None, None, ids, crawler.DEFAULT_PROFILE, 1,
+                                 DyingSizer(), poll=0.01))
+    assert [rid for rid, _, _ in results] == ids
+    assert [rid for rid, _, exc in results if exc is None] == [0, 1]
+    assert all(str(exc) == "worker died" for _, _, exc in results[2:])
+
+
+def test_crawl_gives_up_on_a_stalled_batch(monkeypatch):
+    release = threading.Event()
+
+    def fetch_record(session, bucket, rid, query):
+        if rid == 1:
+            release.wait(5)
+        return {"id": rid}
+
+    monkeypatch.setattr(crawler, "fetch_record", fetch_record)
+    started = time.monotonic()
+    results = list(crawler.crawl(None, None, [0, 1], crawler.DEFAULT_PROFILE, 1,
+                                 crawler.AdaptiveBatchSize(1, 1),
+                                 stall_timeout=0.2, poll=0.01))
+    release.set()
+    assert time.monotonic() - started < 2
+    assert results[0] == (0, {"id": 0}, None)
+    assert results[1][0] == 1 and isinstance(results[1][2], TimeoutError)
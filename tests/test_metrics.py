@@ -0,0 +1,128 @@
+import math
+from pathlib import Path
+
+import matplotlib
+import numpy as np
+import pytest
+
+import metrics
+from conftest import load_stage
+
+LABELS = ["outcome was worsened", "no effect", "neutral/mixed results",
+          "significant", "very significant"]
+SCORES = [0.00, 0.25, 0.50, 0.75, 1.00]
+
+
+def sample(n=400, seed=1):
+    rng = np.random.default_rng(seed)
+    y_true = rng.integers(0, 5, n)
+    y_pred = np.where(rng.random(n) < 0.6, y_true, rng.integers(0, 5, n))
+    return y_true, y_pred
+
+
+def test_chunk_stays_within_memory_budget():
+    assert metrics._chunk(10) == metrics.CHUNK
+    assert metrics._chunk(34_000) * 34_000 <= metrics.MAX_CELLS
+    assert metrics._chunk(10 ** 9) == 1
+
+
+def test_paired_permutation_does_not_depend_on_chunking(monkeypatch):
+    y_true, y_pred = sample()
+    mode = np.full(len(y_true), 3)
+    full = metrics.paired_permutation(y_true, y_pred, mode, SCORES, 2000,
+                                      np.random.default_rng(0))
+    monkeypatch.setattr(metrics, "MAX_CELLS", 400 * 7)      # 7 resamples per step
+    small = metrics.paired_permutation(y_true, y_pred, mode, SCORES, 2000,
+                                       np.random.default_rng(0))
+    assert small == full
+    assert full["accuracy"][1] < 0.01
+
+
+def test_identical_forecasts_are_not_significant():
+    y_true, y_pred = sample()
+    result = metrics.paired_permutation(y_true, y_pred, y_pred, SCORES, 500,
+                                        np.random.default_rng(0))
+    assert all(diff == 0 and p == 1 for diff, p in result.values())
+
+
+def test_shuffle_test_finds_skill(monkeypatch):
+    y_true, y_pred = sample()
+    monkeypatch.setattr(metrics, "MAX_CELLS", 400 * 50)
+    result = metrics.shuffle_test(y_true, y_pred, SCORES, 1000, np.random.default_rng(0))
+    assert result["accuracy"][1] == pytest.approx(1 / 1001)
+    assert result["kappa"][1] == pytest.approx(1 / 1001)
+
+
+def test_bootstrap_interval_contains_estimate():
+    y_true, y_pred = sample()
+    m = metrics.evaluate(y_true, y_pred, SCORES, LABELS)
+    ci = metrics.bootstrap(m.confusion, SCORES, 2000, np.random.default_rng(0))
+    for name in metrics.METRIC_NAMES:
+        low, high = ci[name]
+        assert low <= getattr(m, name) <= high
+
+
+def test_expected_random_matches_mean_of_draws_for_linear_metrics():
+    y_true, _ = sample()
+    confusion = metrics.confusion_matrix(y_true, y_true, 5)
+    expected = metrics.from_confusion(metrics.expected_random(confusion), SCORES, LABELS)
+    rng = np.random.default_rng(0)
+    draws = [metrics.evaluate(y_true, rng.integers(0, 5, len(y_true)), SCORES, LABELS)
+             for _ in range(400)]
+    assert expected.accuracy == pytest.approx(np.mean([d.accuracy for d in draws]), abs=0.005)
+    assert expected.brier == pytest.approx(np.mean([d.brier for d in draws]), abs=0.005)
+    assert expected.rmse ** 2 == pytest.approx(np.mean([d.rmse ** 2 for d in draws]), abs=0.005)
+
+
+# ---------- stage 5 against the report it replaced ----------
+
+DATA = Path(__file__).resolve().parent.parent / "data"
+
+
+def reference_report(truth: dict, pred: dict) -> dict:
+    """The pre-NumPy stage 5 arithmetic, pair by pair."""
+    grade_to_score = dict(zip(LABELS, SCORES))
+    pairs = [(t, pred.get(k)) for k, t in truth.items()
+             if t in grade_to_score and pred.get(k) in grade_to_score]
+    y_true = [grade_to_score[t] for t, _ in pairs]
+    y_pred = [grade_to_score[p] for _, p in pairs]
+    hit = [1 if t >= 0.75 else 0 for t in y_true]
+    f1s = []
+    for g in LABELS:
+        tp = sum(t == g and p == g for t, p in pairs)
+        fp = sum(t != g and p == g for t, p in pairs)
+        fn = sum(t == g and p != g for t, p in pairs)
+        prec = tp / (tp + fp) if tp + fp else 0
+        rec = tp / (tp + fn) if tp + fn else 0
+        f1s.append(0 if prec + rec == 0 else 2 * prec * rec / (prec + rec))
+    return {"n": len(pairs),
+            "rmse": math.sqrt(sum((p - t) ** 2 for p, t in zip(y_pred, y_true)) / len(pairs)),
+            "accuracy": sum(p == t for p, t in zip(y_pred, y_true)) / len(pairs),
+            "brier": sum((f - t) ** 2 for f, t in zip(y_pred, hit)) / len(pairs),
+            "macro_f1": sum(f1s) / len(f1s)}
+
+
+def test_evaluate_matches_pairwise_reference():
+    y_true, y_pred = sample(seed=7)
+    m = metrics.evaluate(y_true, y_pred, SCORES, LABELS)
+    keys = range(len(y_true))
+    ref = reference_report({k: LABELS[y_true[k]] for k in keys},
+                           {k: LABELS[y_pred[k]] for k in keys})
+    for name, value in ref.items():
+        assert getattr(m, name) == pytest.approx(value)
+
+
+def test_stage_5_reproduces_the_old_report_on_bundled_data():
+    matplotlib.use("Agg")
+    report = load_stage("5_report_stats_on_forecasts.py")
+    result = report.main(DATA / "abstract_outcome_grades.yaml",
+                         DATA / "abstract_outcome_forecasts.yaml", resamples=200)
+    model, mode = result["model"], result["most_common"]
+    # figures printed by the original report for data/
+    assert model.n == 133
+    assert round(model.rmse, 4) == 0.3081
+    assert round(model.accuracy, 5) == 0.48120
+    assert round(model.macro_f1, 4) == 0.3342
+    assert round(model.brier, 4) == 0.2030
+    assert (round(mode.rmse, 4), round(mode.accuracy, 5), round(mode.brier, 4)) == \
+           (0.3058, 0.51128, 0.2204)
@@ -0,0 +1,64 @@
+import json
+
+import yaml
+
+import pipeline
+
+
+def stage(name, **kwargs):
+    return next(s for s in pipeline.stages(**kwargs) if s.name == name)
+
+
+def test_pending_calls_tolerates_torn_journal_line(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    s1 = stage("1")
+    mod = pipeline.module(s1.script)
+    (tmp_path / s1.inputs[0]).write_text("https://x/record/1\nhttps://x/record/2\n"
+                                         "https://x/record/3\n", encoding="utf-8")
+    (tmp_path / mod.JOURNAL).write_text(json.dumps({"id": 1}) + "\n" + '{"id": 2, "rec',
+                                        encoding="utf-8")
+    assert pipeline.pending_calls(s1, {}, False, False).startswith("2 records to fetch")
+
+
+def test_modes_and_index_change_stage_4_settings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    default = pipeline.settings_hash(stage("4"))
+    assert pipeline.settings_hash(stage("4")) == default
+    assert pipeline.settings_hash(stage("4", samples=5)) != default
+    assert pipeline.settings_hash(stage("4", per_record=True)) != default
+
+    index = tmp_path / pipeline.module(stage("4").script).RETRIEVAL_INDEX
+    index.mkdir()
+    (index / "meta.json").write_text("{}", encoding="utf-8")
+    with_index = pipeline.settings_hash(stage("4", retrieve=3))
+    assert with_index not in (default, pipeline.settings_hash(stage("4", samples=5)))
+    (index / "meta.json").write_text('{"rebuilt": true}', encoding="utf-8")
+    assert pipeline.settings_hash(stage("4", retrieve=3)) != with_index
+    assert pipeline.settings_hash(stage("3", samples=5)) == pipeline.settings_hash(stage("3"))
+
+
+def test_stage_4_record_hash_ignores_outcome_text(tmp_path):
+    rows = [
+        {"record_id": "3ie-1", "kind": "intervention", "term": None, "response": "cash"},
+        {"record_id": "3ie-1", "kind": "outcome", "term": "Income", "response": "rose 10%"},
+        {"record_id": "3ie-1", "kind": "outcome", "term": "Health", "response": "No information"},
+    ]
+
+    def hashes(rows):
+        path = tmp_path / "extractions.yaml"
+        path.write_text(yaml.safe_dump(rows), encoding="utf-8")
+        return (pipeline.record_hashes(path, stage("4").row_part),
+                pipeline.record_hashes(path, stage("3").row_part))
+
+    forecast, grade = hashes(rows)
+    reworded = [dict(r) for r in rows]
+    reworded[1]["response"] = "rose by ten percent"
+    assert hashes(reworded)[0] == forecast           # stage 4 never reads the outcome text
+    assert hashes(reworded)[1] != grade              # stage 3 does
+
+    informative = [dict(r) for r in rows]
+    informative[2]["response"] = "improved"
+    assert hashes(informative)[0] != forecast        # one more outcome to forecast
+    new_intervention = [dict(r) for r in rows]
+    new_intervention[0]["response"] = "cash and training"
+    assert hashes(new_intervention)[0] != forecast
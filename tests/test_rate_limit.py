@@ -0,0 +1,46 @@
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from rate_limit import TokenBucket, backoff_delay, retry_after
+
+
+def test_bucket_allows_burst_then_refills_at_rate():
+    bucket = TokenBucket(rate=50, burst=3)
+    started = time.monotonic()
+    for _ in range(3):
+        bucket.acquire()
+    assert time.monotonic() - started < 0.02
+    bucket.acquire()                      # the fourth token takes 1/50 s to refill
+    assert time.monotonic() - started >= 0.015
+
+
+def test_pause_blocks_callers():
+    bucket = TokenBucket(rate=1000, burst=10)
+    bucket.pause(0.05)
+    started = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.045
+
+
+def test_bucket_rejects_non_positive_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+
+
+def test_retry_after_seconds_and_http_date():
+    assert retry_after("7") == 7.0
+    assert retry_after(" 1.5 ") == 1.5
+    assert retry_after("-3") == 0.0
+    assert retry_after(None) is None
+    assert retry_after("soon") is None
+    when = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert 25 <= retry_after(format_datetime(when, usegmt=True)) <= 30
+    past = datetime.now(timezone.utc) - timedelta(days=1)
+    assert retry_after(format_datetime(past, usegmt=True)) == 0.0
+
+
+def test_backoff_delay_is_capped():
+    assert all(0 <= backoff_delay(attempt, base=1, cap=4) <= 4 for attempt in range(1, 20))
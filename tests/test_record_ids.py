@@ -0,0 +1,100 @@
+import subprocess
+import sys
+from collections import Counter
+
+import pytest
+import yaml
+
+import record_ids
+from conftest import SRC, load_stage
+from store import Store
+
+RECORDS = [
+    {"id": 28503, "title": "a", "abstract": "x"},
+    {"id": None, "title": "no id", "abstract": "y"},
+    {"id": 7, "title": "c", "abstract": "z", "source": "scopus"},
+]
+
+
+def write(path, rows):
+    path.write_text(yaml.safe_dump(rows, sort_keys=False), encoding="utf-8")
+    return path
+
+
+def test_record_id_uses_the_source_id_or_a_content_hash():
+    assert record_ids.record_id(RECORDS[0]) == "3ie-28503"
+    assert record_ids.record_id(RECORDS[2]) == "scopus-7"
+    hashed = record_ids.record_id(RECORDS[1])
+    assert hashed.startswith("3ie-h") and len(hashed) == len("3ie-h") + 12
+    assert record_ids.record_id(dict(RECORDS[1], year=2020)) == hashed      # only title + abstract
+    assert record_ids.record_id(dict(RECORDS[1], abstract="other")) != hashed
+
+
+def test_check_stable_rejects_positional_keys():
+    assert record_ids.is_positional("R00001") and record_ids.is_positional("R123456")
+    assert not record_ids.is_positional("R1") and not record_ids.is_positional("3ie-R00001")
+    record_ids.check_stable([("3ie-1", "Income"), ("scopus-h00", None)], "grades.yaml")
+    with pytest.raises(SystemExit, match="grades.yaml still uses positional record IDs"):
+        record_ids.check_stable([("3ie-1", "Income"), ("R00002", "Income")], "grades.yaml")
+
+
+def test_positional_map_follows_file_order():
+    mapping = record_ids.positional_map(RECORDS[:1] + ["not a record"] + RECORDS[1:])
+    assert mapping == {"R00001": "3ie-28503", "R00003": record_ids.record_id(RECORDS[1]),
+                       "R00004": "scopus-7"}
+
+
+def test_rekey_counts_migrated_and_unmapped_rows():
+    counts = Counter()
+    rows = [{"record_id": "R00001", "term": "a"}, {"record_id": "R00009", "term": "b"},
+            {"record_id": "3ie-5", "term": "c"}]
+    out = list(record_ids.rekey(rows, {"R00001": "3ie-28503"}, counts))
+    assert [r["record_id"] for r in out] == ["3ie-28503", "R00009", "3ie-5"]
+    assert counts == {"migrated": 1, "unmapped": 1}
+    assert rows[0]["record_id"] == "R00001"         # input rows are not modified
+
+
+def test_migrate_yaml_merges_rows_whose_new_key_exists(tmp_path):
+    path = write(tmp_path / "grades.yaml", [
+        {"record_id": "R00001", "term": "Income", "grade": "Significant"},
+        {"record_id": "3ie-28503", "term": "Income", "grade": "No effect"},
+        {"record_id": "R00003", "term": "Sales", "grade": "No effect"},
+    ])
+    counts = record_ids.migrate_yaml(path, record_ids.positional_map(RECORDS))
+    assert counts == {"migrated": 2, "unmapped": 0, "merged": 1}
+    rows = yaml.safe_load(path.read_text(encoding="utf-8"))
+    assert [(r["record_id"], r["term"]) for r in rows] == [
+        ("3ie-28503", "Income"), ("scopus-7", "Sales")]
+
+
+def test_migration_script_rekeys_yaml_and_store(tmp_path):
+    records = write(tmp_path / "impact_records.yaml", RECORDS)
+    write(tmp_path / "abstract_outcome_grades.yaml",
+          [{"record_id": "R00003", "term": "Sales", "grade": "No effect"}])
+    store = Store(tmp_path / "pipeline.sqlite")
+    store.replace_records(RECORDS)
+    with store.table("grades") as grades:
+        grades.append({"record_id": "R00001", "term": "Income", "grade": "significant"})
+    store.close()
+
+    out = subprocess.run([sys.executable, str(SRC / "record_ids.py"), "--records", str(records),
+                          "--db", "pipeline.sqlite"],
+                         cwd=tmp_path, capture_output=True, text=True, check=True).stdout
+    assert "3 positional IDs mapped" in out
+    assert "Skipping abstract_extractions.yaml: not found" in out
+    rows = yaml.safe_load((tmp_path / "abstract_outcome_grades.yaml").read_text(encoding="utf-8"))
+    assert rows[0]["record_id"] == "scopus-7"
+    store = Store(tmp_path / "pipeline.sqlite")
+    assert store.table("grades").keys() == [("3ie-28503", "Income")]
+    store.close()
+
+
+def test_stage_3_refuses_positional_input(tmp_path, monkeypatch):
+    stage = load_stage("3_grade_outcomes.py")
+    monkeypatch.chdir(tmp_path)
+    write(tmp_path / stage.YAML_INPUT, [
+        {"record_id": "R00001", "kind": "intervention", "term": None, "response": "cash"},
+        {"record_id": "R00001", "kind": "outcome", "term": "Income", "response": "rose"},
+    ])
+    with pytest.raises(SystemExit, match=f"{stage.YAML_INPUT} still uses positional"):
+        stage.main()
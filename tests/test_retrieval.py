@@ -0,0 +1,59 @@
+import pytest
+import yaml
+
+import retrieval
+
+
+def write(path, rows):
+    path.write_text(yaml.safe_dump(rows, sort_keys=False), encoding="utf-8")
+    return path
+
+
+@pytest.fixture
+def index(tmp_path):
+    records = write(tmp_path / "records.yaml", [
+        {"id": 1, "year_of_publication": 2015},
+        {"id": 2, "year_of_publication": "2018"},
+        {"id": 3, "year_of_publication": 2020},
+        {"id": 4, "year_of_publication": None},
+        {"id": 5, "year_of_publication": 2016},
+    ])
+    extractions = write(tmp_path / "extractions.yaml", [
+        {"record_id": f"3ie-{i}", "kind": "intervention", "term": None, "response": text}
+        for i, text in [(1, "cash transfers to mothers"), (2, "conditional cash transfers"),
+                        (3, "cash transfers and school meals"), (4, "cash transfers"),
+                        (5, "irrigation canals for farmers")]
+    ])
+    grades = write(tmp_path / "grades.yaml", [
+        {"record_id": f"3ie-{i}", "term": "School enrolment", "grade": g}
+        for i, g in [(1, "Significant"), (2, "no effect"), (3, "very significant"),
+                     (4, "significant"), (5, "no information")]
+    ] + [{"record_id": "3ie-5", "term": "Crop yields", "grade": "significant"}])
+    out = tmp_path / "index"
+    counts = retrieval.build(out, records, extractions, grades)
+    assert counts["documents"] == 5
+    return retrieval.Index(out)
+
+
+def test_before_only_returns_earlier_known_years(index):
+    hits = index.search("cash transfers", "school enrolment", before=2019, k=10)
+    assert {h.record_id for h in hits} == {"3ie-1", "3ie-2"}     # not 2020, not unknown
+    assert all(h.year < 2019 for h in hits)
+    assert index.search("cash transfers", "School enrolment", before=2015) == []
+
+
+def test_search_filters_term_exclusions_and_skipped_grades(index):
+    hits = index.search("cash transfers", "  School   Enrolment ", k=10, exclude="3ie-3")
+    assert "3ie-3" not in {h.record_id for h in hits}
+    assert "3ie-5" not in {h.record_id for h in hits}             # "no information" skipped
+    assert [h.record_id for h in index.search("farmers", "Crop yields")] == ["3ie-5"]
+    assert index.search("cash", "Unknown outcome") == []
+    assert index.year("3ie-2") == 2018 and index.year("3ie-4") == -1
+
+
+@pytest.mark.parametrize("method", ["bm25", "tfidf"])
+def test_more_similar_text_ranks_first(index, method):
+    hits = index.search("conditional cash transfers", "School enrolment", k=3, method=method)
+    assert hits[0].record_id == "3ie-2"
+    assert hits[0].grade == "no effect"
+    assert [h.score for h in hits] == sorted((h.score for h in hits), reverse=True)
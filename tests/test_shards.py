@@ -0,0 +1,65 @@
+import json
+
+import pytest
+import yaml
+
+import shards
+
+
+def write(path, rows):
+    path.write_text(yaml.safe_dump(rows, sort_keys=False), encoding="utf-8")
+
+
+def grade(rid, term, grade):
+    return {"record_id": rid, "term": term, "grade": grade}
+
+
+@pytest.fixture
+def outputs(tmp_path):
+    path = tmp_path / "abstract_outcome_grades.yaml"
+    write(path, [grade("3ie-1", "Income", "significant")])
+    write(shards.shard_path(path, (2, 2)), [grade("3ie-3", "Income", "no effect"),
+                                            grade("3ie-1", "Income", "significant")])
+    write(shards.shard_path(path, (1, 2)), [grade("3ie-2", "Income", "no effect")])
+    # a row still in shard 1's journal counts as well
+    journal = shards.journal_path(shards.shard_path(path, (1, 2)))
+    journal.write_text(json.dumps(grade("3ie-4", "Health", "significant")) + "\n",
+                       encoding="utf-8")
+    return path
+
+
+def test_parse_and_assign_shards():
+    assert shards.parse_shard("2/4") == (2, 4)
+    assert shards.parse_shard(None) is None
+    for bad in ("0/4", "5/4", "two"):
+        with pytest.raises(SystemExit):
+            shards.parse_shard(bad)
+    ids = [f"3ie-{i}" for i in range(200)]
+    owners = [[i for i in range(1, 5) if shards.in_shard(rid, (i, 4))] for rid in ids]
+    assert all(len(o) == 1 for o in owners)              # every record in exactly one shard
+
+
+def test_merge_is_ordered_and_drops_duplicates(outputs):
+    stats = shards.merge(outputs)
+    assert (stats["shards"], stats["added"], stats["duplicates"], stats["conflicts"]) == (2, 3, 1, [])
+    rows = yaml.safe_load(outputs.read_text(encoding="utf-8"))
+    # canonical rows first, then shard 1 (file, then journal), then shard 2
+    assert [r["record_id"] for r in rows] == ["3ie-1", "3ie-2", "3ie-4", "3ie-3"]
+    assert shards.shard_files(outputs) == []
+
+
+def test_merge_keeps_first_answer_on_conflict(outputs):
+    write(shards.shard_path(outputs, (2, 2)), [grade("3ie-2", "Income", "significant")])
+    stats = shards.merge(outputs)
+    assert stats["conflicts"] == [(("3ie-2", None, "Income"), "abstract_outcome_grades.shard2of2.yaml")]
+    rows = {r["record_id"]: r["grade"] for r in yaml.safe_load(outputs.read_text(encoding="utf-8"))}
+    assert rows["3ie-2"] == "no effect"
+
+
+def test_strict_merge_writes_nothing_on_conflict(outputs):
+    write(shards.shard_path(outputs, (2, 2)), [grade("3ie-2", "Income", "significant")])
+    before = outputs.read_text(encoding="utf-8")
+    stats = shards.merge(outputs, strict=True)
+    assert len(stats["conflicts"]) == 1
+    assert outputs.read_text(encoding="utf-8") == before
+    assert len(shards.shard_files(outputs)) == 2
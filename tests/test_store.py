@@ -0,0 +1,21 @@
+from store import Store
+
+
+def test_replace_records_keeps_first_of_duplicate_ids(tmp_path, capsys):
+    store = Store(tmp_path / "pipeline.sqlite")
+    records = [{"id": 1, "title": "first"}, {"id": 2, "title": "other"},
+               {"id": 1, "title": "re-listed"}, "not a record"]
+    assert store.replace_records(records) == 2
+    assert "1 records share a source ID" in capsys.readouterr().out
+    assert [r["title"] for r in store.records()] == ["first", "other"]
+    store.close()
+
+
+def test_tables_resume_by_key(tmp_path):
+    store = Store(tmp_path / "pipeline.sqlite")
+    with store.table("grades") as grades:
+        grades.append({"record_id": "3ie-1", "term": "Income", "grade": "significant"})
+    grades = store.table("grades")
+    assert ("3ie-1", "Income") in grades
+    assert ("3ie-1", "Health") not in grades
+    store.close()
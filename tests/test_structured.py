@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+from llm_cache import LLMCache
+from llm_runner import Job, LLMRunner
+from structured import GRADES, accepts, obj, parse, run_validated, string
+
+SCHEMA = obj(grade=string(GRADES))
+
+
+class FakeClient:
+    """Answers every chat-completion request with the next canned reply."""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.prompts = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, **params):
+        self.prompts.append(messages[-1]["content"])
+        message = SimpleNamespace(content=self.replies.pop(0))
+        return SimpleNamespace(usage=None,
+                               choices=[SimpleNamespace(message=message, finish_reason="stop")])
+
+
+def parse_grade(result):
+    value, error = parse(result.text, SCHEMA)
+    return (None, error) if error else (value["grade"].lower(), None)
+
+
+def runner(client, cache):
+    return LLMRunner("test-model", "system", client=client, cache=cache,
+                     accept=accepts(parse_grade), max_concurrency=1)
+
+
+def test_parse_rejects_grade_outside_enum():
+    assert parse('{"grade": "Significant"}', SCHEMA) == ({"grade": "Significant"}, None)
+    assert parse('{"grade": "Great"}', SCHEMA)[1]
+    assert parse("Significant", SCHEMA)[1]
+
+
+def test_malformed_answers_are_not_cached(tmp_path):
+    cache = LLMCache(tmp_path / "cache.sqlite")
+    client = FakeClient(["not json", '{"grade": "Great"}'])
+    results = list(run_validated(runner(client, cache).run, [Job("prompt", {"n": 1})], parse_grade))
+    assert [(value, bool(error)) for _, value, error in results] == [(None, True)]
+    assert cache.stats()["entries"] == 0
+
+    # the next run asks the model again instead of replaying the bad answer
+    client = FakeClient(['{"grade": "No effect"}'])
+    results = list(run_validated(runner(client, cache).run, [Job("prompt", {"n": 1})], parse_grade))
+    assert [(value, error) for _, value, error in results] == [("no effect", None)]
+    assert client.prompts == ["prompt"]
+    assert cache.stats()["entries"] == 1
+
+
+def test_rejected_cache_entry_is_asked_again(tmp_path):
+    cache = LLMCache(tmp_path / "cache.sqlite")
+    plain = LLMRunner("test-model", "system", client=FakeClient(["oops"]), cache=cache)
+    assert plain.ask("prompt") == "oops"          # cached by a runner without ``accept``
+
+    client = FakeClient(['{"grade": "Significant"}'])
+    assert runner(client, cache).ask("prompt") == '{"grade": "Significant"}'
+    assert client.prompts == ["prompt"]
@@ -0,0 +1,52 @@
+import pytest
+import yaml
+
+import yaml_cache
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(yaml_cache, "CHUNK_ITEMS", 3)     # several chunks per file
+
+
+ROWS = [{"record_id": f"3ie-{i}", "term": f"t{i}", "response": "line one\n\nline three",
+         "nested": [{"a": i}, "- not an item"]} for i in range(10)] + [None, "text", []]
+
+
+def test_iter_list_streams_what_yaml_load_reads(tmp_path):
+    path = tmp_path / "rows.yaml"
+    assert yaml_cache.write_list(path, iter(ROWS)) == len(ROWS)
+    assert yaml.safe_load(path.read_text(encoding="utf-8")) == ROWS
+    assert list(yaml_cache.iter_list(path)) == ROWS
+
+
+def test_iter_list_handles_comments_flow_style_and_missing_files(tmp_path):
+    path = tmp_path / "rows.yaml"
+    path.write_text("# header\n\n- a: 1\n  # inside\n- b: 2\n-\n  c: 3\n", encoding="utf-8")
+    assert list(yaml_cache.iter_list(path)) == [{"a": 1}, {"b": 2}, {"c": 3}]
+    path.write_text("[{a: 1}, {b: 2}]\n", encoding="utf-8")
+    assert list(yaml_cache.iter_list(path)) == [{"a": 1}, {"b": 2}]
+    yaml_cache.write_list(path, [])
+    assert list(yaml_cache.iter_list(path)) == []
+    assert list(yaml_cache.iter_list(tmp_path / "missing.yaml")) == []
+
+
+def test_iter_list_under_a_key(tmp_path):
+    path = tmp_path / "doc.yaml"
+    path.write_text("format: 2\ntemplates:\n  q: '{abstract}'\nrows:\n- x: 1\n- x: 2\n"
+                    "after: true\n", encoding="utf-8")
+    assert list(yaml_cache.iter_list(path, key="rows")) == [{"x": 1}, {"x": 2}]
+    path.write_text("rows: []\n", encoding="utf-8")
+    assert list(yaml_cache.iter_list(path, key="rows")) == []
+    assert list(yaml_cache.iter_list(path, key="other")) == []
+
+
+def test_iter_list_is_lazy(tmp_path):
+    path = tmp_path / "rows.yaml"
+    yaml_cache.write_list(path, ROWS[:9])
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("oops: not a list item\n")
+    rows = yaml_cache.iter_list(path)
+    assert [next(rows) for _ in range(3)] == ROWS[:3]    # the bad tail is not read yet
+    with pytest.raises(ValueError):
+        list(rows)